@@ -38,12 +38,13 @@ class Stations(object):
         }
 
     def _dict_to_station(self, sid, data):
-        for k, v in data.iteritems():
-            logger.debug('stationid:{} key:\'{}\' value:\'{}\''.format(sid, k, v))
-            try:
-                stations[sid].__setattr__(k, v)
-            except:
-                logger.exception('Error setting station %d, \'%s\' to \'%s\'', sid, k, v)
+        with options.batch(stations[sid]):
+            for k, v in data.iteritems():
+                logger.debug('stationid:{} key:\'{}\' value:\'{}\''.format(sid, k, v))
+                try:
+                    stations[sid].__setattr__(k, v)
+                except:
+                    logger.exception('Error setting station %d, \'%s\' to \'%s\'', sid, k, v)
 
     @does_json
     def GET(self, station_id=None):
@@ -130,27 +131,28 @@ class Programs(object):
             ProgramType.WEEKLY_WEATHER: prog.set_weekly_weather
         }
 
-        for k, v in data.iteritems():
-            logger.debug('Setting program property key:\'%s\' to value:\'%s\'', k, v)
-            try:
-                if k not in self.EXCLUDED_KEYS:
-                    prog.__setattr__(k, v)
-            except:
-                logger.exception('Error setting program property key:\'%s\' to value:\'%s\'', k, v)
-
-            if prog.type is ProgramType.CUSTOM:
-                # CUSTOM
-                prog.modulo = data['modulo']
-                prog.manual = False
+        with options.batch(prog):
+            for k, v in data.iteritems():
+                logger.debug('Setting program property key:\'%s\' to value:\'%s\'', k, v)
                 try:
-                    prog.start = datetime.fromtimestamp(data['start'])
+                    if k not in self.EXCLUDED_KEYS:
+                        prog.__setattr__(k, v)
                 except:
-                    prog.start = datetime.now()
-                prog.schedule = data['schedule']
-            else:
-                # All other types
-                program_set = set_method_table[prog.type]
-                program_set(*data['type_data'])
+                    logger.exception('Error setting program property key:\'%s\' to value:\'%s\'', k, v)
+
+                if prog.type is ProgramType.CUSTOM:
+                    # CUSTOM
+                    prog.modulo = data['modulo']
+                    prog.manual = False
+                    try:
+                        prog.start = datetime.fromtimestamp(data['start'])
+                    except:
+                        prog.start = datetime.now()
+                    prog.schedule = data['schedule']
+                else:
+                    # All other types
+                    program_set = set_method_table[prog.type]
+                    program_set(*data['type_data'])
 
     def __init__(self):
         self.EXCLUDED_KEYS = [
@@ -14,6 +14,7 @@ import web
 from errors import badrequest, unauthorized
 
 from ospy.helpers import test_password
+from ospy.intervals import Interval
 from ospy.options import options
 
 logger = logging.getLogger('OSPyAPI')
@@ -45,7 +46,8 @@ def local_to_utc(dt):
 _json_dumps = partial(json.dumps,
                       # default=lambda x: x.isoformat() if hasattr(x, 'isoformat') else str(x),
                       # default=lambda x: local_to_utc(x).isoformat() if hasattr(x, 'isoformat') else str(x),
-                      default=lambda x: to_timestamp(x) if hasattr(x, 'isoformat') else str(x),
+                      default=lambda x: to_timestamp(x) if hasattr(x, 'isoformat') else
+                                        dict(x) if isinstance(x, Interval) else str(x),
                       sort_keys=False)
 
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# The ospy modules keep their data in ./ospy/data, so the benchmarks run in a temporary folder.
+# Run a benchmark from the root folder using: python -m benchmarks.<name>
+
+# System imports
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path = [ROOT] + [p for p in sys.path if p and os.path.abspath(p) != ROOT]
+__path__[:] = [os.path.abspath(p) for p in __path__]
+
+_work_dir = tempfile.mkdtemp(prefix='ospy_benchmarks_')
+os.makedirs(os.path.join(_work_dir, 'ospy', 'data'))
+os.chdir(_work_dir)
+atexit.register(shutil.rmtree, _work_dir, True)
+
+
+def timed(function, *args, **kwargs):
+    """Returns the result of the function and the number of seconds it took (best of 3 runs)."""
+    best = None
+    result = None
+    for _ in range(3):
+        start = time.time()
+        result = function(*args, **kwargs)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return result, best
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Time to list all stations and all programs the way the API does (GET /stations and GET /programs),
+# with the index found by searching the list (old) and with the stored index (new).
+# The API itself needs web.py, so the listings below access the same attributes as its converters.
+
+# System imports
+import logging
+import os
+
+# Local imports
+from benchmarks import timed
+from ospy.options import options
+from ospy.programs import programs, ProgramType, _Program
+from ospy.stations import stations, _Station
+
+
+def _old_station_index(self):
+    return self._stations.get().index(self)
+
+
+def _old_program_index(self):
+    try:
+        return self._programs.get().index(self)
+    except ValueError:
+        return -1
+
+
+def _list_stations():
+    return [{
+        'id': station.index,
+        'name': station.name,
+        'enabled': station.enabled,
+        'ignore_rain': station.ignore_rain,
+        'is_master': station.is_master,
+        'activate_master': station.activate_master,
+        'remaining_seconds': station.remaining_seconds,
+        'running': station.active
+    } for station in stations]
+
+
+def _list_programs():
+    return [{
+        'id': program.index,
+        'name': program.name,
+        'stations': program.stations,
+        'enabled': program.enabled,
+        'type': program.type,
+        'type_name': ProgramType.NAMES.get(program.type, ''),
+        'type_data': program.type_data,
+        'summary': program.summary(),
+        'schedule': program.schedule,
+        'modulo': program.modulo,
+        'manual': program.manual,
+        'start': program.start,
+    } for program in programs]
+
+
+def _compare(name, counts, resize, listing):
+    print '%-10s %7s %11s %11s %14s %14s' % (name, 'Count', 'Old', 'New', 'Old per item', 'New per item')
+    new_index = {_Station: _Station.index, _Program: _Program.index}
+    for count in counts:
+        resize(count)
+        _Station.index, _Program.index = property(_old_station_index), property(_old_program_index)
+        old_result, old_time = timed(listing)
+        _Station.index, _Program.index = new_index[_Station], new_index[_Program]
+        new_result, new_time = timed(listing)
+        assert old_result == new_result
+
+        print '%-10s %7d %10.2fms %10.2fms %12.1fus %12.1fus' % (
+            name, count, old_time * 1000, new_time * 1000, old_time / count * 1e6, new_time / count * 1e6)
+    print
+
+
+def _resize_programs(count):
+    while programs.count() < count:
+        program = programs.create_program()
+        program.stations = [programs.count() % stations.count()]
+        program.set_days_simple(6 * 60, 30, 10, 2, [0, 2, 4])
+        programs.add_program(program)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    _compare('Stations', [64, 128, 256, 512, 1024], lambda count: setattr(options, 'output_count', count),
+             _list_stations)
+
+    options.output_count = 64
+    _compare('Programs', [25, 50, 100, 200, 400], _resize_programs, _list_programs)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Memory used by a 30-day run history and a 2-day prediction for 200 stations,
+# with the intervals stored as dictionaries (old) and as slotted Interval records (new).
+# The values (datetimes, strings) are the same objects in both cases, so the difference is the overhead per interval.
+
+# System imports
+import datetime
+import logging
+import os
+import random
+import sys
+
+# Local imports
+from ospy.intervals import Interval
+from ospy.options import options
+from ospy.programs import programs
+from ospy.scheduler import predicted_schedule
+
+
+def _size(obj, seen):
+    """Returns the size of the object and everything it refers to that has not been seen yet."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    result = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        result += sum(_size(key, seen) + _size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        result += sum(_size(value, seen) for value in obj)
+    elif isinstance(obj, Interval):
+        result += sum(_size(getattr(obj, key), seen) for key in Interval.__slots__ if hasattr(obj, key))
+    return result
+
+
+def _sizes(name, intervals, as_log):
+    as_dicts = [dict(interval.iteritems()) for interval in intervals]
+    if as_log:
+        intervals = [{'time': interval['start'], 'level': 20, 'data': interval} for interval in intervals]
+        as_dicts = [{'time': interval['start'], 'level': 20, 'data': interval} for interval in as_dicts]
+
+    values = set()
+    for interval in as_dicts:
+        _size(interval['data'] if as_log else interval, values)
+    values.difference_update(id(interval['data'] if as_log else interval) for interval in as_dicts)
+
+    old = _size(as_dicts, set(values))
+    new = _size(intervals, set(values))
+    print '%-22s %9d %10.2fMB %10.2fMB %9d %9d %9.1fx' % (
+        name, len(intervals), old / 1e6, new / 1e6, old / len(intervals), new / len(intervals), float(old) / new)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    rnd = random.Random(1)
+    options.output_count = 200
+    options.max_usage = 0
+    for index in range(20):
+        program = programs.create_program()
+        program.stations = range(index * 10, index * 10 + 10)
+        program.set_days_simple(rnd.randint(0, 1439), rnd.randint(5, 20), 10, 2, range(7))
+        programs.add_program(program)
+
+    now = datetime.datetime.now()
+    history = predicted_schedule(now - datetime.timedelta(days=30), now)
+    for interval in history:
+        interval['active'] = False
+    prediction = predicted_schedule(now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+
+    print '%-22s %9s %12s %12s %9s %9s %10s' % (
+        'Data', 'Intervals', 'Dicts', 'Intervals', 'Dict/run', 'Slots/run', 'Reduction')
+    _sizes('Run log (30 days)', history, True)
+    _sizes('Prediction (2 days)', prediction, False)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Bytes written to disk per option change with 100 programs and 200 stations.
+# The full rewrite is the size of all pickled values (what a checkpoint writes), the journal size is measured.
+
+# System imports
+import os
+import pickle
+import random
+
+# Local imports
+from ospy import options as options_module
+from ospy.options import options
+from ospy.stations import stations
+from ospy.programs import programs
+
+
+def _write():
+    if options._write_timer is not None:
+        options._write_timer.cancel()
+    before = os.path.getsize(options_module.JOURNAL_FILE)
+    options._write()
+    return os.path.getsize(options_module.JOURNAL_FILE) - before
+
+
+def main():
+    rnd = random.Random(1)
+    options.output_count = 200
+    for index in range(100):
+        program = programs.create_program()
+        program.stations = rnd.sample(range(200), 20)
+        program.set_days_simple(rnd.randint(0, 1439), rnd.randint(5, 30), 10, 3, range(7))
+        programs.add_program(program)
+
+    # Start from a checkpoint (written by hand to keep the benchmark independent of the dbm module):
+    with open(options_module.JOURNAL_FILE, 'wb') as fh:
+        pickle.dump(options._checkpoint, fh, pickle.HIGHEST_PROTOCOL)
+    options._journal_valid = True
+    options._dirty = set()
+
+    full = sum(len(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)) + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+               for key, value in options._values.iteritems())
+
+    changes = [
+        ('Station name', lambda i: setattr(stations.get(i), 'name', 'Station %d' % i)),
+        ('Program schedule', lambda i: programs.get(i % 100).set_days_simple(i, 10, 5, 2, [0, 2, 4])),
+        ('Global option', lambda i: setattr(options, 'station_delay', i % 60)),
+    ]
+
+    print 'Full rewrite: %d bytes per change' % full
+    print '%-20s %15s %12s' % ('Change', 'Journal bytes', 'Reduction')
+    for name, change in changes:
+        written = []
+        for i in range(50):
+            change(i)
+            written.append(_write())
+        average = float(sum(written)) / len(written)
+        print '%-20s %15.0f %11.0fx' % (name, average, full / average)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Time to determine the intervals of a program with 32 stations for every program type and a few window sizes.
+# The old implementation was called for every station, the new one calculates all stations in one call.
+
+# System imports
+import datetime
+import logging
+import os
+
+# Local imports
+from benchmarks import timed
+from ospy.options import options
+from ospy.programs import programs, ProgramType
+
+
+def _old_active_intervals(program, date_time_start, date_time_end, station):
+    """The active intervals as they were determined before intervals were generated in minutes."""
+    if station in program._station_schedule:
+        schedule = program._station_schedule[station]
+    else:
+        schedule = []
+
+    result = []
+    if program.manual:
+        current_date_time = program.start
+    else:
+        start_delta = date_time_start - program.start
+        start_minutes = (start_delta.days*24*60 + int(start_delta.seconds/60)) % program.modulo
+        current_date_time = date_time_start - datetime.timedelta(minutes=start_minutes,
+                                                                 seconds=date_time_start.second,
+                                                                 microseconds=date_time_start.microsecond)
+
+    while current_date_time < date_time_end:
+        for entry in schedule:
+            start = current_date_time + datetime.timedelta(minutes=entry[0])
+            end = current_date_time + datetime.timedelta(minutes=entry[1])
+
+            if end <= date_time_start:
+                continue
+
+            if start >= date_time_end:
+                break
+
+            result.append({
+                'start': start,
+                'end': end
+            })
+
+        if program.manual:
+            break
+
+        current_date_time += datetime.timedelta(minutes=program.modulo)
+
+    return result
+
+
+def _old(program, start, end):
+    return {station: _old_active_intervals(program, start, end, station) for station in program.stations}
+
+
+def _new(program, start, end):
+    return program.station_intervals(start, end, program.stations)
+
+
+def _custom(program):
+    program.modulo = 3 * 1440
+    program.manual = False
+    program.schedule = [[minute, minute + 15] for minute in range(300, 3 * 1440, 720)]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    options.output_count = 64
+    today = datetime.date.today()
+    pems = [[day * 1440 + minute, priority] for day in range(7)
+            for minute, priority in zip(range(240, 1440, 180), [1, 3, 2, 2, 3, 1, 2])]
+
+    setups = [
+        (ProgramType.DAYS_SIMPLE, lambda p: p.set_days_simple(360, 20, 10, 3, range(7))),
+        (ProgramType.DAYS_ADVANCED, lambda p: p.set_days_advanced([[300, 320], [700, 730], [1200, 1210]], range(7))),
+        (ProgramType.REPEAT_SIMPLE, lambda p: p.set_repeat_simple(360, 20, 10, 3, 2, today)),
+        (ProgramType.REPEAT_ADVANCED, lambda p: p.set_repeat_advanced([[300, 320], [2000, 2030]], 3, today)),
+        (ProgramType.WEEKLY_ADVANCED,
+         lambda p: p.set_weekly_advanced([[minute, minute + 20] for minute in range(300, 7 * 1440, 1440)])),
+        (ProgramType.WEEKLY_WEATHER, lambda p: p.set_weekly_weather(5, 25, 20, 10, pems)),
+        (ProgramType.CUSTOM, _custom),
+    ]
+
+    now = datetime.datetime.now()
+    print '%-16s %6s %10s %10s %10s %8s' % ('Type', 'Window', 'Intervals', 'Old', 'New', 'Speedup')
+    for program_type, setup in setups:
+        program = programs.create_program()
+        program.stations = range(32)
+        setup(program)
+        programs.add_program(program)
+        if program_type == ProgramType.WEEKLY_WEATHER:  # The plan of each station needs its balance
+            programs.calculate_balances()
+            program.update_station_schedule()
+        assert program.type == program_type
+
+        for days in [2, 10, 30]:
+            start, end = now - datetime.timedelta(days=1), now + datetime.timedelta(days=days - 1)
+            old_result, old_time = timed(_old, program, start, end)
+            new_result, new_time = timed(_new, program, start, end)
+            assert old_result == new_result
+
+            print '%-16s %5dd %10d %9.2fms %9.2fms %7.1fx' % (
+                ProgramType.NAMES[program_type], days, sum(len(x) for x in new_result.itervalues()),
+                old_time * 1000, new_time * 1000, old_time / new_time)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Placement of the predicted schedule within max_usage for 500 stations and 50 programs (two days),
+# the old dictionary based placement compared to the usage timeline.
+# The statistics show how many keys of the timeline are visited for each query.
+
+# System imports
+import bisect
+import datetime
+import logging
+import os
+import random
+
+# Local imports
+from benchmarks import timed
+from ospy import scheduler
+from ospy.options import options
+from ospy.programs import programs
+from ospy.stations import stations
+
+
+def _old_place(usage_changes, interval, max_usage, delay_delta):
+    """The placement as it was done by predicted_schedule before the usage timeline was introduced."""
+    usage_keys = sorted(usage_changes.keys())
+    start_usage = 0
+    start_key_index = -1
+
+    for index, key in enumerate(usage_keys):
+        if key > interval['start']:
+            break
+        start_key_index = index
+        start_usage += usage_changes[key]
+
+    failed = False
+    finished = False
+    while not failed and not finished:
+        parallel_usage = 0
+        parallel_current = 0
+        for index in range(start_key_index+1, len(usage_keys)):
+            key = usage_keys[index]
+            if key >= interval['end']:
+                break
+            parallel_current += usage_changes[key]
+            parallel_usage = max(parallel_usage, parallel_current)
+
+        if start_usage + parallel_usage + interval['usage'] <= max_usage:
+
+            start = interval['start']
+            end = interval['end']
+            if start not in usage_changes:
+                usage_changes[start] = 0
+            if end not in usage_changes:
+                usage_changes[end] = 0
+
+            usage_changes[start] += interval['usage']
+            usage_changes[end] -= interval['usage']
+            finished = True
+        else:
+            while not failed:
+                # Shift this interval to next possibility
+                start_key_index += 1
+
+                # No more options
+                if start_key_index >= len(usage_keys):
+                    failed = True
+                else:
+                    next_option = usage_keys[start_key_index]
+                    next_change = usage_changes[next_option]
+                    start_usage += next_change
+
+                    # Lower usage at this starting point:
+                    if next_change < 0:
+                        skip_delay = False
+                        if options.min_runtime > 0:
+                            # Try to determine how long we have been running at this point:
+                            min_runtime_delta = datetime.timedelta(seconds=options.min_runtime)
+                            temp_usage = 0
+                            running_since = next_option
+                            not_running_since = next_option
+                            for temp_index in range(0, start_key_index):
+                                temp_usage_key = usage_keys[temp_index]
+                                if temp_usage < 0.01 and usage_changes[temp_usage_key] > 0 and \
+                                        temp_usage_key - not_running_since > datetime.timedelta(seconds=3):
+                                    running_since = temp_usage_key
+                                temp_usage += usage_changes[temp_usage_key]
+                                if temp_usage < 0.01 and usage_changes[temp_usage_key] < 0:
+                                    not_running_since = temp_usage_key
+                            if next_option - running_since < min_runtime_delta:
+                                skip_delay = True
+
+                        if skip_delay:
+                            time_to_next = next_option - interval['start']
+                        else:
+                            time_to_next = next_option + delay_delta - interval['start']
+
+                        interval['start'] += time_to_next
+                        interval['end'] += time_to_next
+                        break
+
+    return not failed
+
+
+class _CountingTimeline(scheduler._UsageTimeline):
+    """Counts the queries and the number of keys they visit."""
+
+    def __init__(self):
+        super(_CountingTimeline, self).__init__()
+        self.queries = 0
+        self.visited = 0
+
+    def last_exceeding(self, index, end, usage, max_usage):
+        result = super(_CountingTimeline, self).last_exceeding(index, end, usage, max_usage)
+        end_index = bisect.bisect_left(self.keys, end, index+1)
+        self.queries += 1
+        self.visited += end_index - (max(index, 0) if result is None else result)
+        return result
+
+    def next_start(self, index, usage, max_usage):
+        result = super(_CountingTimeline, self).next_start(index, usage, max_usage)
+        self.queries += 1
+        self.visited += (len(self.keys) if result is None else result) - index
+        return result
+
+
+def _place_all(intervals, place, usage, max_usage, delay_delta):
+    result = [interval.copy() for interval in intervals]
+    for interval in result:
+        if not place(usage, interval, max_usage, delay_delta):
+            interval['blocked'] = 'scheduler error'
+    return result
+
+
+def _old(intervals, max_usage, delay_delta):
+    return _place_all(intervals, _old_place, {}, max_usage, delay_delta)
+
+
+def _new(intervals, max_usage, delay_delta, timeline=scheduler._UsageTimeline):
+    usage = timeline()
+    return _place_all(intervals, scheduler._place_interval, usage, max_usage, delay_delta), usage
+
+
+def _setup(rnd, program_stations, repeat):
+    options.output_count = 500
+    options.max_usage = 0  # The intervals are determined without placement
+    for station in stations.get():
+        station.usage = rnd.choice([0.5, 1.0, 1.0, 2.0])
+    while programs.count():
+        programs.remove_program(programs.count() - 1)
+    for index in range(50):
+        program = programs.create_program()
+        program.stations = rnd.sample(range(500), program_stations)
+        program.set_days_simple(rnd.randint(0, 1439), rnd.randint(5, 20), 10, repeat, range(7))
+        program.fixed = True
+        programs.add_program(program)
+
+    # The intervals in the order in which they are placed:
+    now = datetime.datetime.now()
+    return scheduler.predicted_schedule(now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    configurations = [
+        # (stations per program, repeat, max_usage, station_delay, min_runtime)
+        (10, 0, 8, 0, 0),
+        (10, 0, 4, 30, 0),
+        (10, 0, 4, 30, 600),
+        (20, 1, 16, 30, 0),
+    ]
+
+    print '%-38s %9s %9s %9s %8s %9s %9s %12s' % (
+        'Configuration', 'Intervals', 'Old', 'New', 'Speedup', 'Keys', 'Queries', 'Keys/query')
+    for program_stations, repeat, max_usage, station_delay, min_runtime in configurations:
+        intervals = _setup(random.Random(1), program_stations, repeat)
+        options.station_delay = station_delay
+        options.min_runtime = min_runtime
+        delay_delta = datetime.timedelta(seconds=station_delay)
+
+        old_result, old_time = timed(_old, intervals, max_usage, delay_delta)
+        (new_result, _), new_time = timed(_new, intervals, max_usage, delay_delta)
+        assert old_result == new_result
+
+        _, counted = _new(intervals, max_usage, delay_delta, _CountingTimeline)
+        print '%-38s %9d %8.2fs %8.2fs %7.1fx %9d %9d %12.2f' % (
+            '%d/program x%d, max %g, %ds' % (program_stations, repeat + 1, max_usage, station_delay) +
+            (', min %ds' % min_runtime if min_runtime else ''),
+            len(intervals), old_time, new_time, old_time / new_time,
+            len(counted.keys), counted.queries, float(counted.visited) / counted.queries)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# Time to plan a weather based program with 64 stations,
+# with the PEMs (potential evapotranspiration moments) given for a week and used for three weeks.
+# The old planner filtered all later PEMs for every PEM, the new one follows precomputed successor links.
+
+# System imports
+import datetime
+import logging
+import os
+import random
+
+# Local imports
+from benchmarks import timed
+from ospy.options import options
+from ospy.programs import programs, _IntervalSet
+from ospy.stations import stations
+
+
+def _old_update_station_schedule(self):
+    """The weather based planner of _Program.update_station_schedule before the PEM successor links."""
+    self._schedule_bounds.clear()
+
+    now = datetime.datetime.now()
+    week_start = datetime.datetime.combine(now.date() -
+                                           datetime.timedelta(days=now.weekday()),
+                                           datetime.time.min)
+    last_start = self._start
+    self._start = week_start
+    start_difference = int(round((week_start - last_start).total_seconds() / 60))
+    irrigation_min, irrigation_max, run_max, pause_ratio, pem_mins = self.type_data
+
+    pems = [(week_start + datetime.timedelta(minutes=x), y) for x, y in pem_mins]
+    pems += [(week_start + datetime.timedelta(days=7, minutes=x), y) for x, y in pem_mins]
+    pems += [(week_start + datetime.timedelta(days=-7, minutes=x), y) for x, y in pem_mins]
+    pems = sorted(pems)
+    pems = [x for x in pems if x[0] >= now - datetime.timedelta(hours=1)]
+    pems = [x for x in pems if (x[0].date() - now.date()).days < 10]
+
+    to_sprinkle = {}
+    for station in self.stations:
+        to_sprinkle[station] = []
+        station_pems = pems[:]
+        # Make sure to keep whatever we were planning to do
+        if station in self._station_schedule:
+            for interval in self._station_schedule[station]:
+                if now - datetime.timedelta(hours=1) < last_start + datetime.timedelta(minutes=interval[1]) and last_start + datetime.timedelta(minutes=interval[0]) < now + datetime.timedelta(hours=1):
+                    to_sprinkle[station].append([interval[0] + start_difference, interval[1] + start_difference])
+                elif to_sprinkle[station] and last_start + datetime.timedelta(minutes=interval[0]) - (week_start + datetime.timedelta(minutes=to_sprinkle[station][-1][1])) < datetime.timedelta(hours=3):
+                    to_sprinkle[station].append([interval[0] + start_difference, interval[1] + start_difference])
+            if to_sprinkle[station]:
+                station_pems = [x for x in pems if x[0] > week_start + datetime.timedelta(minutes=to_sprinkle[station][-1][1])]
+
+        balance = stations.get(station).balance
+        station_balance = {
+            -1: balance[now.date() - datetime.timedelta(days=1)]['total']
+        }
+        rain = {
+            -1: balance[now.date() - datetime.timedelta(days=1)]['rain']
+        }
+        for day_index in range(0, 10):
+            overall_balance = balance[now.date() + datetime.timedelta(days=day_index)]
+            station_balance[day_index] = station_balance[day_index-1] \
+                                         - overall_balance['eto'] \
+                                         + overall_balance['rain'] \
+                                         + sum(interval['irrigation'] for interval in overall_balance['intervals'] if
+                                               interval['done'] or interval['program'] != self.index)
+            station_balance[day_index] = max(-100, min(station_balance[day_index], stations.get(station).capacity))
+            rain[day_index] = overall_balance['rain']
+
+
+        station_schedule = _IntervalSet(self.modulo, to_sprinkle[station])
+        for index, (pem, prio) in enumerate(station_pems):
+            day_index = (pem.date() - now.date()).days
+            rain_today = max(rain[max(-1, day_index-1)], rain[day_index], rain[min(day_index+1, 9)])
+
+            better_days = [x for x in station_pems[index+1:] if x[1] > prio]
+            better_or_equal_days = [x for x in station_pems[index+1:] if x[1] >= prio and x[0] > pem]
+            any_days = station_pems[index+1:]
+
+            target_index, target_index_pref = 9, 9
+            if any_days:
+                target_index = (any_days[0][0].date() - now.date()).days
+
+            if not better_days: # The best day:
+                amount = irrigation_max
+                if better_or_equal_days:
+                    target_index_pref = (better_or_equal_days[0][0].date() - now.date()).days
+            else: # A better day is possible:
+                amount = 0
+                target_index_pref = (better_days[0][0].date() - now.date()).days
+
+            # Make sure not to overflow the capacity (and aim for 0 for today):
+            later_sprinkle_max = min([-station_balance[day_index]] + [stations.get(station).capacity - station_balance[later_day_index] for later_day_index in range(day_index+1, target_index_pref)])
+
+            # Make sure we sprinkle enough not to go above the maximum in the future:
+            later_sprinkle_min = max(-station_balance[later_day_index] - irrigation_max for later_day_index in range(day_index, target_index + 1))
+            if later_sprinkle_min > 0: # We need to do something to prevent going over the maximum, so:
+                later_sprinkle_min = max(irrigation_min, later_sprinkle_min) # Make sure to sprinkle
+
+            # Try to go towards a better day:
+            later_sprinkle_min_pref = max(-station_balance[later_day_index] - irrigation_max for later_day_index in range(day_index, target_index_pref + 1))
+            if later_sprinkle_min_pref > 0: # We need to do something to prevent going over the maximum, so:
+                later_sprinkle_min_pref = max(irrigation_min, later_sprinkle_min) # Make sure to sprinkle
+
+            # Calculate the final value based on the constraints that we have:
+            # print station, pem, amount, later_sprinkle_min, later_sprinkle_min_pref, later_sprinkle_max, irrigation_max-rain_today, irrigation_max, stations.get(station).capacity, [-station_balance[day_index]] + [(stations.get(station).capacity - station_balance[later_day_index]) for later_day_index in range(day_index+1, target_index_pref)]
+            amount = min(max(later_sprinkle_min, min(max(later_sprinkle_min_pref, amount), later_sprinkle_max, irrigation_max-rain_today)), irrigation_max)
+            if amount >= irrigation_min:
+                logging.debug('Weather based schedule for %s: PEM: %s, priority: %s, amount: %f.', stations.get(station).name, str(pem), prio, amount)
+                for later_day_index in range(day_index, 10):
+                    station_balance[later_day_index] += amount
+                week_min = (pem - week_start).total_seconds() / 60
+
+                intervals = [amount]
+                while any(x > run_max for x in intervals):
+                    new_len = len(intervals) + 1
+                    intervals = [amount / new_len] * new_len
+
+                for interval in intervals:
+                    station_duration = int(round(interval*60/stations.get(station).precipitation))
+                    station_schedule.add(week_min, week_min+station_duration)
+                    week_min += station_duration + int(round(station_duration*pause_ratio))
+
+        to_sprinkle[station] = station_schedule.intervals
+        logging.debug('Weather based deficit for %s: %s', stations.get(station).name, str(sorted([((now.date() + datetime.timedelta(days=x)).isoformat(), y) for x, y in station_balance.iteritems()])))
+
+    self._station_schedule = to_sprinkle
+
+
+def _plan(program, update):
+    program._station_schedule = {}  # Do not keep the plan of the previous run
+    update(program)
+    return program._station_schedule
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    options.output_count = 64
+    rnd = random.Random(1)
+    for station in stations.get():
+        station.capacity = rnd.choice([10.0, 20.0, 40.0])
+        station.precipitation = rnd.choice([5.0, 10.0, 20.0])
+
+    print '%-9s %6s %9s %9s %11s %11s %8s' % ('PEMs/day', 'PEMs', 'Stations', 'Planned', 'Old', 'New', 'Speedup')
+    for pems_per_day in [7, 14, 24]:
+        pems = [[day * 1440 + minute, rnd.randint(1, 5)]
+                for day in range(7) for minute in sorted(rnd.sample(range(1440), pems_per_day))]
+
+        program = programs.create_program()
+        program.stations = range(64)
+        program.set_weekly_weather(5, 25, 20, 10, pems)
+        programs.add_program(program)
+        programs.calculate_balances()
+
+        old_result, old_time = timed(_plan, program, _old_update_station_schedule)
+        new_result, new_time = timed(_plan, program, lambda p: p.update_station_schedule())
+        assert old_result == new_result
+
+        print '%-9d %6d %9d %9d %10.2fms %10.2fms %7.1fx' % (
+            pems_per_day, 3 * len(pems), len(program.stations), sum(len(x) for x in new_result.itervalues()),
+            old_time * 1000, new_time * 1000, old_time / new_time)
+        programs.remove_program(program.index)
+
+    os._exit(0)  # Do not wait for the background threads
+
+
+if __name__ == '__main__':
+    main()
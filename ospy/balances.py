@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import datetime
+import logging
+import os
+import pickle
+import threading
+import traceback
+
+BALANCE_FILE = './ospy/data/balances.pkl'
+
+
+class _BalanceDay(dict):
+    """The (read-only) values of a single day, changes should be made using _StationBalance.update."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('The balance of a day is read-only, use update() instead')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class _StationBalance(object):
+    """The water balance of a single station.
+    The values are stored per column with one entry for each day starting at first_date.
+    Days without information have None as eto value."""
+
+    COLUMNS = ['eto', 'rain', 'intervals', 'total', 'valid']
+
+    def __init__(self):
+        self.first_date = None
+        self.eto = []
+        self.rain = []
+        self.intervals = []
+        self.total = []
+        self.valid = []
+        self.changed = False
+
+    def _offset(self, day):
+        return -1 if self.first_date is None else (day - self.first_date).days
+
+    def __contains__(self, day):
+        offset = self._offset(day)
+        return 0 <= offset < len(self.eto) and self.eto[offset] is not None
+
+    def __getitem__(self, day):
+        if day not in self:
+            raise KeyError(day)
+        offset = self._offset(day)
+        values = {column: getattr(self, column)[offset] for column in self.COLUMNS}
+        if values['intervals'] is not None:
+            values['intervals'] = tuple(values['intervals'])
+        return _BalanceDay(values)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [self.first_date + datetime.timedelta(days=offset)
+                for offset, eto in enumerate(self.eto) if eto is not None]
+
+    def values(self):
+        return [self[day] for day in self.keys()]
+
+    def iteritems(self):
+        for day in self.keys():
+            yield day, self[day]
+
+    def update(self, day, **values):
+        """Updates the given columns of a single day, adding the day if needed."""
+        if self.first_date is None:
+            self.first_date = day
+
+        offset = self._offset(day)
+        if offset < 0:
+            for column in self.COLUMNS:
+                setattr(self, column, [None] * -offset + getattr(self, column))
+            self.first_date = day
+            offset = 0
+        while offset >= len(self.eto):
+            for column in self.COLUMNS:
+                getattr(self, column).append(None)
+
+        for column, value in values.iteritems():
+            if getattr(self, column)[offset] != value:
+                getattr(self, column)[offset] = value
+                self.changed = True
+
+    def prune(self, first_date):
+        """Removes all days before the given date."""
+        offset = self._offset(first_date)
+        if offset > 0:
+            for column in self.COLUMNS:
+                setattr(self, column, getattr(self, column)[offset:])
+            self.first_date = first_date
+            self.changed = True
+
+
+class _Balances(object):
+    """Keeps the water balance of all stations, it is saved separately from the options."""
+
+    def __init__(self):
+        self._balances = {}
+        self._lock = threading.Lock()
+
+        try:
+            if not os.path.isfile(BALANCE_FILE) and os.path.isfile(BALANCE_FILE + '.tmp'):
+                os.rename(BALANCE_FILE + '.tmp', BALANCE_FILE)  # Saving was interrupted
+            if os.path.isfile(BALANCE_FILE):
+                with open(BALANCE_FILE, 'rb') as fh:
+                    for station, columns in pickle.load(fh).iteritems():
+                        self._balances[station] = _StationBalance()
+                        self._balances[station].__dict__.update(columns)
+        except Exception:
+            logging.warning('Could not load water balances:\n' + traceback.format_exc())
+
+    def get(self, station):
+        with self._lock:
+            if station not in self._balances:
+                self._balances[station] = _StationBalance()
+            return self._balances[station]
+
+    def available(self, station):
+        return station in self._balances and len(self._balances[station]) > 0
+
+    def save(self):
+        """Saves the balances to disk if anything has changed."""
+        with self._lock:
+            if not any(balance.changed for balance in self._balances.values()):
+                return
+
+            for balance in self._balances.values():
+                balance.changed = False
+            data = {station: {key: value for key, value in balance.__dict__.iteritems() if key != 'changed'}
+                    for station, balance in self._balances.iteritems()}
+
+            with open(BALANCE_FILE + '.tmp', 'wb') as fh:
+                pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+            if os.path.isfile(BALANCE_FILE):
+                os.remove(BALANCE_FILE)
+            os.rename(BALANCE_FILE + '.tmp', BALANCE_FILE)
+
+balances = _Balances()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+
+class Interval(object):
+    """A scheduled or logged run of a station.
+    The values are stored in slots, but can also be used like a dictionary (as plugins and templates do).
+    Keys without a value are not present, unknown keys (of plugins or older logs) are kept separately."""
+
+    KEYS = ('station', 'program', 'program_name', 'fixed', 'cut_off', 'manual', 'blocked', 'active',
+            'start', 'original_start', 'end', 'adjustment', 'uid', 'usage')
+    _KEY_SET = frozenset(KEYS)
+
+    __slots__ = KEYS + ('_extra',)
+
+    def __init__(self, values=None, **kwargs):
+        if values is not None:
+            self.update(values)
+        if kwargs:
+            self.update(kwargs)
+
+    def __getitem__(self, key):
+        try:
+            if key in self._KEY_SET:
+                return getattr(self, key)
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._KEY_SET:
+            setattr(self, key, value)
+        else:
+            try:
+                self._extra[key] = value
+            except AttributeError:
+                self._extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self._KEY_SET:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        result = [key for key in self.KEYS if hasattr(self, key)]
+        if hasattr(self, '_extra'):
+            result += self._extra.keys()
+        return result
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def update(self, values=None, **kwargs):
+        if values is not None:
+            for key, value in (values.iteritems() if hasattr(values, 'iteritems') else values):
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def copy(self):
+        result = Interval.__new__(Interval)
+        for key in self.KEYS:
+            if hasattr(self, key):
+                setattr(result, key, getattr(self, key))
+        if hasattr(self, '_extra'):
+            result._extra = self._extra.copy()
+        return result
+
+    def __eq__(self, other):
+        if not isinstance(other, (Interval, dict)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Interval(%r)' % dict(self.iteritems())
+
+    def __getstate__(self):
+        return dict(self.iteritems())
+
+    def __setstate__(self, state):
+        self.update(state)
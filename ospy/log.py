@@ -5,8 +5,11 @@ from __future__ import print_function
 __author__ = 'Rimco'
 
 # System imports
+import bisect
 import datetime
 import logging
+import os
+import pickle
 import traceback
 from os import path
 import threading
@@ -14,22 +17,115 @@ import time
 import sys
 
 # Local imports
+from ospy.intervals import Interval
 from ospy.options import options
+from ospy.options import schedule_changes
 
 EVENT_FILE = './ospy/data/events.log'
+RUN_FILE = './ospy/data/runs.journal'
 EVENT_FORMAT = "%(asctime)s [%(levelname)s %(event_type)s] %(filename)s:%(lineno)d: %(message)s"
 RUN_START_FORMAT = "%(asctime)s [START  Run] Program %(program)d - Station %(station)d: From %(start)s to %(end)s"
 RUN_FINISH_FORMAT = "%(asctime)s [FINISH Run] Program %(program)d - Station %(station)d: From %(start)s to %(end)s"
 
 
+class _RunJournal(object):
+    """Append-only file with all changes to the run log.
+    Every change is a separately pickled record, so saving a change does not rewrite the whole log.
+    The journal is compacted (rewritten with only the current runs) when it contains too many obsolete records."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self.records = 0
+
+    def load(self):
+        """Replays the journal. Returns the list of runs and whether the journal was damaged.
+        Returns None instead of the list of runs if there is no journal."""
+        if not os.path.isfile(self._filename) and os.path.isfile(self._filename + '.tmp'):
+            os.rename(self._filename + '.tmp', self._filename)  # Compaction was interrupted
+        if not os.path.isfile(self._filename):
+            return None, False
+
+        runs = []
+        by_uid = {}
+        deleted = set()
+        damaged = False
+        self.records = 0
+        with open(self._filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            while True:
+                offset = fh.tell()
+                try:
+                    record = pickle.load(fh)
+                except EOFError:
+                    damaged = offset != size  # Only a clean end if no partial record follows
+                    break
+                except Exception:
+                    damaged = True  # Probably an incomplete write, ignore the rest
+                    break
+
+                self.records += 1
+                if record[0] == 'add':
+                    run = record[1]
+                    runs.append(run)
+                    by_uid[(run['data']['uid'], run['data']['start'])] = run
+                elif record[0] == 'finish':
+                    run = by_uid.get((record[1], record[2]))
+                    if run is not None:
+                        run['data']['end'] = record[3]
+                        run['data']['active'] = False
+                elif record[0] == 'delete':
+                    run = by_uid.pop((record[1], record[2]), None)
+                    if run is not None:
+                        deleted.add(id(run))
+
+        return [run for run in runs if id(run) not in deleted], damaged
+
+    def append(self, record):
+        with open(self._filename, 'ab') as fh:
+            pickle.dump(record, fh, pickle.HIGHEST_PROTOCOL)
+        self.records += 1
+
+    def compact(self, runs):
+        """Rewrites the journal to contain only the given runs."""
+        with open(self._filename + '.tmp', 'wb') as fh:
+            for run in runs:
+                pickle.dump(('add', run), fh, pickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(self._filename):
+            os.remove(self._filename)
+        os.rename(self._filename + '.tmp', self._filename)
+        self.records = len(runs)
+
+
 class _Log(logging.Handler):
     def __init__(self):
         super(_Log, self).__init__()
+        self._run_journal = _RunJournal(RUN_FILE)
+        runs, damaged = self._run_journal.load()
+        if runs is None:
+            # No journal available yet, take the runs that were stored in the options:
+            runs = options.logged_runs[:]
+            damaged = True
+        if options.logged_runs:
+            options.logged_runs = []
+        for run in runs:
+            if not isinstance(run['data'], Interval):
+                run['data'] = Interval(run['data'])
+        if damaged:
+            self._run_journal.compact(runs)
+
         self._log = {
-            'Run': options.logged_runs[:]
+            'Run': sorted(runs, key=lambda run: run['data']['start'])
         }
         self._lock = threading.RLock()
         self._plugin_time = time.time() + 3
+        self._journal_synced = True
+
+        # Indices on the run log, see _index_runs:
+        self._run_starts = []
+        self._active_runs = []
+        self._active_stations = {}
+        self._finished_duration = datetime.timedelta()
+        self._index_runs()
 
     @property
     def level(self):
@@ -41,10 +137,18 @@ class _Log(logging.Handler):
 
     def _save_logs(self):
         from ospy.programs import programs, ProgramType
-        result = []
         if options.run_log or any(program.type == ProgramType.WEEKLY_WEATHER for program in programs.get()):
-            result = self._log['Run']
-        options.logged_runs = result
+            # Rewrite the journal if it was not kept up to date or if it contains too many obsolete records:
+            if not self._journal_synced or self._run_journal.records > 2 * len(self._log['Run']) + 100:
+                self._run_journal.compact(self._log['Run'])
+                self._journal_synced = True
+        elif self._journal_synced:
+            self._run_journal.compact([])
+            self._journal_synced = False
+
+    def _journal(self, *record):
+        if self._journal_synced:
+            self._run_journal.append(record)
 
     @staticmethod
     def _save_log(msg, level, event_type):
@@ -63,6 +167,19 @@ class _Log(logging.Handler):
             with open(EVENT_FILE, 'a') as fh:
                 fh.write(msg + '\n')
 
+    def _index_runs(self):
+        """Rebuilds the indices on the run log, which is kept sorted on start time.
+        Keeps the start times for bisection, the active runs (in log order and per station)
+        and the maximum duration of the finished runs to be able to find all runs overlapping a period."""
+        runs = self._log['Run']
+        self._run_starts = [run['data']['start'] for run in runs]
+        self._active_runs = [run for run in runs if run['data']['active']]
+        self._active_stations = {}
+        for run in self._active_runs:
+            self._active_stations.setdefault(run['data']['station'], []).append(run)
+        self._finished_duration = max([datetime.timedelta()] + [run['data']['end'] - run['data']['start']
+                                                                for run in runs if not run['data']['active']])
+
     def _prune(self, event_type):
         if event_type not in self._log:
             return  # We cannot prune
@@ -80,23 +197,30 @@ class _Log(logging.Handler):
         """Indicates a certain run has been started. The start time will be updated."""
         with self._lock:
             # Update time with current time
-            interval = interval.copy()
+            interval = Interval(interval)
             interval['start'] = datetime.datetime.now()
             interval['active'] = True
 
-            self._log['Run'].append({
+            run = {
                 'time': datetime.datetime.now(),
                 'level': logging.INFO,
                 'data': interval
-            })
-
-            fmt_dict = interval.copy()
+            }
+            index = bisect.bisect_right(self._run_starts, interval['start'])
+            self._log['Run'].insert(index, run)
+            self._run_starts.insert(index, interval['start'])
+            self._active_runs.append(run)
+            self._active_stations.setdefault(interval['station'], []).append(run)
+            self._journal('add', run)
+
+            fmt_dict = dict(interval)
             fmt_dict['asctime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
             fmt_dict['start'] = fmt_dict['start'].strftime("%Y-%m-%d %H:%M:%S")
             fmt_dict['end'] = fmt_dict['end'].strftime("%Y-%m-%d %H:%M:%S")
 
             self._save_log(RUN_START_FORMAT % fmt_dict, logging.DEBUG, 'Run')
             self._prune('Run')
+            schedule_changes.notify()
 
     def finish_run(self, interval):
         """Indicates a certain run has been stopped. Use interval=None to stop all active runs.
@@ -104,17 +228,25 @@ class _Log(logging.Handler):
         with self._lock:
             if isinstance(interval, str) or interval is None:
                 uid = interval
-            elif isinstance(interval, dict) and 'uid' in interval:
+            elif isinstance(interval, (dict, Interval)) and 'uid' in interval:
                 uid = interval['uid']
             else:
                 raise ValueError
 
-            for entry in self._log['Run']:
-                if (uid is None or entry['data']['uid'] == uid) and entry['data']['active']:
+            finished = False
+            for entry in self._active_runs[:]:
+                if uid is None or entry['data']['uid'] == uid:
                     entry['data']['end'] = datetime.datetime.now()
                     entry['data']['active'] = False
+                    finished = True
 
-                    fmt_dict = entry['data'].copy()
+                    self._active_runs.remove(entry)
+                    self._active_stations[entry['data']['station']].remove(entry)
+                    self._finished_duration = max(self._finished_duration,
+                                                  entry['data']['end'] - entry['data']['start'])
+                    self._journal('finish', entry['data']['uid'], entry['data']['start'], entry['data']['end'])
+
+                    fmt_dict = dict(entry['data'])
                     fmt_dict['asctime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
                     fmt_dict['start'] = fmt_dict['start'].strftime("%Y-%m-%d %H:%M:%S")
                     fmt_dict['end'] = fmt_dict['end'].strftime("%Y-%m-%d %H:%M:%S")
@@ -124,13 +256,34 @@ class _Log(logging.Handler):
                         break
 
             self._prune('Run')
+            if finished:
+                schedule_changes.notify()
 
-    def active_runs(self):
-        return [run['data'].copy() for run in self._log['Run'] if run['data']['active']]
+    def active_runs(self, station=None):
+        with self._lock:
+            runs = self._active_runs if station is None else self._active_stations.get(station, [])
+            return [run['data'].copy() for run in runs]
 
     def finished_runs(self):
         return [run['data'].copy() for run in self._log['Run'] if not run['data']['active']]
 
+    def runs_between(self, start_time, end_time, station=None):
+        """Returns the (finished and active) runs overlapping the given period sorted on start time.
+        Optionally only returns the runs of the given station."""
+        with self._lock:
+            # Finished runs ending after start_time cannot have started before this:
+            first_start = start_time - self._finished_duration
+            first = bisect.bisect_left(self._run_starts, first_start)
+            last = bisect.bisect_right(self._run_starts, end_time)
+
+            # Active runs can have (planned) ends far in the future, so these are checked separately:
+            runs = [run for run in self._active_runs if run['data']['start'] < first_start]
+            runs += self._log['Run'][first:last]
+
+            return [run['data'].copy() for run in runs
+                    if run['data']['end'] >= start_time and run['data']['start'] <= end_time and
+                    (station is None or run['data']['station'] == station)]
+
     def log_event(self, event_type, message, level=logging.INFO, format_msg=True):
         if threading.current_thread().__class__.__name__ != '_MainThread' and time.time() < self._plugin_time:
             time.sleep(self._plugin_time - time.time())
@@ -199,6 +352,7 @@ class _Log(logging.Handler):
                     min_eto = min(min_eto, min([datetime.date.today() - datetime.timedelta(days=7)] + stations.get(station).balance.keys()))
 
         # Now try to remove as much as we can
+        deleted = False
         for index in reversed(xrange(len(self._log['Run']) - minimum)):
             interval = self._log['Run'][index]['data']
 
@@ -212,8 +366,13 @@ class _Log(logging.Handler):
                 delete = False
 
             if delete:
+                self._journal('delete', interval['uid'], interval['start'])
                 del self._log['Run'][index]
+                deleted = True
 
+        if deleted:
+            self._index_runs()
+            schedule_changes.notify()
         self._save_logs()
 
     def clear(self, event_type):
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import sqlite3
+import threading
+import time
+
+OBSERVATION_FILE = './ospy/data/weather.db'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    location TEXT NOT NULL,
+    name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    error TEXT,
+    body TEXT NOT NULL,
+    etag TEXT,
+    modified TEXT,
+    UNIQUE (location, name)
+);
+CREATE INDEX IF NOT EXISTS documents_day ON documents (day);
+
+CREATE TABLE IF NOT EXISTS hourly (
+    document INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    condition,
+    wind,
+    temp,
+    humidity
+);
+CREATE INDEX IF NOT EXISTS hourly_time ON hourly (document, time);
+
+CREATE TABLE IF NOT EXISTS daily (
+    document INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    mean_wind,
+    mean_pressure,
+    mean_temp,
+    min_temp,
+    max_temp,
+    max_humidity,
+    min_humidity,
+    rain
+);
+CREATE INDEX IF NOT EXISTS daily_day ON daily (document, day);
+'''
+
+HOURLY_COLUMNS = ['time', 'condition', 'wind', 'temp', 'humidity']
+DAILY_COLUMNS = ['day', 'mean_wind', 'mean_pressure', 'mean_temp', 'min_temp', 'max_temp',
+                 'max_humidity', 'min_humidity', 'rain']
+
+
+class _Observations(object):
+    """Keeps the downloaded weather documents of each location in a SQLite database.
+    The hourly and daily values of the documents are stored in separate tables, so they can be
+    looked up without loading the whole document. The values are stored as found in the document."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(OBSERVATION_FILE, check_same_thread=False)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(_SCHEMA)
+
+        # Add the validator columns to older databases:
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(documents)')]
+        with self._db:
+            for column in ['etag', 'modified']:
+                if column not in columns:
+                    self._db.execute('ALTER TABLE documents ADD COLUMN %s TEXT' % column)
+
+    def _document_id(self, location, name):
+        row = self._db.execute('SELECT id FROM documents WHERE location = ? AND name = ?',
+                               (location, name)).fetchone()
+        return None if row is None else row[0]
+
+    def info(self, location, name):
+        """Returns the time the document was fetched and its error (if any), or None if it is not available."""
+        with self._lock:
+            return self._db.execute('SELECT fetched, error FROM documents WHERE location = ? AND name = ?',
+                                    (location, name)).fetchone()
+
+    def validators(self, location, name):
+        """Returns the ETag and Last-Modified values of the document, or (None, None)."""
+        with self._lock:
+            row = self._db.execute('SELECT etag, modified FROM documents WHERE location = ? AND name = ?',
+                                   (location, name)).fetchone()
+            return (None, None) if row is None else row
+
+    def touch(self, location, name):
+        """Marks the document as fetched just now (it did not change)."""
+        with self._lock, self._db:
+            self._db.execute('UPDATE documents SET fetched = ? WHERE location = ? AND name = ?',
+                             (time.time(), location, name))
+
+    def body(self, location, name):
+        with self._lock:
+            row = self._db.execute('SELECT body FROM documents WHERE location = ? AND name = ?',
+                                   (location, name)).fetchone()
+            if row is None:
+                raise KeyError((location, name))
+            return row[0]
+
+    def add(self, location, name, day, body, error=None, hourly=(), daily=(), fetched=None, etag=None, modified=None):
+        """Stores (or replaces) a document together with its hourly and daily values.
+        The values are given as tuples in the order of HOURLY_COLUMNS and DAILY_COLUMNS."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM documents WHERE location = ? AND name = ?', (location, name))
+            document = self._db.execute(
+                'INSERT INTO documents (location, name, day, fetched, error, body, etag, modified) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (location, name, day.isoformat(), time.time() if fetched is None else fetched, error, body,
+                 etag, modified)
+            ).lastrowid
+            self._db.executemany(
+                'INSERT INTO hourly (document, seq, %s) VALUES (?, ?%s)' % (
+                    ', '.join(HOURLY_COLUMNS), ', ?' * len(HOURLY_COLUMNS)),
+                [(document, seq) + tuple(values) for seq, values in enumerate(hourly)])
+            self._db.executemany(
+                'INSERT INTO daily (document, seq, %s) VALUES (?, ?%s)' % (
+                    ', '.join(DAILY_COLUMNS), ', ?' * len(DAILY_COLUMNS)),
+                [(document, seq, values[0].isoformat()) + tuple(values[1:]) for seq, values in enumerate(daily)])
+
+    def remove(self, location, name):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM documents WHERE location = ? AND name = ?', (location, name))
+
+    def hourly(self, location, name, start=None, end=None):
+        """Returns the hourly values (as dictionaries) of a document in their original order.
+        Only values with start <= time < end are returned (if given), time is a UTC timestamp."""
+        with self._lock:
+            query = 'SELECT %s FROM hourly WHERE document = ?' % ', '.join(HOURLY_COLUMNS)
+            args = [self._document_id(location, name)]
+            if start is not None:
+                query += ' AND time >= ?'
+                args.append(start)
+            if end is not None:
+                query += ' AND time < ?'
+                args.append(end)
+            return [dict(zip(HOURLY_COLUMNS, row)) for row in self._db.execute(query + ' ORDER BY seq', args)]
+
+    def daily(self, location, name, day=None):
+        """Returns the daily values (as dictionaries) of a document in their original order."""
+        with self._lock:
+            query = 'SELECT %s FROM daily WHERE document = ?' % ', '.join(DAILY_COLUMNS)
+            args = [self._document_id(location, name)]
+            if day is not None:
+                query += ' AND day = ?'
+                args.append(day.isoformat())
+            return [dict(zip(DAILY_COLUMNS, row)) for row in self._db.execute(query + ' ORDER BY seq', args)]
+
+    def prune(self, first_day):
+        """Removes all documents (and their values) of days before the given date."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM documents WHERE day < ?', (first_day.isoformat(),))
+
+observations = _Observations()
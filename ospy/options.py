@@ -3,9 +3,11 @@
 __author__ = 'Rimco'
 
 # System imports
+from contextlib import contextmanager
 from datetime import datetime
-from threading import Timer
+from threading import Timer, Condition, Lock
 import logging
+import pickle
 import shelve
 
 import helpers
@@ -14,6 +16,9 @@ import os
 import time
 
 OPTIONS_FILE = './ospy/data/options.db'
+JOURNAL_FILE = OPTIONS_FILE + '.journal'
+JOURNAL_MAX_SIZE = 1024 * 1024  # Write a new checkpoint when the journal gets larger than this
+CHECKPOINT_KEY = '__checkpoint__'
 
 
 class _Options(object):
@@ -200,7 +205,7 @@ class _Options(object):
             "help": "Number of run entries to save to disk, 0=no limit.",
             "category": "Logging",
             "min": 0,
-            "max": 1000
+            "max": 10000
         },
         {
             "key": "debug_log",
@@ -254,14 +259,19 @@ class _Options(object):
             "name": "Current password decryption time",
             "default": 0,
         },
+        {
+            "key": "weather_memory",
+            "name": "Memory for parsed weather information (kB)",
+            "default": 2048,
+        },
         {
             "key": "logged_runs",
-            "name": "The runs that have been logged",
+            "name": "The runs that have been logged (moved to the run journal)",
             "default": []
         },
         {
             "key": "weather_cache",
-            "name": "ETo and rain value cache",
+            "name": "ETo and rain value cache (moved to the weather result store)",
             "default": {}
         }
     ]
@@ -271,6 +281,10 @@ class _Options(object):
         self._write_timer = None
         self._callbacks = {}
         self._block = []
+        self._lock = Lock()
+        self._dirty = set()
+        self._checkpoint = 0
+        self._batches = {}
 
         for info in self.OPTIONS:
             self._values[info["key"]] = info["default"]
@@ -287,6 +301,9 @@ class _Options(object):
             except Exception:
                 pass
 
+        self._checkpoint = self._values.pop(CHECKPOINT_KEY, 0)
+        self._journal_valid = self._replay_journal()
+
         if not self.password_salt:  # Password is not hashed yet
             from ospy.helpers import password_salt
             from ospy.helpers import password_hash
@@ -330,28 +347,35 @@ class _Options(object):
         if key.startswith('_'):
             super(_Options, self).__setattr__(key, value)
         else:
-            self._values[key] = value
+            with self._lock:
+                self._values[key] = value
+                self._dirty.add(key)
+            self._changed(key, value)
 
-            if key in self._callbacks:
-                if value != self._callbacks[key]['last_value']:
-                    for cb in self._callbacks[key]['functions']:
-                        try:
-                            cb(key, self._callbacks[key]['last_value'], value)
-                        except Exception:
-                            logging.error('Callback failed:\n' + traceback.format_exc())
-                    self._callbacks[key]['last_value'] = value
-
-            # Only write after 1 second without any more changes
-            if self._write_timer is not None:
-                self._write_timer.cancel()
-            self._write_timer = Timer(1.0, self._write)
-            self._write_timer.start()
+    def _changed(self, key, value):
+        """Calls the callbacks of the changed key and schedules writing the changes."""
+        if key in self._callbacks:
+            if value != self._callbacks[key]['last_value']:
+                for cb in self._callbacks[key]['functions']:
+                    try:
+                        cb(key, self._callbacks[key]['last_value'], value)
+                    except Exception:
+                        logging.error('Callback failed:\n' + traceback.format_exc())
+                self._callbacks[key]['last_value'] = value
+
+        # Only write after 1 second without any more changes
+        if self._write_timer is not None:
+            self._write_timer.cancel()
+        self._write_timer = Timer(1.0, self._write)
+        self._write_timer.start()
 
     def __delattr__(self, item):
         if item.startswith('_'):
             super(_Options, self).__delattr__(item)
         else:
-            del self._values[item]
+            with self._lock:
+                del self._values[item]
+                self._dirty.add(item)
 
             # Only write after 1 second without any more changes
             if self._write_timer is not None:
@@ -371,11 +395,64 @@ class _Options(object):
     def __contains__(self, item):
         return item in self._values
 
+    def _replay_journal(self):
+        """Applies the changes that were saved in the journal after the loaded checkpoint.
+        An incomplete last commit is removed from the journal.
+        Returns False if new commits cannot be appended to the journal (a checkpoint is needed first)."""
+        try:
+            fh = open(JOURNAL_FILE, 'r+b')
+        except IOError:
+            return False  # No journal at all
+
+        with fh:
+            try:
+                if pickle.load(fh) != self._checkpoint:
+                    return False  # The journal belongs to another checkpoint
+            except Exception:
+                return False
+
+            size = os.fstat(fh.fileno()).st_size
+            end = fh.tell()
+            while end < size:
+                try:
+                    updates, deletes = pickle.load(fh)
+                except Exception:
+                    break  # An incomplete last commit
+                self._values.update(updates)
+                for key in deletes:
+                    self._values.pop(key, None)
+                end = fh.tell()
+
+            if end < size:
+                fh.truncate(end)
+        return True
+
     def _write(self):
-        """This function saves the current data to disk. Use a timer to limit the call rate."""
+        """This function saves the changed data to disk. Use a timer to limit the call rate.
+        Changes are appended to the journal, all data is only written if the journal gets too large.
+        Only the values of keys that have been set (or deleted) are journaled, a value that is changed in place
+        (like a list or dict) should be set again to be saved: options.enabled_plugins = options.enabled_plugins"""
+        with self._lock:
+            if not self._journal_valid or not os.path.isfile(JOURNAL_FILE) or \
+                    os.path.getsize(JOURNAL_FILE) > JOURNAL_MAX_SIZE:
+                self._write_checkpoint()
+                self._journal_valid = True
+            else:
+                updates = {key: self._values[key] for key in self._dirty if key in self._values}
+                deletes = [key for key in self._dirty if key not in self._values]
+                # Write each commit at once, an incomplete commit will be ignored when loading:
+                data = pickle.dumps((updates, deletes), pickle.HIGHEST_PROTOCOL)
+                with open(JOURNAL_FILE, 'ab') as fh:
+                    fh.write(data)
+            self._dirty = set()
+
+    def _write_checkpoint(self):
+        """Saves all data to disk and starts a new journal."""
+        self._checkpoint += 1
         db = shelve.open(OPTIONS_FILE + '.tmp')
         db.clear()
         db.update(self._values)
+        db[CHECKPOINT_KEY] = self._checkpoint
         db.close()
 
         if os.path.isfile(OPTIONS_FILE + '.bak') and time.time() - os.path.getmtime(OPTIONS_FILE + '.bak') > 3600\
@@ -391,6 +468,9 @@ class _Options(object):
 
         os.rename(OPTIONS_FILE + '.tmp', OPTIONS_FILE)
 
+        with open(JOURNAL_FILE, 'wb') as fh:
+            pickle.dump(self._checkpoint, fh, pickle.HIGHEST_PROTOCOL)
+
     def get_categories(self):
         result = []
         for info in self.OPTIONS:
@@ -427,9 +507,35 @@ class _Options(object):
             pass
         self._block.remove(cls)
 
-    def save(self, obj, key=""):
+    def save(self, obj, key="", attributes=None):
+        """Saves the public attributes of obj.
+        If a list of attributes is given, only these are updated in the saved values (if available)."""
         cls = self.cls_name(obj, key)
         if cls not in self._block:
+            if id(obj) in self._batches:
+                saves = self._batches[id(obj)]['saves']
+                if cls not in saves:
+                    saves[cls] = (key, None if attributes is None else set(attributes))
+                elif attributes is None:
+                    saves[cls] = (key, None)
+                elif saves[cls][1] is not None:
+                    saves[cls][1].update(attributes)
+                return
+
+            if attributes is not None:
+                changes = {attr: getattr(obj, attr) for attr in attributes}
+                # Patch the stored values at once, so concurrent saves of the same object do not get lost:
+                with self._lock:
+                    values = self._values.get(cls)
+                    if values is not None:
+                        values = dict(values)
+                        values.update(changes)
+                        self._values[cls] = values
+                        self._dirty.add(cls)
+                if values is not None:
+                    self._changed(cls, values)
+                    return
+
             values = {}
             exclude = obj.SAVE_EXCLUDE if hasattr(obj, 'SAVE_EXCLUDE') else []
             for attr in [att for att in dir(obj) if not att.startswith('_') and att not in exclude]:
@@ -438,6 +544,20 @@ class _Options(object):
 
             setattr(self, cls, values)
 
+    @contextmanager
+    def batch(self, obj):
+        """Postpones saving obj until the end of the block, so multiple changes are saved at once."""
+        batch = self._batches.setdefault(id(obj), {'depth': 0, 'saves': {}})
+        batch['depth'] += 1
+        try:
+            yield
+        finally:
+            batch['depth'] -= 1
+            if batch['depth'] == 0:
+                del self._batches[id(obj)]
+                for key, attributes in batch['saves'].itervalues():
+                    self.save(obj, key, attributes)
+
     def erase(self, obj, key=""):
         cls = self.cls_name(obj, key)
         if hasattr(self, cls):
@@ -450,10 +570,43 @@ class _Options(object):
 options = _Options()
 
 
+class _ScheduleChanges(object):
+    """Counts the changes to anything that influences the schedule.
+    Users of the schedule can compare the generation to determine if they should recalculate."""
+
+    def __init__(self):
+        self._condition = Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout=None):
+        """Waits until the generation differs from the given one or the timeout expires.
+        Returns True if the generation has changed."""
+        with self._condition:
+            if self.generation == generation:
+                self._condition.wait(timeout)
+            return self.generation != generation
+
+schedule_changes = _ScheduleChanges()
+
+
 class _LevelAdjustments(dict):
     def __init__(self):
         super(_LevelAdjustments, self).__init__()
 
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            super(_LevelAdjustments, self).__setitem__(key, value)
+            schedule_changes.notify()
+
+    def __delitem__(self, key):
+        super(_LevelAdjustments, self).__delitem__(key)
+        schedule_changes.notify()
+
     def total_adjustment(self):
         return max(0.0, min(5.0, reduce(lambda x, y: x * y, self.values(), options.level_adjustment)))
 
@@ -464,6 +617,15 @@ class _RainBlocks(dict):
     def __init__(self):
         super(_RainBlocks, self).__init__()
 
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            super(_RainBlocks, self).__setitem__(key, value)
+            schedule_changes.notify()
+
+    def __delitem__(self, key):
+        super(_RainBlocks, self).__delitem__(key)
+        schedule_changes.notify()
+
     def block_end(self):
         return max(self.values() + [options.rain_block])
 
@@ -3,6 +3,7 @@
 __author__ = 'Rimco'
 
 # System imports
+import bisect
 import datetime
 import logging
 import traceback
@@ -10,11 +11,38 @@ import math
 
 # Local imports
 from ospy.helpers import minute_time_str, short_day
+from ospy.balances import balances
 from ospy.options import options
+from ospy.options import schedule_changes
 from ospy.weather import weather
 from ospy.stations import stations
 from ospy.log import log
 
+_MINUTE = 60 * 1000000  # In microseconds
+
+
+def _microseconds(time_delta):
+    return (time_delta.days * 24 * 3600 + time_delta.seconds) * 1000000 + time_delta.microseconds
+
+
+def _pem_successors(pems):
+    """Returns for each PEM the index of the next PEM with a higher priority and
+    the index of the first PEM at a later time. The PEMs should be sorted, len(pems) means none."""
+    count = len(pems)
+    next_better = [count] * count
+    next_later = [count] * count
+    stack = []
+    for index in reversed(xrange(count)):
+        while stack and pems[stack[-1]][1] <= pems[index][1]:
+            stack.pop()
+        if stack:
+            next_better[index] = stack[-1]
+        stack.append(index)
+
+        if index + 1 < count:
+            next_later[index] = index + 1 if pems[index + 1][0] > pems[index][0] else next_later[index + 1]
+    return next_better, next_later
+
 
 class ProgramType(object):
     DAYS_SIMPLE = 0
@@ -38,12 +66,54 @@ class ProgramType(object):
 ProgramType.NAMES = {getattr(ProgramType, x): x for x in dir(ProgramType) if not x.startswith('_') and
                                                                              isinstance(getattr(ProgramType, x), int)}
 
+class _IntervalSet(object):
+    """A sorted list of non-overlapping [start, end] intervals in minutes within a period of modulo minutes.
+    Added intervals only fill the gaps between the intervals that are already present."""
+
+    def __init__(self, modulo, intervals=None):
+        self.modulo = modulo
+        self.intervals = [interval[:] for interval in intervals] if intervals else []
+        self._starts = [interval[0] for interval in self.intervals]
+
+    def add(self, start_minute, end_minute):
+        start_minute %= self.modulo
+        end_minute %= self.modulo
+
+        if end_minute < start_minute:
+            end_minute += self.modulo
+
+        if end_minute > self.modulo:  # Wrap around
+            self._fill(0, end_minute % self.modulo)
+            self._fill(start_minute, self.modulo)
+        else:
+            self._fill(start_minute, end_minute)
+
+    def _fill(self, start, end):
+        index = bisect.bisect_right(self._starts, start)
+        if index > 0:
+            start = max(start, self.intervals[index-1][1])
+
+        while start < end:
+            gap_end = min(end, self._starts[index]) if index < len(self._starts) else end
+            if start < gap_end:
+                self.intervals.insert(index, [start, gap_end])
+                self._starts.insert(index, start)
+                index += 1
+
+            if gap_end >= end:
+                break
+
+            start = max(start, self.intervals[index][1])
+            index += 1
+
+
 class _Program(object):
-    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', '_programs', '_loading']
+    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', '_programs', '_loading', '_index']
 
     def __init__(self, programs_instance, index):
         self._programs = programs_instance
         self._loading = True
+        self._index = -1  # Maintained by _Programs
 
         self.name = "Program %02d" % (index+1 if index >= 0 else abs(index))
         self._stations = []
@@ -54,6 +124,7 @@ class _Program(object):
 
         self._schedule = []
         self._station_schedule = {}
+        self._schedule_bounds = {}  # Sorted start and end minutes per schedule, see _bounds
         self._modulo = 24*60
         self._manual = False  # Non-repetitive (run-once) if True
         self._start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
@@ -66,10 +137,7 @@ class _Program(object):
 
     @property
     def index(self):
-        try:
-            return self._programs.get().index(self)
-        except ValueError:
-            return -1
+        return self._index
 
     @property
     def stations(self):
@@ -81,6 +149,7 @@ class _Program(object):
         self.update_station_schedule()
 
     def update_station_schedule(self):
+        self._schedule_bounds.clear()
 
         if self.type != ProgramType.WEEKLY_WEATHER:
             self._station_schedule = {}
@@ -118,45 +187,56 @@ class _Program(object):
                         if to_sprinkle[station]:
                             station_pems = [x for x in pems if x[0] > week_start + datetime.timedelta(minutes=to_sprinkle[station][-1][1])]
 
+                    station_info = stations.get(station)
+                    balance = station_info.balance
                     station_balance = {
-                        -1: stations.get(station).balance[now.date() - datetime.timedelta(days=1)]['total']
+                        -1: balance[now.date() - datetime.timedelta(days=1)]['total']
                     }
                     rain = {
-                        -1: stations.get(station).balance[now.date() - datetime.timedelta(days=1)]['rain']
+                        -1: balance[now.date() - datetime.timedelta(days=1)]['rain']
                     }
                     for day_index in range(0, 10):
-                        overall_balance = stations.get(station).balance[now.date() + datetime.timedelta(days=day_index)]
+                        overall_balance = balance[now.date() + datetime.timedelta(days=day_index)]
                         station_balance[day_index] = station_balance[day_index-1] \
                                                      - overall_balance['eto'] \
                                                      + overall_balance['rain'] \
                                                      + sum(interval['irrigation'] for interval in overall_balance['intervals'] if
                                                            interval['done'] or interval['program'] != self.index)
-                        station_balance[day_index] = max(-100, min(station_balance[day_index], stations.get(station).capacity))
+                        station_balance[day_index] = max(-100, min(station_balance[day_index], station_info.capacity))
                         rain[day_index] = overall_balance['rain']
 
 
+                    station_schedule = _IntervalSet(self.modulo, to_sprinkle[station])
+                    pem_count = len(station_pems)
+                    next_better, next_later = _pem_successors(station_pems)
                     for index, (pem, prio) in enumerate(station_pems):
                         day_index = (pem.date() - now.date()).days
                         rain_today = max(rain[max(-1, day_index-1)], rain[day_index], rain[min(day_index+1, 9)])
 
-                        better_days = [x for x in station_pems[index+1:] if x[1] > prio]
-                        better_or_equal_days = [x for x in station_pems[index+1:] if x[1] >= prio and x[0] > pem]
-                        any_days = station_pems[index+1:]
+                        # Follow the chain of increasing priorities to find the first later PEM with a higher priority:
+                        better_day = index + 1
+                        while better_day < pem_count and station_pems[better_day][1] <= prio:
+                            better_day = next_better[better_day]
+
+                        # And the first PEM at a later time with at least the same priority:
+                        better_or_equal_day = next_later[index]
+                        while better_or_equal_day < pem_count and station_pems[better_or_equal_day][1] < prio:
+                            better_or_equal_day = next_better[better_or_equal_day]
 
                         target_index, target_index_pref = 9, 9
-                        if any_days:
-                            target_index = (any_days[0][0].date() - now.date()).days
+                        if index + 1 < pem_count:
+                            target_index = (station_pems[index + 1][0].date() - now.date()).days
 
-                        if not better_days: # The best day:
+                        if better_day >= pem_count: # The best day:
                             amount = irrigation_max
-                            if better_or_equal_days:
-                                target_index_pref = (better_or_equal_days[0][0].date() - now.date()).days
+                            if better_or_equal_day < pem_count:
+                                target_index_pref = (station_pems[better_or_equal_day][0].date() - now.date()).days
                         else: # A better day is possible:
                             amount = 0
-                            target_index_pref = (better_days[0][0].date() - now.date()).days
+                            target_index_pref = (station_pems[better_day][0].date() - now.date()).days
 
                         # Make sure not to overflow the capacity (and aim for 0 for today):
-                        later_sprinkle_max = min([-station_balance[day_index]] + [stations.get(station).capacity - station_balance[later_day_index] for later_day_index in range(day_index+1, target_index_pref)])
+                        later_sprinkle_max = min([-station_balance[day_index]] + [station_info.capacity - station_balance[later_day_index] for later_day_index in range(day_index+1, target_index_pref)])
 
                         # Make sure we sprinkle enough not to go above the maximum in the future:
                         later_sprinkle_min = max(-station_balance[later_day_index] - irrigation_max for later_day_index in range(day_index, target_index + 1))
@@ -172,7 +252,7 @@ class _Program(object):
                         # print station, pem, amount, later_sprinkle_min, later_sprinkle_min_pref, later_sprinkle_max, irrigation_max-rain_today, irrigation_max, stations.get(station).capacity, [-station_balance[day_index]] + [(stations.get(station).capacity - station_balance[later_day_index]) for later_day_index in range(day_index+1, target_index_pref)]
                         amount = min(max(later_sprinkle_min, min(max(later_sprinkle_min_pref, amount), later_sprinkle_max, irrigation_max-rain_today)), irrigation_max)
                         if amount >= irrigation_min:
-                            logging.debug('Weather based schedule for %s: PEM: %s, priority: %s, amount: %f.', stations.get(station).name, str(pem), prio, amount)
+                            logging.debug('Weather based schedule for %s: PEM: %s, priority: %s, amount: %f.', station_info.name, str(pem), prio, amount)
                             for later_day_index in range(day_index, 10):
                                 station_balance[later_day_index] += amount
                             week_min = (pem - week_start).total_seconds() / 60
@@ -183,11 +263,12 @@ class _Program(object):
                                 intervals = [amount / new_len] * new_len
 
                             for interval in intervals:
-                                station_duration = int(round(interval*60/stations.get(station).precipitation))
-                                to_sprinkle[station] = self._update_schedule(to_sprinkle[station], self.modulo, week_min, week_min+station_duration)
+                                station_duration = int(round(interval*60/station_info.precipitation))
+                                station_schedule.add(week_min, week_min+station_duration)
                                 week_min += station_duration + int(round(station_duration*pause_ratio))
 
-                    logging.debug('Weather based deficit for %s: %s', stations.get(station).name, str(sorted([((now.date() + datetime.timedelta(days=x)).isoformat(), y) for x, y in station_balance.iteritems()])))
+                    to_sprinkle[station] = station_schedule.intervals
+                    logging.debug('Weather based deficit for %s: %s', station_info.name, str(sorted([((now.date() + datetime.timedelta(days=x)).isoformat(), y) for x, y in station_balance.iteritems()])))
 
                 self._station_schedule = to_sprinkle
             except Exception:
@@ -199,11 +280,11 @@ class _Program(object):
 
     @schedule.setter
     def schedule(self, value):
-        new_schedule = []
+        new_schedule = _IntervalSet(self.modulo)
         for interval in value:
-            new_schedule = self._update_schedule(new_schedule, self.modulo, interval[0], interval[1])
+            new_schedule.add(interval[0], interval[1])
 
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
         self.update_station_schedule()
         self.type = ProgramType.CUSTOM
         self.type_data = [value]
@@ -337,11 +418,11 @@ class _Program(object):
         self.update_station_schedule()
 
     def set_days_simple(self, start_min, duration_min, pause_min, repeat_times, days):
-        new_schedule = []
+        new_schedule = _IntervalSet(7*1440)
         for day in days:
             day_start_min = start_min + 1440 * day
             for i in range(repeat_times+1):
-                new_schedule = self._update_schedule(new_schedule, 7*1440, day_start_min, day_start_min + duration_min)
+                new_schedule.add(day_start_min, day_start_min + duration_min)
                 day_start_min += pause_min + duration_min
 
         self._modulo = 7*1440
@@ -349,54 +430,55 @@ class _Program(object):
         self._start = datetime.datetime.combine(datetime.date.today() -
                                                 datetime.timedelta(days=datetime.date.today().weekday()),
                                                 datetime.time.min)  # First day of current week
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
         self.update_station_schedule()
 
         self.type = ProgramType.DAYS_SIMPLE
         self.type_data = [start_min, duration_min, pause_min, repeat_times, days[:]]
 
     def set_days_advanced(self, schedule, days):
-        new_schedule = []
+        new_schedule = _IntervalSet(7*1440)
         for day in days:
             offset = 1440 * day
             for interval in schedule:
-                new_schedule = self._update_schedule(new_schedule, 7*1440, interval[0] + offset, interval[1] + offset)
+                new_schedule.add(interval[0] + offset, interval[1] + offset)
 
         self._modulo = 7*1440
         self._manual = False
         self._start = datetime.datetime.combine(datetime.date.today() -
                                                 datetime.timedelta(days=datetime.date.today().weekday()),
                                                 datetime.time.min)  # First day of current week
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
         self.update_station_schedule()
 
         self.type = ProgramType.DAYS_ADVANCED
         self.type_data = [schedule, days[:]]
 
     def set_repeat_simple(self, start_min, duration_min, pause_min, repeat_times, repeat_days, start_date):
-        new_schedule = []
+        new_schedule = _IntervalSet(repeat_days*1440)
         day_start_min = start_min
         for i in range(repeat_times+1):
-            new_schedule = self._update_schedule(new_schedule, repeat_days*1440, day_start_min, day_start_min + duration_min)
+            new_schedule.add(day_start_min, day_start_min + duration_min)
             day_start_min += pause_min + duration_min
 
         self._modulo = repeat_days*1440
         self._manual = False
         self._start = datetime.datetime.combine(start_date, datetime.time.min)
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
         self.update_station_schedule()
 
         self.type = ProgramType.REPEAT_SIMPLE
         self.type_data = [start_min, duration_min, pause_min, repeat_times, repeat_days, start_date]
 
     def set_repeat_advanced(self, schedule, repeat_days, start_date):
-        new_schedule = []
+        new_schedule = _IntervalSet(repeat_days*1440)
         for interval in schedule:
-            new_schedule = self._update_schedule(new_schedule, repeat_days*1440, interval[0], interval[1])
+            new_schedule.add(interval[0], interval[1])
 
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
+        self._schedule_bounds.clear()
         for station in self.stations:
-            self._station_schedule[station] = new_schedule
+            self._station_schedule[station] = self._schedule
         self._modulo = repeat_days*1440
         self._manual = False
         self._start = datetime.datetime.combine(start_date, datetime.time.min)
@@ -405,36 +487,36 @@ class _Program(object):
         self.type_data = [schedule, repeat_days, start_date]
 
     def set_weekly_advanced(self, schedule):
-        new_schedule = []
+        new_schedule = _IntervalSet(7*1440)
         for interval in schedule:
-            new_schedule = self._update_schedule(new_schedule, 7*1440, interval[0], interval[1])
+            new_schedule.add(interval[0], interval[1])
 
         self._modulo = 7*1440
         self._manual = False
         self._start = datetime.datetime.combine(datetime.date.today() -
                                                 datetime.timedelta(days=datetime.date.today().weekday()),
                                                 datetime.time.min)  # First day of current week
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
         self.update_station_schedule()
 
         self.type = ProgramType.WEEKLY_ADVANCED
         self.type_data = [schedule]
 
     def set_weekly_weather(self, irrigation_min, irrigation_max, run_max, pause_min, pems):
-        new_schedule = []
+        new_schedule = _IntervalSet(21*1440)
 
         # Just fill in something, will be updated per station anyways:
         for pem, prio in pems:
-            new_schedule = self._update_schedule(new_schedule, 21*1440, pem, pem + 1)
-            new_schedule = self._update_schedule(new_schedule, 21*1440, 7*1440 + pem, 7*1440 + pem + 1)
-            new_schedule = self._update_schedule(new_schedule, 21*1440, 14*1440 + pem, 14*1440 + pem + 1)
+            new_schedule.add(pem, pem + 1)
+            new_schedule.add(7*1440 + pem, 7*1440 + pem + 1)
+            new_schedule.add(14*1440 + pem, 14*1440 + pem + 1)
 
         self._modulo = 21*1440
         self._manual = False
         self._start = datetime.datetime.combine(datetime.date.today() -
                                                 datetime.timedelta(days=datetime.date.today().weekday()),
                                                 datetime.time.min)  # First day of current week
-        self._schedule = new_schedule
+        self._schedule = new_schedule.intervals
 
         self.fixed = 1
         self.cut_off = 0
@@ -536,49 +618,25 @@ class _Program(object):
         else:
             return self.schedule
 
-    @staticmethod
-    def _update_schedule(schedule, modulo, start_minute, end_minute):
-        start_minute %= modulo
-        end_minute %= modulo
-
-        if end_minute < start_minute:
-            end_minute += modulo
-
-        if end_minute > modulo:
-            new_entries = [
-                [0, end_minute % modulo],
-                [start_minute, modulo]
-            ]
-        else:
-            new_entries = [[start_minute, end_minute]]
-
-        new_schedule = schedule[:]
-
-        while new_entries:
-            entry = new_entries.pop(0)
-            for existing in new_schedule:
-                if existing[0] <= entry[0] < existing[1]:
-                    entry[0] = existing[1]
-                if existing[0] < entry[1] <= existing[1]:
-                    entry[1] = existing[0]
-                if entry[0] < existing[0] <= existing[1] < entry[1]:
-                    new_entries.append([existing[1], entry[1]])
-                    entry[1] = existing[0]
-
-                if entry[1] - entry[0] <= 0:
-                    break
-
-            if entry[1] - entry[0] > 0:
-                new_schedule.append(entry)
-                new_schedule.sort(key=lambda ent: ent[0])
-
-        return new_schedule
+    def _bounds(self, schedule):
+        """Returns the start and end minutes of the given schedule as two sorted lists.
+        Returns None if the intervals of the schedule are not sorted or overlap."""
+        cached = self._schedule_bounds.get(id(schedule))
+        if cached is None or cached[0] is not schedule:
+            starts = [entry[0] for entry in schedule]
+            ends = [entry[1] for entry in schedule]
+            if all(start <= end for start, end in zip(starts, ends)) and \
+                    all(end <= start for end, start in zip(ends, starts[1:])):
+                cached = (schedule, (starts, ends))
+            else:
+                cached = (schedule, None)
+            self._schedule_bounds[id(schedule)] = cached
+        return cached[1]
 
     def is_active(self, date_time, station):
-        if station in self._station_schedule:
-            schedule = self._station_schedule[station]
-        else:
-            schedule = []
+        schedule = self._station_schedule.get(station)
+        if not schedule:
+            return False  # Also keeps the bounds of empty schedules out of the cache
 
         time_delta = date_time - self.start
         minute_delta = time_delta.days*24*60 + int(time_delta.seconds/60)
@@ -588,6 +646,16 @@ class _Program(object):
 
         current_minute = minute_delta % self.modulo
 
+        bounds = self._bounds(schedule)
+        if bounds is not None:
+            # Only the last interval starting before the current minute can contain it,
+            # the next one might contain it one period later:
+            starts, ends = bounds
+            index = bisect.bisect_right(starts, current_minute)
+            if index > 0 and current_minute < ends[index-1]:
+                return True
+            return index < len(starts) and starts[index] <= current_minute+self.modulo < ends[index]
+
         result = False
         for entry in schedule:
             if entry[0] <= current_minute < entry[1]:
@@ -601,42 +669,81 @@ class _Program(object):
 
         return result
 
-    def active_intervals(self, date_time_start, date_time_end, station):
-        if station in self._station_schedule:
-            schedule = self._station_schedule[station]
-        else:
-            schedule = []
-
-        result = []
+    def _reference(self, date_time_start):
+        """Returns the start of the period of the program at the given moment."""
         if self.manual:
-            current_date_time = self.start
-        else:
-            start_delta = date_time_start - self.start
-            start_minutes = (start_delta.days*24*60 + int(start_delta.seconds/60)) % self.modulo
-            current_date_time = date_time_start - datetime.timedelta(minutes=start_minutes,
-                                                                     seconds=date_time_start.second,
-                                                                     microseconds=date_time_start.microsecond)
+            return self.start
+
+        start_delta = date_time_start - self.start
+        start_minutes = (start_delta.days*24*60 + int(start_delta.seconds/60)) % self.modulo
+        return date_time_start - datetime.timedelta(minutes=start_minutes,
+                                                    seconds=date_time_start.second,
+                                                    microseconds=date_time_start.microsecond)
+
+    def _minute_intervals(self, start_minute, end_microseconds, schedule):
+        """Returns the intervals of the schedule overlapping the given period as (start, end) minutes.
+        The period and the intervals are relative to the reference time, intervals ending at start_minute
+        are over."""
+        result = []
+        if schedule:
+            bounds = self._bounds(schedule)
+
+            offset = 0
+            if not self.manual:  # Skip the periods which are over completely
+                last_end = bounds[1][-1] if bounds is not None else max(entry[1] for entry in schedule)
+                offset = max(0, (start_minute - last_end) // self.modulo) * self.modulo
+
+            while offset * _MINUTE < end_microseconds:
+                if bounds is not None:
+                    # Select the intervals that end after the start and start before the end of the period:
+                    starts, ends = bounds
+                    first = bisect.bisect_right(ends, start_minute - offset)
+                    last = bisect.bisect_left(starts, end_microseconds // _MINUTE - offset + 1, first)
+                    while last > first and (offset + starts[last-1]) * _MINUTE >= end_microseconds:
+                        last -= 1
+                    result.extend((offset + entry[0], offset + entry[1]) for entry in schedule[first:last])
+                else:
+                    for entry in schedule:
+                        if offset + entry[1] <= start_minute:
+                            continue
 
-        while current_date_time < date_time_end:
-            for entry in schedule:
-                start = current_date_time + datetime.timedelta(minutes=entry[0])
-                end = current_date_time + datetime.timedelta(minutes=entry[1])
+                        if (offset + entry[0]) * _MINUTE >= end_microseconds:
+                            break
 
-                if end <= date_time_start:
-                    continue
+                        result.append((offset + entry[0], offset + entry[1]))
 
-                if start >= date_time_end:
+                if self.manual:
                     break
 
-                result.append({
-                    'start': start,
-                    'end': end
-                })
+                offset += self.modulo
 
-            if self.manual:
-                break
+        return result
 
-            current_date_time += datetime.timedelta(minutes=self.modulo)
+    def active_intervals(self, date_time_start, date_time_end, station):
+        return self.station_intervals(date_time_start, date_time_end, [station])[station]
+
+    def station_intervals(self, date_time_start, date_time_end, stations_list):
+        """Returns the active intervals of multiple stations as a dictionary.
+        The intervals of stations sharing the same schedule are only calculated once."""
+        reference = self._reference(date_time_start)
+        start_minute = _microseconds(date_time_start - reference) // _MINUTE
+        end_microseconds = _microseconds(date_time_end - reference)
+
+        result = {}
+        calculated = {}
+        for station in stations_list:
+            schedule = self._station_schedule.get(station)
+            if not schedule:
+                result[station] = []
+                continue
+
+            if id(schedule) not in calculated:
+                intervals = self._minute_intervals(start_minute, end_microseconds, schedule)
+                calculated[id(schedule)] = [(reference + datetime.timedelta(minutes=start),
+                                             reference + datetime.timedelta(minutes=end))
+                                            for start, end in intervals]
+
+            result[station] = [{'start': start, 'end': end} for start, end in calculated[id(schedule)]]
 
         return result
 
@@ -661,61 +768,80 @@ class _Program(object):
             super(_Program, self).__setattr__(key, value)
             if key not in self.SAVE_EXCLUDE:
                 if not self._loading and self.index >= 0:
-                    options.save(self, self.index)
+                    # Private attributes are saved using the property with the same name:
+                    attribute = key.lstrip('_')
+                    if isinstance(getattr(type(self), attribute, None), property) or attribute == key:
+                        options.save(self, self.index, [attribute])
+                    schedule_changes.notify()
 
 
 class _Programs(object):
     def __init__(self):
         self._programs = []
-        self.run_now_program = None
+        self._run_now_program = None
 
         i = 0
         while options.available(_Program, i):
             self._programs.append(_Program(self, i))
+            self._programs[-1]._index = i
             i += 1
 
         options.add_callback('output_count', self._option_cb)
         weather.add_callback(self._weather_cb)
 
+    @property
+    def run_now_program(self):
+        return self._run_now_program
+
+    @run_now_program.setter
+    def run_now_program(self, value):
+        self._run_now_program = value
+        schedule_changes.notify()
+
     def _option_cb(self, key, old, new):
         # Remove all stations that do not exist anymore
         for program in self._programs:
             program.stations = [station for station in program.stations if 0 <= station < new]
 
-    def calculate_balances(self):
+    @staticmethod
+    def _future_runs(now, last_date):
+        """Predicts the schedule from now up to and including last_date once and returns the unblocked runs
+        per (station, date). Just like a prediction per day (from now on), a run is listed on each day it overlaps."""
         from scheduler import predicted_schedule
+        result = {}
+        for run in predicted_schedule(now, datetime.datetime.combine(last_date, datetime.time.max)):
+            if not run['blocked']:
+                run_date = max(run['start'], now).date()
+                while run_date <= last_date and \
+                        run['end'] > max(datetime.datetime.combine(run_date, datetime.time.min), now):
+                    result.setdefault((run['station'], run_date), []).append(run)
+                    run_date += datetime.timedelta(days=1)
+        return result
+
+    def calculate_balances(self):
         now = datetime.datetime.now()
+        future_runs = self._future_runs(now, now.date() + datetime.timedelta(days=9))
+
         for station in stations.get():
-            station.balance = {key: value for key, value in station.balance.iteritems()
-                               if key >= now.date() - datetime.timedelta(days=21)}
-
-            if not station.balance or (now.date() - datetime.timedelta(days=21)) not in station.balance:
-                station.balance[now.date() - datetime.timedelta(days=21)] = {
-                    'eto': 0.0,
-                    'rain': 0.0,
-                    'intervals': [],
-                    'total': 0.0,
-                    'valid': True
-                }
-
-            runs = log.finished_runs() + log.active_runs()
+            balance = station.balance
+            balance.prune(now.date() - datetime.timedelta(days=21))
+
+            if (now.date() - datetime.timedelta(days=21)) not in balance:
+                balance.update(now.date() - datetime.timedelta(days=21),
+                               eto=0.0, rain=0.0, intervals=[], total=0.0, valid=True)
+
+            runs = log.runs_between(datetime.datetime.combine(now.date() - datetime.timedelta(days=20), datetime.time.min),
+                                    now + datetime.timedelta(days=10), station.index)
             calc_day = now.date() - datetime.timedelta(days=20)
             while calc_day < now.date() + datetime.timedelta(days=10):
-                if calc_day not in station.balance:
-                    station.balance[calc_day] = {
-                        'eto': 4.0,
-                        'rain': 0.0,
-                        'intervals': [],
-                        'total': 0.0,
-                        'valid': False
-                    }
+                if calc_day not in balance:
+                    balance.update(calc_day, eto=4.0, rain=0.0, intervals=[], total=0.0, valid=False)
                 try:
-                    if not station.balance[calc_day]['valid'] or calc_day >= now.date():
-                        station.balance[calc_day]['eto'] = weather.get_eto(calc_day)
-                        station.balance[calc_day]['rain'] = weather.get_rain(calc_day)
-                        station.balance[calc_day]['valid'] = True
+                    if not balance[calc_day]['valid'] or calc_day >= now.date():
+                        balance.update(calc_day, eto=weather.get_eto(calc_day))
+                        balance.update(calc_day, rain=weather.get_rain(calc_day), valid=True)
                 except Exception:
-                    station.balance[calc_day]['valid'] = False
+                    balance.update(calc_day, valid=False)
                     logging.warning('Could not get weather information, using fallbacks:\n' + traceback.format_exc())
 
                 intervals = []
@@ -734,34 +860,29 @@ class _Programs(object):
                     del runs[0]
 
                 if calc_day >= now.date():
-                    if calc_day == now.date():
-                        date_time_start = now
-                    else:
-                        date_time_start = datetime.datetime.combine(calc_day, datetime.time.min)
-                    date_time_end = datetime.datetime.combine(calc_day, datetime.time.max)
-                    for run in predicted_schedule(date_time_start, date_time_end):
-                        if not run['blocked'] and run['station'] == station.index:
-                            irrigation = (run['end'] - run['start']).total_seconds() / 3600 * station.precipitation
-                            intervals.append({
-                                'program': run['program'],
-                                'program_name': run['program_name'],
-                                'done': False,
-                                'irrigation': irrigation
-                            })
-
-                if len(intervals) > len(station.balance[calc_day]['intervals']) or calc_day >= now.date():
-                    station.balance[calc_day]['intervals'] = intervals
-
-                station.balance[calc_day]['total'] = station.balance[calc_day - datetime.timedelta(days=1)]['total'] \
-                                                     - station.balance[calc_day]['eto'] \
-                                                     + station.balance[calc_day]['rain'] \
-                                                     + sum(interval['irrigation'] for interval in station.balance[calc_day]['intervals'])
-
-                station.balance[calc_day]['total'] = max(-100, min(station.balance[calc_day]['total'], station.capacity))
+                    for run in future_runs.get((station.index, calc_day), []):
+                        irrigation = (run['end'] - run['start']).total_seconds() / 3600 * station.precipitation
+                        intervals.append({
+                            'program': run['program'],
+                            'program_name': run['program_name'],
+                            'done': False,
+                            'irrigation': irrigation
+                        })
+
+                if len(intervals) > len(balance[calc_day]['intervals']) or calc_day >= now.date():
+                    balance.update(calc_day, intervals=intervals)
+
+                day_balance = balance[calc_day]
+                total = balance[calc_day - datetime.timedelta(days=1)]['total'] \
+                        - day_balance['eto'] \
+                        + day_balance['rain'] \
+                        + sum(interval['irrigation'] for interval in day_balance['intervals'])
+
+                balance.update(calc_day, total=max(-100, min(total, station.capacity)))
 
                 calc_day += datetime.timedelta(days=1)
 
-            station.balance = station.balance # Force saving
+        balances.save()
 
     def _weather_cb(self):
         self.calculate_balances()
@@ -778,7 +899,9 @@ class _Programs(object):
         if program is None:
             program = _Program(self, len(self._programs))
         self._programs.append(program)
+        program._index = len(self._programs) - 1
         options.save(program, program.index)
+        schedule_changes.notify()
 
     def create_program(self):
         """Returns a new program, but doesn't add it to the list."""
@@ -786,12 +909,15 @@ class _Programs(object):
 
     def remove_program(self, index):
         if 0 <= index < len(self._programs):
+            self._programs[index]._index = -1
             del self._programs[index]
 
         for i in range(index, len(self._programs)):
+            self._programs[i]._index = i
             options.save(self._programs[i], i)  # Save programs using new indices
 
         options.erase(_Program, len(self._programs))  # Remove info in last index
+        schedule_changes.notify()
 
     def run_now(self, index):
         if 0 <= index < len(self._programs):
@@ -3,22 +3,203 @@
 __author__ = 'Rimco'
 
 # System imports
+from threading import Lock
 from threading import Thread
+import atexit
+import bisect
 import datetime
+import hashlib
+import os
+import pickle
 import time
 import logging
+import traceback
 
 # Local imports
 from ospy.inputs import inputs
+from ospy.intervals import Interval
 from ospy.log import log
 from ospy.options import level_adjustments
 from ospy.options import options
 from ospy.options import rain_blocks
+from ospy.options import schedule_changes
 from ospy.programs import programs
 from ospy.runonce import run_once
 from ospy.stations import stations
 from ospy.outputs import outputs
 
+SNAPSHOT_FILE = './ospy/data/schedule.pkl'
+
+
+class _UsageTimeline(object):
+    """Keeps track of the combined usage of scheduled intervals over time.
+    Every key is a moment at which the usage changes, the level of a key holds until the next key.
+    The queries scan the keys from the given index, they only visit a few keys per query in practice
+    (see benchmarks/schedule_packing.py) and adding a key is linear anyway because of the list inserts."""
+
+    def __init__(self):
+        self.keys = []
+        self.changes = []
+        self.levels = []
+        self._markers = []  # (summed usage, running since, not running since) after each key, see running_since
+
+    def _key_index(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            self.keys.insert(index, key)
+            self.changes.insert(index, 0)
+            self.levels.insert(index, self.levels[index-1] if index > 0 else 0)
+        return index
+
+    def add(self, start, end, usage):
+        start_index = self._key_index(start)
+        end_index = self._key_index(end)
+        self.changes[start_index] += usage
+        self.changes[end_index] -= usage
+        for index in xrange(start_index, end_index):
+            self.levels[index] += usage
+        del self._markers[start_index:]
+
+    def index_before(self, key):
+        """Returns the index of the last key at or before the given moment, -1 if there is none."""
+        return bisect.bisect_right(self.keys, key) - 1
+
+    def last_exceeding(self, index, end, usage, max_usage):
+        """Returns the index of the last key from index up to end at which adding usage would exceed max_usage.
+        Returns None if the usage can be added over this whole range."""
+        end_index = bisect.bisect_left(self.keys, end, index+1)
+        for check_index in xrange(end_index-1, max(index, 0)-1, -1):
+            if self.levels[check_index] + usage > max_usage:
+                return check_index
+        return None
+
+    def running_since(self, index):
+        """Returns the moment before the key at index since which the usage has been continuously active.
+        Returns None if it did not start (after a pause of more than a few seconds) before this key.
+        The markers are calculated once for each key and are kept until an interval is added before them."""
+        while len(self._markers) < index:
+            key_index = len(self._markers)
+            total, running_since, not_running_since = self._markers[-1] if self._markers else (0, None, None)
+            key = self.keys[key_index]
+            change = self.changes[key_index]
+            if total < 0.01 and change > 0 and not_running_since is not None and \
+                    key - not_running_since > datetime.timedelta(seconds=3):
+                running_since = key
+            total += change
+            if total < 0.01 and change < 0:
+                not_running_since = key
+            self._markers.append((total, running_since, not_running_since))
+        return self._markers[index-1][1] if index > 0 else None
+
+    def next_start(self, index, usage, max_usage):
+        """Returns the index of the first key after index at which the usage drops enough to add usage.
+        Returns None if there is no such key."""
+        for check_index in xrange(index+1, len(self.keys)):
+            if self.changes[check_index] < 0 and self.levels[check_index] + usage <= max_usage:
+                return check_index
+        return None
+
+
+class _SuffixMaximum(object):
+    """Keeps track of the maximum value set on each position
+    and can tell if any position at or after a given position exceeds a value."""
+
+    def __init__(self, size):
+        self._size = size
+        self._tree = [None] * (size + 1)
+
+    def update(self, position, value):
+        index = self._size - position
+        while index <= self._size:
+            if self._tree[index] is None or self._tree[index] < value:
+                self._tree[index] = value
+            index += index & -index
+
+    def exceeds(self, position, value):
+        index = self._size - position
+        while index > 0:
+            if self._tree[index] is not None and self._tree[index] > value:
+                return True
+            index -= index & -index
+        return False
+
+
+def _skip_logged(intervals, skip_intervals):
+    """Returns the intervals that have not been processed before according to the logged intervals.
+    A logged interval is looked up by uid, every (unblocked) logged interval also skips the intervals
+    that are positioned before it in the list and started originally before it.
+    The intervals should not be blocked yet."""
+    uid_positions = {}
+    for index, interval in enumerate(intervals):
+        uid_positions.setdefault(interval['uid'], []).append(index)
+
+    logged = [False] * len(intervals)
+    watermarks = _SuffixMaximum(len(intervals) + 1)
+    for to_skip in skip_intervals:
+        position = len(intervals)
+        for index in uid_positions.get(to_skip['uid'], []):
+            original_start = intervals[index]['original_start']
+            if logged[index] or watermarks.exceeds(index + 1, original_start):
+                continue  # Skipped before
+            if not to_skip['blocked'] and original_start < to_skip['original_start']:
+                continue  # Skipped because it started before this logged interval
+            logged[index] = True
+            position = index
+            break
+
+        if not to_skip['blocked']:
+            watermarks.update(position, to_skip['original_start'])
+
+    return [interval for index, interval in enumerate(intervals)
+            if not logged[index] and not watermarks.exceeds(index + 1, interval['original_start'])]
+
+
+def _place_interval(usage, interval, max_usage, delay_delta):
+    """Shifts the interval to the first moment at which it can be added without exceeding max_usage
+    and adds it to the usage timeline. Returns False if there is no such moment."""
+    duration = interval['end'] - interval['start']
+    key_index = usage.index_before(interval['start'])
+    reach = interval['end']
+
+    failed = False
+    finished = False
+    while not failed and not finished:
+        exceeding = usage.last_exceeding(key_index, interval['end'], interval['usage'], max_usage)
+        if exceeding is None:
+            usage.add(interval['start'], interval['end'], interval['usage'])
+            finished = True
+        else:
+            # Starting points up to the exceeding key will overlap it as well:
+            if usage.keys[exceeding] < reach:
+                key_index = exceeding
+
+            # Shift this interval to next possibility
+            key_index = usage.next_start(key_index, interval['usage'], max_usage)
+
+            # No more options
+            if key_index is None:
+                failed = True
+            else:
+                next_option = usage.keys[key_index]
+                skip_delay = False
+                if options.min_runtime > 0:
+                    # Try to determine how long we have been running at this point:
+                    running_since = usage.running_since(key_index)
+                    if running_since is None or \
+                            next_option - running_since < datetime.timedelta(seconds=options.min_runtime):
+                        skip_delay = True
+
+                if skip_delay:
+                    time_to_next = next_option - interval['start']
+                else:
+                    time_to_next = next_option + delay_delta - interval['start']
+
+                interval['start'] += time_to_next
+                interval['end'] += time_to_next
+                reach = next_option + duration
+
+    return not failed
+
 
 def predicted_schedule(start_time, end_time):
     """Determines all schedules for the given time range.
@@ -34,17 +215,9 @@ def predicted_schedule(start_time, end_time):
     skip_intervals = log.finished_runs() + log.active_runs()
     current_active = [interval for interval in skip_intervals if not interval['blocked']]
 
-    usage_changes = {}
+    usage = _UsageTimeline()
     for active in current_active:
-        start = active['start']
-        end = active['end']
-        if start not in usage_changes:
-            usage_changes[start] = 0
-        if end not in usage_changes:
-            usage_changes[end] = 0
-
-        usage_changes[start] += active['usage']
-        usage_changes[end] -= active['usage']
+        usage.add(active['start'], active['end'], active['usage'])
 
     station_schedules = {}
 
@@ -55,27 +228,29 @@ def predicted_schedule(start_time, end_time):
             if station.index not in station_schedules:
                 station_schedules[station.index] = []
 
-            new_schedule = {
-                'active': None,
-                'program': -1,
-                'program_name': "Run-Once",
-                'fixed': True,
-                'cut_off': 0,
-                'manual': True,
-                'blocked': False,
-                'start': interval['start'],
-                'original_start': interval['start'],
-                'end': interval['end'],
-                'uid': '%s-%s-%d' % (str(interval['start']), "Run-Once", station.index),
-                'usage': station.usage
-            }
+            new_schedule = Interval(
+                station=station.index,
+                active=None,
+                program=-1,
+                program_name="Run-Once",
+                fixed=True,
+                cut_off=0,
+                manual=True,
+                blocked=False,
+                start=interval['start'],
+                original_start=interval['start'],
+                end=interval['end'],
+                uid='%s-%s-%d' % (str(interval['start']), "Run-Once", station.index),
+                usage=station.usage
+            )
             station_schedules[station.index].append(new_schedule)
 
     # Get run-now information:
     if programs.run_now_program is not None:
         program = programs.run_now_program
+        station_intervals = program.station_intervals(start_time, end_time, program.stations)
         for station in sorted(program.stations):
-            run_now_intervals = program.active_intervals(start_time, end_time, station)
+            run_now_intervals = station_intervals[station]
             for interval in run_now_intervals:
                 if station >= stations.count() or stations.master == station or not stations[station].enabled:
                     continue
@@ -85,20 +260,21 @@ def predicted_schedule(start_time, end_time):
 
                 program_name = "%s (Run-Now)" % program.name
 
-                new_schedule = {
-                    'active': None,
-                    'program': -1,
-                    'program_name': program_name,
-                    'fixed': True,
-                    'cut_off': 0,
-                    'manual': True,
-                    'blocked': False,
-                    'start': interval['start'],
-                    'original_start': interval['start'],
-                    'end': interval['end'],
-                    'uid': '%s-%s-%d' % (str(interval['start']), program_name, station),
-                    'usage': stations.get(station).usage
-                }
+                new_schedule = Interval(
+                    station=station,
+                    active=None,
+                    program=-1,
+                    program_name=program_name,
+                    fixed=True,
+                    cut_off=0,
+                    manual=True,
+                    blocked=False,
+                    start=interval['start'],
+                    original_start=interval['start'],
+                    end=interval['end'],
+                    uid='%s-%s-%d' % (str(interval['start']), program_name, station),
+                    usage=stations.get(station).usage
+                )
                 station_schedules[station].append(new_schedule)
 
     # Aggregate per station:
@@ -106,8 +282,9 @@ def predicted_schedule(start_time, end_time):
         if not program.enabled:
             continue
 
+        station_intervals = program.station_intervals(start_time, end_time, program.stations)
         for station in sorted(program.stations):
-            program_intervals = program.active_intervals(start_time, end_time, station)
+            program_intervals = station_intervals[station]
 
             if station >= stations.count() or stations.master == station or not stations[station].enabled:
                 continue
@@ -119,20 +296,21 @@ def predicted_schedule(start_time, end_time):
                 if current_active and current_active[-1]['original_start'] > interval['start']:
                     continue
 
-                new_schedule = {
-                    'active': None,
-                    'program': program.index,
-                    'program_name': program.name, # Save it because programs can be renamed
-                    'fixed': program.fixed,
-                    'cut_off': program.cut_off/100.0,
-                    'manual': program.manual,
-                    'blocked': False,
-                    'start': interval['start'],
-                    'original_start': interval['start'],
-                    'end': interval['end'],
-                    'uid': '%s-%d-%d' % (str(interval['start']), program.index, station),
-                    'usage': stations.get(station).usage
-                }
+                new_schedule = Interval(
+                    station=station,
+                    active=None,
+                    program=program.index,
+                    program_name=program.name, # Save it because programs can be renamed
+                    fixed=program.fixed,
+                    cut_off=program.cut_off/100.0,
+                    manual=program.manual,
+                    blocked=False,
+                    start=interval['start'],
+                    original_start=interval['start'],
+                    end=interval['end'],
+                    uid='%s-%d-%d' % (str(interval['start']), program.index, station),
+                    usage=stations.get(station).usage
+                )
                 station_schedules[station].append(new_schedule)
 
     # Make lists sorted on start time, check usage
@@ -162,30 +340,14 @@ def predicted_schedule(start_time, end_time):
                 interval['end'] += time_delta
             last_end = interval['end']
 
-            new_interval = {
-                'station': station
-            }
-            new_interval.update(interval)
-
-            all_intervals.append(new_interval)
+            all_intervals.append(interval)
 
     # Make list of entries sorted on duration and time (stable sorted on station #)
     all_intervals.sort(key=lambda inter: inter['end'] - inter['start'])
     all_intervals.sort(key=lambda inter: inter['start'])
 
-    # If we have processed some intervals before, we should skip all that were scheduled before them
-    for to_skip in skip_intervals:
-        index = 0
-        while index < len(all_intervals):
-            interval = all_intervals[index]
-
-            if interval['original_start'] < to_skip['original_start'] and (not to_skip['blocked'] or interval['blocked']):
-                del all_intervals[index]
-            elif interval['uid'] == to_skip['uid']:
-                del all_intervals[index]
-                break
-            else:
-                index += 1
+    # If we have processed some intervals before, we should skip all that were scheduled before them:
+    all_intervals = _skip_logged(all_intervals, skip_intervals)
 
     # And make sure manual programs get priority:
     all_intervals.sort(key=lambda inter: not inter['manual'])
@@ -206,87 +368,9 @@ def predicted_schedule(start_time, end_time):
             interval['blocked'] = 'cut-off'
             continue
 
-        if max_usage > 0:
-            usage_keys = sorted(usage_changes.keys())
-            start_usage = 0
-            start_key_index = -1
-
-            for index, key in enumerate(usage_keys):
-                if key > interval['start']:
-                    break
-                start_key_index = index
-                start_usage += usage_changes[key]
-
-            failed = False
-            finished = False
-            while not failed and not finished:
-                parallel_usage = 0
-                parallel_current = 0
-                for index in range(start_key_index+1, len(usage_keys)):
-                    key = usage_keys[index]
-                    if key >= interval['end']:
-                        break
-                    parallel_current += usage_changes[key]
-                    parallel_usage = max(parallel_usage, parallel_current)
-
-                if start_usage + parallel_usage + interval['usage'] <= max_usage:
-
-                    start = interval['start']
-                    end = interval['end']
-                    if start not in usage_changes:
-                        usage_changes[start] = 0
-                    if end not in usage_changes:
-                        usage_changes[end] = 0
-
-                    usage_changes[start] += interval['usage']
-                    usage_changes[end] -= interval['usage']
-                    finished = True
-                else:
-                    while not failed:
-                        # Shift this interval to next possibility
-                        start_key_index += 1
-
-                        # No more options
-                        if start_key_index >= len(usage_keys):
-                            failed = True
-                        else:
-                            next_option = usage_keys[start_key_index]
-                            next_change = usage_changes[next_option]
-                            start_usage += next_change
-
-                            # Lower usage at this starting point:
-                            if next_change < 0:
-                                skip_delay = False
-                                if options.min_runtime > 0:
-                                    # Try to determine how long we have been running at this point:
-                                    min_runtime_delta = datetime.timedelta(seconds=options.min_runtime)
-                                    temp_usage = 0
-                                    running_since = next_option
-                                    not_running_since = next_option
-                                    for temp_index in range(0, start_key_index):
-                                        temp_usage_key = usage_keys[temp_index]
-                                        if temp_usage < 0.01 and usage_changes[temp_usage_key] > 0 and temp_usage_key - not_running_since > datetime.timedelta(seconds=3):
-                                            running_since = temp_usage_key
-                                        temp_usage += usage_changes[temp_usage_key]
-                                        if temp_usage < 0.01 and usage_changes[temp_usage_key] < 0:
-                                            not_running_since = temp_usage_key
-                                    if next_option - running_since < min_runtime_delta:
-                                        skip_delay = True
-
-                                if skip_delay:
-                                    time_to_next = next_option - interval['start']
-                                else:
-                                    time_to_next = next_option + delay_delta - interval['start']
-
-                                interval['start'] += time_to_next
-                                interval['end'] += time_to_next
-                                break
-
-            if failed:
-                logging.warning('Could not schedule %s.', interval['uid'])
-                interval['blocked'] = 'scheduler error'
-
-
+        if max_usage > 0 and not _place_interval(usage, interval, max_usage, delay_delta):
+            logging.warning('Could not schedule %s.', interval['uid'])
+            interval['blocked'] = 'scheduler error'
 
     all_intervals.sort(key=lambda inter: inter['start'])
 
@@ -298,11 +382,9 @@ def combined_schedule(start_time, end_time):
     if current_time < start_time:
         result = predicted_schedule(start_time, end_time)
     elif current_time > end_time:
-        result = [entry for entry in log.finished_runs() if start_time <= entry['start'] <= end_time or
-                                                            start_time <= entry['end'] <= end_time]
+        result = log.runs_between(start_time, end_time)
     else:
-        result = log.finished_runs()
-        result += log.active_runs()
+        result = log.runs_between(start_time, end_time)
         predicted = predicted_schedule(start_time, end_time)
         result += [entry for entry in predicted if current_time <= entry['start'] <= end_time]
 
@@ -310,12 +392,45 @@ def combined_schedule(start_time, end_time):
 
 
 class _Scheduler(Thread):
+    # Options that influence the predicted schedule or the master outputs:
+    SCHEDULE_OPTIONS = ['scheduler_enabled', 'manual_mode', 'max_usage', 'station_delay', 'min_runtime',
+                        'rain_sensor_enabled', 'rain_sensor_no', 'level_adjustment', 'rain_block',
+                        'master_relay', 'master_on_delay', 'master_off_delay']
+
+    # Recalculate the schedule at least this often, even if nothing seems to have changed:
+    SCHEDULE_REFRESH = datetime.timedelta(hours=1)
+
+    # The saved schedule is resumed after a restart if it is at most this old (it is saved again after half of it):
+    SNAPSHOT_AGE = datetime.timedelta(hours=12)
+
+    # Maximum time to sleep between checks (guards against changes of the system clock):
+    MAX_SLEEP = 60
+
+    # The rain sensor cannot notify us, so it is polled with this interval:
+    RAIN_SENSOR_SLEEP = 1
+
     def __init__(self):
         super(_Scheduler, self).__init__()
         self.daemon = True
         #options.add_callback('scheduler_enabled', self._option_cb)
         options.add_callback('manual_mode', self._option_cb)
         options.add_callback('master_relay', self._option_cb)
+        for key in self.SCHEDULE_OPTIONS:
+            options.add_callback(key, self._schedule_option_cb)
+
+        self._schedule = []
+        self._schedule_state = None
+        self._schedule_time = None
+        self._schedule_configuration = None
+        self._schedule_lock = Lock()
+        self._recalculation = None
+        self._saved_configuration = None
+        self._saved_time = None
+
+        self._master_starts = []
+        self._master_ends = []
+        self._master_state = None
+        self._master_schedule = None
 
         # If manual mode is active, finish all stale runs:
         if options.manual_mode:
@@ -333,6 +448,162 @@ class _Scheduler(Thread):
         if key == 'master_relay' and not new and outputs.relay_output:
             outputs.relay_output = False
 
+    @staticmethod
+    def _schedule_option_cb(key, old, new):
+        schedule_changes.notify()
+
+    def _current_schedule(self, current_time):
+        """Returns the predicted schedule from a day before until a day after the current time.
+        The schedule is recalculated in the background if anything it depends on has changed.
+        Until then, None is returned if the last schedule is outdated (and it is returned if it is only old)."""
+        # The rain sensor is an input without notifications, so it is part of the state:
+        state = (schedule_changes.generation, inputs.rain_sensed())
+        with self._schedule_lock:
+            schedule, schedule_state, schedule_time = self._schedule, self._schedule_state, self._schedule_time
+
+        if state != schedule_state or schedule_time is None or \
+                not schedule_time <= current_time < schedule_time + self.SCHEDULE_REFRESH:
+            if not self._recalculating():
+                self._recalculation = Thread(target=self._recalculate, args=(state, current_time))
+                self._recalculation.daemon = True
+                self._recalculation.start()
+            if state != schedule_state:
+                return None
+        return schedule
+
+    def _recalculating(self):
+        return self._recalculation is not None and self._recalculation.is_alive()
+
+    def _recalculate(self, state, current_time):
+        """Calculates the schedule for the given state, this runs in a separate thread."""
+        try:
+            configuration = self._configuration_hash(current_time)
+            schedule = predicted_schedule(current_time - datetime.timedelta(days=1),
+                                          current_time + datetime.timedelta(days=1))
+            with self._schedule_lock:
+                self._schedule = schedule
+                self._schedule_state = state
+                self._schedule_time = current_time
+                self._schedule_configuration = configuration
+
+            # Only save if the configuration has changed or the saved schedule gets too old to resume:
+            if configuration != self._saved_configuration or self._saved_time is None or \
+                    not self._saved_time <= current_time < self._saved_time + self.SNAPSHOT_AGE / 2:
+                self._save_snapshot()
+        except Exception:
+            logging.warning('Could not calculate the schedule:\n' + traceback.format_exc())
+
+    def _configuration_hash(self, current_time):
+        """Returns a hash of everything the predicted schedule depends on (except the log):
+        the saved program, station and scheduler options, the run-now and run-once programs,
+        the level adjustments, the rain blocks and the water balances."""
+        configuration = [(key, options[key]) for key in self.SCHEDULE_OPTIONS]
+        for obj, key in [(program, program.index) for program in programs.get()] + \
+                        [(station, station.index) for station in stations.get()] + [(stations, '')]:
+            if options.available(obj, key):
+                configuration.append((options.cls_name(obj, key), sorted(options[options.cls_name(obj, key)].items())))
+
+        run_now_program = programs.run_now_program
+        configuration.append(('run_now', run_now_program.index if run_now_program is not None else None))
+        start, end = current_time - datetime.timedelta(days=1), current_time + datetime.timedelta(days=1)
+        configuration.append(('run_once', [[(entry['start'], entry['end'])
+                                            for entry in run_once.active_intervals(start, end, station.index)]
+                                           for station in stations.get()]))
+        configuration.append(('level_adjustments', sorted(level_adjustments.items())))
+        configuration.append(('rain_blocks', sorted(rain_blocks.items())))
+        configuration.append(('balances', [list(station.balance.iteritems()) for station in stations.get()]))
+        return hashlib.sha1(repr(configuration)).hexdigest()
+
+    def _save_snapshot(self):
+        """Saves the current schedule to be able to resume it quickly after a restart."""
+        with self._schedule_lock:
+            if self._schedule_time is None or self._schedule_time == self._saved_time:
+                return
+            snapshot = {
+                'configuration': self._schedule_configuration,
+                'rain': self._schedule_state[1],
+                'time': self._schedule_time,
+                'schedule': self._schedule
+            }
+
+        try:
+            with open(SNAPSHOT_FILE + '.tmp', 'wb') as fh:
+                pickle.dump(snapshot, fh, pickle.HIGHEST_PROTOCOL)
+            if os.path.isfile(SNAPSHOT_FILE):
+                os.remove(SNAPSHOT_FILE)
+            os.rename(SNAPSHOT_FILE + '.tmp', SNAPSHOT_FILE)
+            self._saved_configuration = snapshot['configuration']
+            self._saved_time = snapshot['time']
+        except Exception:
+            logging.warning('Could not save the schedule:\n' + traceback.format_exc())
+
+    def _load_snapshot(self, current_time):
+        """Uses the saved schedule as current schedule if it is still recent and based on the same configuration.
+        Returns True if the saved schedule can be used, it is recalculated directly afterwards."""
+        if not os.path.isfile(SNAPSHOT_FILE) or options.manual_mode:
+            return False
+
+        try:
+            with open(SNAPSHOT_FILE, 'rb') as fh:
+                snapshot = pickle.load(fh)
+        except Exception:
+            logging.warning('Could not load the saved schedule:\n' + traceback.format_exc())
+            return False
+
+        if snapshot['configuration'] != self._configuration_hash(current_time) or \
+                snapshot['rain'] != inputs.rain_sensed() or \
+                not snapshot['time'] <= current_time < snapshot['time'] + self.SNAPSHOT_AGE:
+            return False
+
+        # The log is not part of the configuration, so skip the runs that were started or stopped since:
+        schedule = sorted(snapshot['schedule'], key=lambda interval: interval['original_start'])
+        schedule = _skip_logged(schedule, log.finished_runs() + log.active_runs())
+        schedule.sort(key=lambda interval: interval['start'])
+
+        with self._schedule_lock:
+            self._schedule = schedule
+            self._schedule_state = (schedule_changes.generation, snapshot['rain'])
+            self._schedule_time = None
+            self._schedule_configuration = snapshot['configuration']
+        self._saved_configuration = snapshot['configuration']
+        self._saved_time = snapshot['time']
+        return True
+
+    def _master_timeline(self, current_time):
+        """Returns the sorted starts and ends of the periods in which the master should be active (using delays).
+        The periods are merged from the runs and the schedule, they are only recalculated if these have changed."""
+        schedule = None if options.manual_mode else self._current_schedule(current_time)
+        state = (schedule_changes.generation, options.manual_mode)
+        if state != self._master_state or schedule is not self._master_schedule:
+            self._master_state = state
+            self._master_schedule = schedule
+
+            on_delay = datetime.timedelta(seconds=options.master_on_delay)
+            off_delay = datetime.timedelta(seconds=options.master_off_delay)
+            check_end = current_time + datetime.timedelta(days=1)
+
+            # Runs that ended before this moment cannot influence the master anymore:
+            entries = log.runs_between(current_time - max(datetime.timedelta(0), off_delay), check_end)
+            # In manual mode we cannot predict, we only know what is currently running and the history
+            if schedule is not None:
+                entries += [entry for entry in schedule if current_time <= entry['start'] <= check_end]
+
+            periods = sorted((entry['start'] + on_delay, entry['end'] + off_delay) for entry in entries
+                             if not entry['blocked'] and stations.get(entry['station']).activate_master)
+
+            self._master_starts = []
+            self._master_ends = []
+            for start, end in periods:
+                if start >= end:
+                    continue
+                if self._master_ends and start <= self._master_ends[-1]:
+                    self._master_ends[-1] = max(self._master_ends[-1], end)
+                else:
+                    self._master_starts.append(start)
+                    self._master_ends.append(end)
+
+        return self._master_starts, self._master_ends
+
     def run(self):
         # Activate outputs upon start if needed:
         current_time = datetime.datetime.now()
@@ -344,18 +615,38 @@ class _Scheduler(Thread):
             if entry['end'] > current_time and (not rain or ignore_rain) and not entry['blocked']:
                 stations.activate(entry['station'])
 
+        # Continue with the schedule from before the restart while it is recalculated:
+        if self._load_snapshot(current_time):
+            logging.debug('Resuming the saved schedule.')
+        atexit.register(self._save_snapshot)
+
         while True:
-            self._check_schedule()
-            time.sleep(1)
+            generation = schedule_changes.generation
+            next_check = self._check_schedule()
+            timeout = self.RAIN_SENSOR_SLEEP if options.rain_sensor_enabled else self.MAX_SLEEP
+            if next_check is not None:
+                timeout = min(timeout, max(0, (next_check - datetime.datetime.now()).total_seconds()))
+            if self._recalculation is not None:
+                # The changes are checked again as soon as the new schedule is ready:
+                self._recalculation.join(timeout)
+                if not self._recalculation.is_alive():
+                    self._recalculation = None
+            else:
+                schedule_changes.wait(generation, timeout)
 
-    @staticmethod
-    def _check_schedule():
+    def _check_schedule(self):
+        """Updates the runs and outputs for the current time.
+        Returns the next time at which something will change (or None if nothing is planned)."""
         current_time = datetime.datetime.now()
-        check_start = current_time - datetime.timedelta(days=1)
-        check_end = current_time + datetime.timedelta(days=1)
+        # While recalculating, the scheduler waits for the new schedule:
+        transitions = [self._schedule_time + self.SCHEDULE_REFRESH] \
+            if self._schedule_time is not None and not self._recalculating() else []
 
-        rain = not options.manual_mode and (rain_blocks.block_end() > datetime.datetime.now() or
+        block_end = rain_blocks.block_end()
+        rain = not options.manual_mode and (block_end > datetime.datetime.now() or
                                             inputs.rain_sensed())
+        if block_end > current_time:
+            transitions.append(block_end)
 
         active = log.active_runs()
         for entry in active:
@@ -364,9 +655,11 @@ class _Scheduler(Thread):
                 log.finish_run(entry)
                 if not entry['blocked']:
                     stations.deactivate(entry['station'])
+            else:
+                transitions.append(entry['end'])
 
-        if not options.manual_mode:
-            schedule = predicted_schedule(check_start, check_end)
+        schedule = None if options.manual_mode else self._current_schedule(current_time)
+        if schedule is not None:
             #import pprint
             #logging.debug("Schedule: %s", pprint.pformat(schedule))
             for entry in schedule:
@@ -374,6 +667,10 @@ class _Scheduler(Thread):
                     log.start_run(entry)
                     if not entry['blocked']:
                         stations.activate(entry['station'])
+                if entry['start'] > current_time:
+                    transitions.append(entry['start'])
+                if entry['end'] > current_time:
+                    transitions.append(entry['end'])
 
         if stations.master is not None or options.master_relay:
             master_on = False
@@ -386,19 +683,13 @@ class _Scheduler(Thread):
                         break
 
             else:
-                # In manual mode we cannot predict, we only know what is currently running and the history
-                if options.manual_mode:
-                    active = log.finished_runs() + active
-                else:
-                    active = combined_schedule(check_start, check_end)
-
-                for entry in active:
-                    if not entry['blocked'] and stations.get(entry['station']).activate_master:
-                        if entry['start'] + datetime.timedelta(seconds=options.master_on_delay) \
-                                <= current_time < \
-                                entry['end'] + datetime.timedelta(seconds=options.master_off_delay):
-                            master_on = True
-                            break
+                master_starts, master_ends = self._master_timeline(current_time)
+                index = bisect.bisect_right(master_starts, current_time) - 1
+                if index >= 0 and current_time < master_ends[index]:
+                    master_on = True
+                    transitions.append(master_ends[index])
+                elif index + 1 < len(master_starts):
+                    transitions.append(master_starts[index + 1])
 
             if stations.master is not None:
                 master_station = stations.get(stations.master)
@@ -410,6 +701,8 @@ class _Scheduler(Thread):
                 if master_on != outputs.relay_output:
                     outputs.relay_output = master_on
 
+        return min(transitions) if transitions else None
+
 scheduler = _Scheduler()
 
 
@@ -7,14 +7,17 @@ import datetime
 import logging
 
 # Local imports
+from ospy.balances import balances
 from ospy.options import options
+from ospy.options import schedule_changes
 
 
 class _Station(object):
-    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', 'is_master', 'active', 'remaining_seconds']
+    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', 'is_master', 'active', 'remaining_seconds', 'balance']
 
     def __init__(self, stations_instance, index):
         self._stations = stations_instance
+        self._index = None  # Maintained by _BaseStations
         self.activate_master = False
 
         self.name = "Station %02d" % (index+1)
@@ -23,13 +26,13 @@ class _Station(object):
         self.usage = 1.0
         self.precipitation = 10.0
         self.capacity = 10.0
-        self.balance = {}
 
-        # Remove (old) balance info:
+        # Move (old) balance info to the balance store:
         if options.cls_name(self, index) in options:
-            opts = options[options.cls_name(self, index)]
+            opts = dict(options[options.cls_name(self, index)])
+            balance = opts.pop('balance', {})
             if 'last_balance_date' in opts and 'last_balance' in opts:
-                self.balance[opts['last_balance_date']] = {
+                balance[opts['last_balance_date']] = {
                     'eto': 0.0,
                     'rain': 0.0,
                     'intervals': [],
@@ -37,17 +40,26 @@ class _Station(object):
                     'valid': True
                 }
 
-            if 'last_balance_date' in opts:
-                del opts['last_balance_date']
-            if 'last_balance' in opts:
-                del opts['last_balance']
-            options[options.cls_name(self, index)] = opts
+            opts.pop('last_balance_date', None)
+            opts.pop('last_balance', None)
+            if opts != options[options.cls_name(self, index)]:
+                if not balances.available(index):
+                    for day, values in balance.iteritems():
+                        balances.get(index).update(day, **values)
+                    balances.save()
+                options[options.cls_name(self, index)] = opts
 
         options.load(self, index)
 
     @property
     def index(self):
-        return self._stations.get().index(self)
+        if self._index is None:
+            raise ValueError('Station is not part of the stations (yet)')
+        return self._index
+
+    @property
+    def balance(self):
+        return balances.get(self.index)
 
     @property
     def is_master(self):
@@ -77,11 +89,10 @@ class _Station(object):
         Returns 0 if no corresponding interval was found.
         Returns -1 if it should be considered infinite."""
         from ospy.log import log
-        active = log.active_runs()
-        index = self.index
+        active = log.active_runs(self.index)
         result = 0
         for interval in active:
-            if not interval['blocked'] and interval['station'] == index:
+            if not interval['blocked']:
                 result = max(0, (interval['end'] - datetime.datetime.now()).total_seconds())
                 if result > datetime.timedelta(days=356).total_seconds():
                     result = -1
@@ -92,7 +103,8 @@ class _Station(object):
         try:
             super(_Station, self).__setattr__(key, value)
             if not key.startswith('_') and key not in self.SAVE_EXCLUDE:
-                options.save(self, self.index)
+                options.save(self, self.index, [key])
+                schedule_changes.notify()
         except ValueError:  # No index available yet
             pass
 
@@ -112,6 +124,7 @@ class _BaseStations(object):
         self._state = [False] * count
         for i in range(count):
             self._stations.append(_Station(self, i))
+            self._stations[-1]._index = i
         self.clear()
 
         options.add_callback('output_count', self._resize_cb)
@@ -126,6 +139,7 @@ class _BaseStations(object):
     def resize(self, count):
         while len(self._stations) < count:
             self._stations.append(_Station(self, len(self._stations)))
+            self._stations[-1]._index = len(self._stations) - 1
             self._state.append(False)
 
         if count < len(self._stations):
@@ -138,9 +152,11 @@ class _BaseStations(object):
             self._activate()
 
             while len(self._stations) > count:
+                self._stations[-1]._index = None
                 del self._stations[-1]
                 del self._state[-1]
 
+        schedule_changes.notify()
         logging.debug("Resized to %d", count)
 
     def count(self):
@@ -189,7 +205,8 @@ class _BaseStations(object):
     def __setattr__(self, key, value):
         super(_BaseStations, self).__setattr__(key, value)
         if not key.startswith('_') and not self._loading:
-            options.save(self)
+            options.save(self, attributes=[key])
+            schedule_changes.notify()
 
 
 class _ShiftStations(_BaseStations):
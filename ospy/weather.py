@@ -6,47 +6,168 @@ __author__ = 'Rimco'
 # System imports
 import logging
 import traceback
-import urllib2
 import json
-import urllib
 import re
 import os
 import shutil
+import calendar
 import datetime
 import time
 import math
-from threading import Thread, Lock
+import pickle
+import Queue
+from collections import OrderedDict
+from threading import Thread, Lock, Timer
 
 from ospy.options import options
 from ospy.log import log
-from ospy.helpers import mkdir_p, try_float
+from ospy.helpers import try_float
+from ospy.observations import observations
+from ospy.weather_providers import WundergroundProvider
 
 
-def _cache(cache_name):
+WEATHER_RESULT_FILE = './ospy/data/weather_results.pkl'
+
+
+class _WeatherResults(object):
+    """Keeps the calculated weather values per (location, elevation, metric, date).
+    The values are saved separately from the options, shortly after the last change.
+    Values of dates more than MAX_AGE days ago are removed when saving."""
+
+    MAX_AGE = 30
+
+    def __init__(self):
+        self._results = {}
+        self._lock = Lock()
+        self._save_timer = None
+
+        try:
+            if not os.path.isfile(WEATHER_RESULT_FILE) and os.path.isfile(WEATHER_RESULT_FILE + '.tmp'):
+                os.rename(WEATHER_RESULT_FILE + '.tmp', WEATHER_RESULT_FILE)  # Saving was interrupted
+            if os.path.isfile(WEATHER_RESULT_FILE):
+                with open(WEATHER_RESULT_FILE, 'rb') as fh:
+                    self._results = pickle.load(fh)
+            elif 'location' in options.weather_cache and 'elevation' in options.weather_cache:
+                # Move the values that were cached in the options:
+                for metric, values in options.weather_cache.iteritems():
+                    if metric not in ['location', 'elevation']:
+                        for check_date, value in values.iteritems():
+                            self._results[(options.weather_cache['location'], options.weather_cache['elevation'],
+                                           metric, check_date)] = value
+                self._save()
+        except Exception:
+            logging.warning('Could not load weather results:\n' + traceback.format_exc())
+
+        if options.weather_cache:
+            options.weather_cache = {}
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def __getitem__(self, key):
+        return self._results[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._results and self._results[key] == value:
+                return
+            self._results[key] = value
+
+            # Only write after 1 second without any more changes
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = Timer(1.0, self._save)
+            self._save_timer.start()
+
+    def _save(self):
+        with self._lock:
+            today = datetime.date.today()
+            for key in self._results.keys():
+                if (today - key[3]).days > self.MAX_AGE:
+                    del self._results[key]
+
+            try:
+                with open(WEATHER_RESULT_FILE + '.tmp', 'wb') as fh:
+                    pickle.dump(self._results, fh, pickle.HIGHEST_PROTOCOL)
+                if os.path.isfile(WEATHER_RESULT_FILE):
+                    os.remove(WEATHER_RESULT_FILE)
+                os.rename(WEATHER_RESULT_FILE + '.tmp', WEATHER_RESULT_FILE)
+            except Exception:
+                logging.warning('Could not save weather results:\n' + traceback.format_exc())
+
+
+class _ParsedDocuments(object):
+    """Keeps the most recently used wunderground documents in memory, identified by their key and fetch time.
+    The size of the documents is kept below options.weather_memory kB, the least recently used documents are dropped."""
+
+    def __init__(self):
+        self._documents = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key, fetched, read):
+        entry = self._documents.pop(key, None)
+        if entry is not None and entry[0] == fetched:
+            self.hits += 1
+        else:
+            if entry is not None:
+                self._size -= entry[1]
+            self.misses += 1
+            body = read()
+            entry = (fetched, len(body), json.loads(body))
+            self._size += entry[1]
+
+        self._documents[key] = entry
+        while self._size > options.weather_memory * 1024 and len(self._documents) > 1:
+            self._size -= self._documents.popitem(last=False)[1][1]
+        return entry[2]
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'documents': len(self._documents),
+            'size': self._size
+        }
+
+
+class _TokenBucket(object):
+    """Allows bursts of up to capacity calls, the tokens are refilled at the given rate (per second).
+    Calling take blocks until a token is available."""
+
+    def __init__(self, capacity, rate):
+        self._capacity = capacity
+        self._rate = rate
+        self._tokens = float(capacity)
+        self._time = time.time()
+        self._lock = Lock()
+
+    def take(self):
+        with self._lock:
+            while True:
+                now = time.time()
+                self._tokens = min(self._capacity, self._tokens + max(0, now - self._time) * self._rate)
+                self._time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                logging.info('Waiting for weather information.')
+                time.sleep((1 - self._tokens) / self._rate)
+
+
+def _cache(metric):
     def cache_decorator(func):
         def func_wrapper(self, check_date):
-            if 'location' not in self._result_cache or self._location != self._result_cache['location'] or \
-                    'elevation' not in self._result_cache or options.elevation != self._result_cache['elevation']:
-                self._result_cache = {
-                    'location': self._location,
-                    'elevation': options.elevation
-                }
-            if cache_name not in self._result_cache:
-                self._result_cache[cache_name] = {}
-
-            if check_date not in self._result_cache[cache_name] or (datetime.date.today() - check_date).days < 1:
+            key = (self._location, options.elevation, metric, check_date)
+            if key not in self._results or (datetime.date.today() - check_date).days < 1:
                 try:
-                    self._result_cache[cache_name][check_date] = func(self, check_date)
-                    options.weather_cache = self._result_cache
+                    self._results[key] = func(self, check_date)
                 except Exception:
-                    if check_date not in self._result_cache[cache_name]:
+                    if key not in self._results:
                         raise
-                    
-                for key in self._result_cache[cache_name].keys():
-                    if (datetime.date.today() - key).days > 30:
-                        del self._result_cache[cache_name][key]
 
-            return self._result_cache[cache_name][check_date]
+            return self._results[key]
         return func_wrapper
     return cache_decorator
 
@@ -115,6 +236,9 @@ class _Weather(Thread):
         "Widespread Dust":                0.6,
     }
 
+    REQUESTS_PER_MINUTE = 5
+    PREFETCH_WORKERS = 3
+
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
@@ -122,14 +246,15 @@ class _Weather(Thread):
         self._callbacks = []
 
         self._location = options.location
-        self._wunderground_key = options.wunderground_key
-        self._requests = []
+        self._provider = WundergroundProvider()
+        self._request_tokens = _TokenBucket(self.REQUESTS_PER_MINUTE, self.REQUESTS_PER_MINUTE / 60.0)
         self._lid = ""
         self._tz = None
         self._lat = 0
         self._lon = 0
         self._determine_location = True
-        self._result_cache = options.weather_cache
+        self._results = _WeatherResults()
+        self._documents = _ParsedDocuments()
 
         options.add_callback('location', self._option_cb)
         options.add_callback('wunderground_key', self._option_cb)
@@ -154,6 +279,21 @@ class _Weather(Thread):
     def update(self):
         self._sleep_time = 0
 
+    @property
+    def provider(self):
+        return self._provider
+
+    @provider.setter
+    def provider(self, value):
+        self._provider = value
+        self._determine_location = True
+        self.update()
+
+    def document_cache_info(self):
+        """Returns the hit/miss counters and the size of the parsed document cache."""
+        with self._lock:
+            return self._documents.info()
+
     def _sleep(self, secs):
         self._sleep_time = secs
         while self._sleep_time > 0:
@@ -161,23 +301,24 @@ class _Weather(Thread):
             self._sleep_time -= 1
 
     def run(self):
+        try:
+            self._import_wunderground_files()
+        except Exception:
+            logging.warning('Could not import weather files:\n' + traceback.format_exc())
+
         while True:
             try:
                 try:
                     if self._determine_location:
                         self._determine_location = False
                         self._find_location()
+                    self._prefetch()
                 finally:
                     for function in self._callbacks:
                         function()
 
-                    self._remove_wunderground_data([
-                        'conditions_',
-                        'forecast10day_',
-                        'history_',
-                        'hourly_',
-                        'hourly10day_'
-                    ])
+                    # Keep 30 days of weather information:
+                    observations.prune(datetime.date.today() - datetime.timedelta(days=29))
 
                 self._sleep(3600)
             except Exception:
@@ -185,18 +326,8 @@ class _Weather(Thread):
                 self._sleep(6*3600)
 
     def _find_location(self):
-        if self._location and self._wunderground_key:
-            lid = ""
-            if re.search("pws:", self._location):
-                lid = self._location
-            else:
-                data = urllib2.urlopen(
-                    "http://autocomplete.wunderground.com/aq?h=0&query=" + urllib.quote_plus(options.location))
-                data = json.load(data)
-                if data is not None:
-                    lid = "zmw:" + data['RESULTS'][0]['zmw']
-
-            self._lid = lid
+        if self._location and self._provider.available():
+            self._lid = self._provider.find_location(self._location)
 
             geo = self._get_wunderground_data('geolookup', None, True)
             self._lat = float(geo['location']['lat'])
@@ -207,99 +338,218 @@ class _Weather(Thread):
             raise Exception('No Location ID found!')
         return self._lid
 
-    def _get_query_path(self, query, name=None):
-        if name is None:
-            name = query
+    @staticmethod
+    def _document_day(name):
+        """Returns the day a document belongs to (used to clean up old documents).
+        This is called by the prefetch workers, so it does not use strptime (its first use is not thread safe)."""
+        match = re.search('_([0-9]{4})([0-9]{2})([0-9]{2})$', name)
+        if match:
+            return datetime.date(*[int(part) for part in match.groups()])
+        return datetime.date.today()
+
+    def _store_document(self, lid, name, body, fetched=None, etag=None, modified=None):
+        """Stores a downloaded document together with its hourly and daily values."""
+        hourly = []
+        daily = []
+        try:
+            data = json.loads(body)
+        except ValueError:
+            error = 'Failed to read ' + name + '.'
+        else:
+            if data is None:
+                error = 'JSON decoding failed.'
+            elif 'error' in data['response']:
+                error = name + ': ' + str(data['response']['error'])
+            else:
+                error = None
+                if name.startswith('history_'):
+                    for observation in data['history']['observations']:
+                        hourly.append((calendar.timegm(self._datetime(observation['utcdate']).timetuple()),
+                                       observation.get('conds'),
+                                       observation.get('wspdm'),
+                                       observation.get('tempm'),
+                                       observation.get('hum')))
+                    for summary in data['history']['dailysummary']:
+                        daily.append((self._document_day(name),
+                                      summary.get('meanwindspdm'),
+                                      summary.get('meanpressurem'),
+                                      summary.get('meantempm'),
+                                      summary.get('mintempm'),
+                                      summary.get('maxtempm'),
+                                      summary.get('maxhumidity'),
+                                      summary.get('minhumidity'),
+                                      summary.get('precipm')))
+                elif name.startswith('hourly'):
+                    for observation in data['hourly_forecast']:
+                        hourly.append((int(observation['FCTTIME']['epoch']),
+                                       observation['condition'],
+                                       observation['wspd']['metric'],
+                                       observation['temp']['metric'],
+                                       observation['humidity']))
+                elif name.startswith('forecast10day_'):
+                    for entry in data['forecast']['simpleforecast']['forecastday']:
+                        daily.append((self._datetime(entry['date']).date(),
+                                      entry['avewind']['kph'],
+                                      None,
+                                      None,
+                                      entry.get('low', {}).get('celsius'),
+                                      entry['high']['celsius'],
+                                      None,
+                                      None,
+                                      entry['qpf_allday']['mm']))
+
+        observations.add(lid, name, self._document_day(name), body, error, hourly, daily, fetched, etag, modified)
+
+    def _import_wunderground_files(self):
+        """Moves the documents of the old wunderground folder to the observation store."""
+        root = os.path.join('ospy', 'data', 'wunderground')
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                folder = os.path.join(root, name, 'q')
+                if os.path.isdir(folder):
+                    for filename in os.listdir(folder):
+                        if filename.endswith('.json'):
+                            path = os.path.join(folder, filename)
+                            lid = filename[:-len('.json')].replace('_', ':', 1)
+                            with open(path, 'r') as fh:
+                                body = fh.read()
+                            try:
+                                self._store_document(lid, name, body, os.path.getmtime(path))
+                            except Exception:
+                                logging.debug('Skipped ' + path + ':\n' + traceback.format_exc())
+            shutil.rmtree(root)
+
+    @staticmethod
+    def _outdated(info, force):
+        """Returns True if a document (with the given info from the store) should be downloaded."""
+        return info is None or (force and time.time() - info[0] > 2 * 3600)
+
+    def _download(self, lid, query, name):
+        provider = self._provider
+        if provider.RATE_LIMITED:
+            self._request_tokens.take()
+
+        logging.debug('Downloading ' + query + ' for ' + lid + '.')
+        etag, modified = observations.validators(lid, name)
+        result = provider.fetch(lid, query, etag, modified)
+        if result is None:
+            observations.touch(lid, name)  # Not modified
+        else:
+            body, etag, modified = result
+            self._store_document(lid, name, body, etag=etag, modified=modified)
+
+    def _prefetch_requests(self):
+        """Returns (priority, query, name) of the documents the balance calculations will need,
+        but which are missing or outdated. Today and the forecasts come first, then history (newest first)."""
+        lid = self.get_lid()
+        today = datetime.date.today()
+        datestring = today.strftime('%Y%m%d')
+
+        result = []
+        for query in ['conditions', 'hourly10day', 'forecast10day']:
+            info = observations.info(lid, query + '_' + datestring)
+            if self._outdated(info, False) or info[1] is not None:
+                result.append((0, query, query + '_' + datestring))
+
+        # The ETo of today is based on history after noon:
+        for days in range(0 if datetime.datetime.now().hour >= 12 else 1, 21):
+            check_date = today - datetime.timedelta(days=days)
+            if days > 0 and (self._location, options.elevation, 'eto', check_date) in self._results \
+                    and (self._location, options.elevation, 'rain', check_date) in self._results:
+                continue
+
+            request = 'history_' + check_date.strftime('%Y%m%d')
+            info = observations.info(lid, request)
+            force = info is not None and (datetime.datetime.fromtimestamp(info[0]).date() <= check_date or
+                                          not observations.daily(lid, request))
+            if self._outdated(info, force) or info[1] is not None:
+                result.append((1 + days, request, request))
 
-        query += '/q/' + self.get_lid() + '.json'
-        name += '/q/' + self.get_lid() + '.json'
+        return result
 
-        path = os.path.join('ospy', 'data', 'wunderground', name.replace(':', '_'))
-        return query, path
+    def _prefetch(self):
+        """Downloads all needed documents using a few workers, limited by the request rate."""
+        if not self._lid or not self._provider.available():
+            return
 
-    def _get_wunderground_data(self, query, name=None, force=False):
+        lid = self.get_lid()
+        queue = Queue.PriorityQueue()
+        for request in self._prefetch_requests():
+            queue.put(request)
+
+        def worker():
+            while True:
+                try:
+                    _, query, name = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    self._download(lid, query, name)
+                except Exception:
+                    logging.debug('Could not prefetch ' + name + ':\n' + traceback.format_exc())
+
+        workers = [Thread(target=worker) for _ in range(min(self.PREFETCH_WORKERS, queue.qsize()))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    def _update_wunderground_data(self, query, name=None, force=False):
+        """Makes sure the document is available in the observation store, returns its name."""
         with self._lock:
-            query, path = self._get_query_path(query, name)
-            mkdir_p(os.path.dirname(path))
+            if name is None:
+                name = query
+            lid = self.get_lid()
 
             try_nr = 1
-            data = {}
             while try_nr <= 2:
                 try:
-                    if not os.path.exists(path) or (force and time.time() - os.path.getmtime(path) > 2 * 3600):
-                        # Max 5 calls per minute:
-                        self._requests.append(time.time())
-                        if len(self._requests) > 5:
-                            del self._requests[0]
-                            if self._requests[-1] - self._requests[0] < 60:
-                                logging.info('Waiting for weather information.')
-                                time.sleep(60 - (self._requests[-1] - self._requests[0]))
-
-                        with open(path, 'wb') as fh:
-                            print query
-                            req = urllib2.urlopen("http://api.wunderground.com/api/" + self._wunderground_key + "/" + query)
-                            while True:
-                                chunk = req.read(20480)
-                                if not chunk:
-                                    break
-                                fh.write(chunk)
-
-                    try:
-                        with file(path, 'r') as fh:
-                            data = json.load(fh)
-                    except ValueError:
-                        raise Exception('Failed to read ' + path + '.')
-
-                    if data is not None:
-                        if 'error' in data['response']:
-                            raise Exception(path + ': ' + str(data['response']['error']))
-                    else:
-                        raise Exception('JSON decoding failed.')
+                    info = observations.info(lid, name)
+                    if self._outdated(info, force):
+                        self._download(lid, query, name)
+                        info = observations.info(lid, name)
+
+                    if info[1] is not None:
+                        raise Exception(info[1])
+                    break
 
                 except Exception as err:
                     if try_nr < 2:
                         log.debug(str(err), 'Retrying.')
-                        os.remove(path)
+                        observations.remove(lid, name)
                     else:
                         raise
                 try_nr += 1
 
-            return data
+            return name
 
-    def _remove_wunderground_data(self, prefixes):
-        root = os.path.join('ospy', 'data', 'wunderground')
-        # Delete old files
-        for prefix in prefixes:
-            check_date = datetime.date.today()
-            day_delta = datetime.timedelta(days=1)
-            keep_folders = []
-            for index in range(30):
-                datestring = check_date.strftime('%Y%m%d')
-                keep_folders.append(prefix + datestring)
-                check_date -= day_delta
-            if os.path.isdir(root):
-                for folder in os.listdir(root):
-                    if folder.startswith(prefix) and folder not in keep_folders:
-                        path = os.path.join(root, folder)
-                        if os.path.isdir(path):
-                            shutil.rmtree(path)
+    def _get_wunderground_data(self, query, name=None, force=False):
+        name = self._update_wunderground_data(query, name, force)
+        with self._lock:
+            lid = self.get_lid()
+            return self._documents.load((lid, name), observations.info(lid, name)[0],
+                                        lambda: observations.body(lid, name))
 
-    def _get_history(self, check_date):
+    def _update_history(self, check_date):
         datestring = check_date.strftime('%Y%m%d')
         request = "history_" + datestring
 
         if isinstance(check_date, datetime.datetime):
             check_date = check_date.date()
 
-        _, path = self._get_query_path(request)
-        force = os.path.isfile(path) and datetime.datetime.fromtimestamp(os.path.getmtime(path)).date() <= check_date
+        info = observations.info(self.get_lid(), request)
+        force = info is not None and datetime.datetime.fromtimestamp(info[0]).date() <= check_date
 
-        data = self._get_wunderground_data(request, force=force)
+        self._update_wunderground_data(request, force=force)
 
-        if data and len(data['history']['dailysummary']) == 0:
-            data = self._get_wunderground_data(request, force=True)
+        if not observations.daily(self.get_lid(), request):
+            self._update_wunderground_data(request, force=True)
 
-        return data
+        return request
+
+    def _get_history(self, check_date):
+        return self._get_wunderground_data(self._update_history(check_date))
 
 
     ################################################################################
@@ -438,15 +688,15 @@ class _Weather(Thread):
         r_so = (0.75 + 0.00002 * options.elevation) * r_a
 
         # m/s at 2m above ground
-        wind_speed = try_float(data['meanwindspdm']) * 1000 / 3600 * 0.748
+        wind_speed = try_float(data['mean_wind']) * 1000 / 3600 * 0.748
 
-        pressure = try_float(data['meanpressurem'], 1000) / 10 # kPa
+        pressure = try_float(data['mean_pressure'], 1000) / 10 # kPa
 
-        temp_avg = try_float(data['meantempm'], 20) # degrees C
-        temp_min = try_float(data['mintempm'], 20) # degrees C
-        temp_max = try_float(data['maxtempm'], 20) # degrees C
-        humid_max = try_float(data['maxhumidity'], 50) # %
-        humid_min = try_float(data['minhumidity'], 50) # %
+        temp_avg = try_float(data['mean_temp'], 20) # degrees C
+        temp_min = try_float(data['min_temp'], 20) # degrees C
+        temp_max = try_float(data['max_temp'], 20) # degrees C
+        humid_max = try_float(data['max_humidity'], 50) # %
+        humid_min = try_float(data['min_humidity'], 50) # %
 
         sigma_t_max4 = 0.000000004903 * math.pow(temp_max + 273.16, 4)
         sigma_t_min4 = 0.000000004903 * math.pow(temp_min + 273.16, 4)
@@ -484,19 +734,21 @@ class _Weather(Thread):
             return self._get_history_eto(check_date)
 
     def _get_history_eto(self, check_date):
-        data = self._get_history(check_date)
+        request = self._update_history(check_date)
         result = 2.0
 
         coverages = {}
-        for observation in data['history']['observations']:
-            hour = int(observation['utcdate']['hour'])
+        for observation in observations.hourly(self.get_lid(), request):
+            current_date = datetime.datetime.utcfromtimestamp(observation['time'])
+            year_date = datetime.datetime(current_date.year, 1, 1)
+            hour = current_date.hour
             if hour not in coverages:
                 coverages[hour] = {
-                    'fractional_day': (360/365.25)*(self._datetime(observation['utcdate']) - self._year(observation['utcdate'])).total_seconds() / 3600 / 24,
+                    'fractional_day': (360/365.25)*(current_date - year_date).total_seconds() / 3600 / 24,
                     'coverage': []
                 }
 
-            coverage = self._calc_coverage(observation['conds'])
+            coverage = self._calc_coverage(observation['condition'])
             coverages[hour]['coverage'].append(coverage)
 
         total_solar_radiation = 0
@@ -509,57 +761,62 @@ class _Weather(Thread):
             total_solar_radiation += solar_radiation
             total_clear_sky_isolation += clear_sky_isolation
 
-        if data and len(data['history']['dailysummary']) > 0:
-            result = self._calc_eto(total_solar_radiation, total_clear_sky_isolation, data['history']['dailysummary'][0])
+        summaries = observations.daily(self.get_lid(), request)
+        if summaries:
+            result = self._calc_eto(total_solar_radiation, total_clear_sky_isolation, summaries[0])
 
         return result
 
-    def _get_todays_eto(self, check_date):
-        datestring = datetime.date.today().strftime('%Y%m%d')
-        hourly_data = self._get_wunderground_data("hourly", "hourly_" + datestring)
-        today_data = self._get_wunderground_data("conditions", "conditions_" + datestring)
-
-        if isinstance(check_date, datetime.datetime):
-            check_date = check_date.date()
-
+    def _get_hourly_summary(self, name, check_date):
+        """Summarizes the hourly forecast values of the given day.
+        Returns the summary and the cloud coverages per hour."""
         summaries = {
-            'meanwindspdm': (lambda x: sum(x) / max(1, len(x)), 'wspd', 'metric'),
-            'meantempm': (lambda x: sum(x) / max(1, len(x)), 'temp', 'metric'),
-            'mintempm': (lambda x: min(x), 'temp', 'metric'),
-            'maxtempm': (lambda x: max(x), 'temp', 'metric'),
-            'maxhumidity': (lambda x: max(x), 'humidity'),
-            'minhumidity': (lambda x: min(x), 'humidity'),
+            'mean_wind': (lambda x: sum(x) / max(1, len(x)), 'wind'),
+            'mean_temp': (lambda x: sum(x) / max(1, len(x)), 'temp'),
+            'min_temp': (lambda x: min(x), 'temp'),
+            'max_temp': (lambda x: max(x), 'temp'),
+            'max_humidity': (lambda x: max(x), 'humidity'),
+            'min_humidity': (lambda x: min(x), 'humidity'),
         }
         summary = {}
         for key in summaries.keys():
             summary[key] = []
 
         coverages = {}
-        for observation in hourly_data['hourly_forecast']:
-            current_date = datetime.datetime.utcfromtimestamp(int(observation['FCTTIME']['epoch']))
+        start = calendar.timegm(check_date.timetuple())
+        for observation in observations.hourly(self.get_lid(), name, start, start + 24 * 3600):
+            current_date = datetime.datetime.utcfromtimestamp(observation['time'])
             year_date = datetime.datetime(current_date.year, 1, 1)
-            if current_date.date() == check_date:
-                hour = current_date.hour
-                if hour not in coverages:
-                    coverages[hour] = {
-                        'fractional_day': (360/365.25)*(current_date - year_date).total_seconds() / 3600 / 24,
-                        'coverage': []
-                    }
-
-                coverage = self._calc_coverage(observation['condition'])
-                coverages[hour]['coverage'].append(coverage)
-
-                for key, search in summaries.iteritems():
-                    elem_data = observation
-                    for elem in search[1:]:
-                        elem_data = elem_data[elem]
-                    summary[key].append(try_float(elem_data))
+            hour = current_date.hour
+            if hour not in coverages:
+                coverages[hour] = {
+                    'fractional_day': (360/365.25)*(current_date - year_date).total_seconds() / 3600 / 24,
+                    'coverage': []
+                }
+
+            coverage = self._calc_coverage(observation['condition'])
+            coverages[hour]['coverage'].append(coverage)
+
+            for key, search in summaries.iteritems():
+                summary[key].append(try_float(observation[search[1]]))
 
         for key, search in summaries.iteritems():
             summary[key] = search[0](summary[key])
 
+        return summary, coverages
+
+    def _get_todays_eto(self, check_date):
+        datestring = datetime.date.today().strftime('%Y%m%d')
+        hourly_name = self._update_wunderground_data("hourly", "hourly_" + datestring)
+        today_data = self._get_wunderground_data("conditions", "conditions_" + datestring)
+
+        if isinstance(check_date, datetime.datetime):
+            check_date = check_date.date()
+
+        summary, coverages = self._get_hourly_summary(hourly_name, check_date)
+
         # No pressure hourly, use conditions data:
-        summary['meanpressurem'] = try_float(today_data['current_observation']['pressure_mb'], 1000)
+        summary['mean_pressure'] = try_float(today_data['current_observation']['pressure_mb'], 1000)
 
         total_solar_radiation = 0
         total_clear_sky_isolation = 0
@@ -575,55 +832,21 @@ class _Weather(Thread):
 
     def _get_future_eto(self, check_date):
         datestring = datetime.date.today().strftime('%Y%m%d')
-        hourly_data = self._get_wunderground_data("hourly10day", "hourly10day_" + datestring)
+        hourly_name = self._update_wunderground_data("hourly10day", "hourly10day_" + datestring)
         today_data = self._get_wunderground_data("conditions", "conditions_" + datestring)
 
         if isinstance(check_date, datetime.datetime):
             check_date = check_date.date()
 
-        summaries = {
-            'meanwindspdm': (lambda x: sum(x) / max(1, len(x)), 'wspd', 'metric'),
-            'meantempm': (lambda x: sum(x) / max(1, len(x)), 'temp', 'metric'),
-            'mintempm': (lambda x: min(x), 'temp', 'metric'),
-            'maxtempm': (lambda x: max(x), 'temp', 'metric'),
-            'maxhumidity': (lambda x: max(x), 'humidity'),
-            'minhumidity': (lambda x: min(x), 'humidity'),
-        }
-        summary = {}
-        for key in summaries.keys():
-            summary[key] = []
-
-        coverages = {}
-        for observation in hourly_data['hourly_forecast']:
-            current_date = datetime.datetime.utcfromtimestamp(int(observation['FCTTIME']['epoch']))
-            year_date = datetime.datetime(current_date.year, 1, 1)
-            if current_date.date() == check_date:
-                hour = current_date.hour
-                if hour not in coverages:
-                    coverages[hour] = {
-                        'fractional_day': (360/365.25)*(current_date - year_date).total_seconds() / 3600 / 24,
-                        'coverage': []
-                    }
-
-                coverage = self._calc_coverage(observation['condition'])
-                coverages[hour]['coverage'].append(coverage)
-
-                for key, search in summaries.iteritems():
-                    elem_data = observation
-                    for elem in search[1:]:
-                        elem_data = elem_data[elem]
-                    summary[key].append(try_float(elem_data))
-
-        for key, search in summaries.iteritems():
-            summary[key] = search[0](summary[key])
+        summary, coverages = self._get_hourly_summary(hourly_name, check_date)
 
         # No pressure forecast, use today's data:
-        summary['meanpressurem'] = try_float(today_data['current_observation']['pressure_mb'], 1000)
+        summary['mean_pressure'] = try_float(today_data['current_observation']['pressure_mb'], 1000)
         day_delta = (check_date - datetime.date.today()).total_seconds() / 3600 / 24
         if today_data['current_observation']['pressure_trend'] == '+':
-            summary['meanpressurem'] += day_delta
+            summary['mean_pressure'] += day_delta
         elif today_data['current_observation']['pressure_trend'] == '-':
-            summary['meanpressurem'] -= day_delta
+            summary['mean_pressure'] -= day_delta
 
         total_solar_radiation = 0
         total_clear_sky_isolation = 0
@@ -644,18 +867,14 @@ class _Weather(Thread):
 
         result = 0.0
         if check_date < datetime.date.today():
-            data = self._get_history(check_date)
-            if data and len(data['history']['dailysummary']) > 0:
-                result = try_float(data['history']['dailysummary'][0]['precipm'])
+            summaries = observations.daily(self.get_lid(), self._update_history(check_date))
+            if summaries:
+                result = try_float(summaries[0]['rain'])
         else:
             datestring = datetime.date.today().strftime('%Y%m%d')
-            data = self._get_wunderground_data("forecast10day", "forecast10day_" + datestring)
-            for entry in data['forecast']['simpleforecast']['forecastday']:
-                if self._datetime(entry['date']).date() == check_date:
-                    if entry['qpf_allday']['mm'] is None:
-                        entry['qpf_allday']['mm'] = 0
-                    result = try_float(entry['qpf_allday']['mm'])
-                    break
+            name = self._update_wunderground_data("forecast10day", "forecast10day_" + datestring)
+            for entry in observations.daily(self.get_lid(), name, check_date)[:1]:
+                result = try_float(0 if entry['rain'] is None else entry['rain'])
         return result
 
 
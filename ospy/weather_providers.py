@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import email.utils
+import httplib
+import json
+import os
+import socket
+import urllib
+import urlparse
+import zlib
+from threading import Lock
+
+# Local imports
+from ospy.options import options
+
+WUNDERGROUND_URL = 'http://api.wunderground.com/api/'
+AUTOCOMPLETE_URL = 'http://autocomplete.wunderground.com/aq'
+
+
+class _ConnectionPool(object):
+    """Keeps the idle HTTP connections per host, so subsequent requests can reuse them (keep-alive)."""
+
+    def __init__(self, timeout=60):
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def _connection(self, scheme, host):
+        with self._lock:
+            idle = self._idle.get((scheme, host), [])
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self._timeout), False
+        return httplib.HTTPConnection(host, timeout=self._timeout), False
+
+    def request(self, url, headers=None):
+        """Performs a GET request, returns the response and its (decompressed) body."""
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip'
+
+        while True:
+            connection, reused = self._connection(scheme, host)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue  # The server might have closed the idle connection
+                raise
+
+            if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.setdefault((scheme, host), []).append(connection)
+
+            if response.getheader('content-encoding', '').lower() == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            return response, body
+
+
+class WeatherProvider(object):
+    """Base class of the weather information providers.
+    Documents are requested using the wunderground queries (like conditions or history_YYYYMMDD) and
+    returned as text in the wunderground format, together with their validators: (body, etag, modified).
+    If the given validators are still valid, None is returned instead."""
+
+    RATE_LIMITED = False
+
+    def available(self):
+        return True
+
+    def find_location(self, location):
+        """Returns the location ID to use for the given location."""
+        return location
+
+    def fetch(self, location, query, etag=None, modified=None):
+        """Returns (document, etag, modified) for the query, or None if the given validators are still valid."""
+        raise NotImplementedError
+
+
+class WundergroundProvider(WeatherProvider):
+    """Requests the documents from the wunderground API, using the key in the options."""
+
+    RATE_LIMITED = True
+
+    def __init__(self):
+        self._pool = _ConnectionPool()
+
+    def available(self):
+        return bool(options.wunderground_key)
+
+    def find_location(self, location):
+        if location.startswith('pws:'):
+            return location
+
+        _, body = self._pool.request(AUTOCOMPLETE_URL + '?h=0&query=' + urllib.quote_plus(location))
+        data = json.loads(body)
+        return '' if data is None else 'zmw:' + data['RESULTS'][0]['zmw']
+
+    def fetch(self, location, query, etag=None, modified=None):
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if modified is not None:
+            headers['If-Modified-Since'] = modified
+
+        response, body = self._pool.request(
+            WUNDERGROUND_URL + options.wunderground_key + '/' + query + '/q/' + location + '.json', headers)
+        if response.status == 304:
+            return None
+        if response.status != 200:
+            raise Exception('%s: HTTP %d %s' % (query, response.status, response.reason))
+        return body, response.getheader('etag'), response.getheader('last-modified')
+
+
+class FixtureProvider(WeatherProvider):
+    """Serves the documents from a folder, for testing and benchmarking without network access.
+    The documents should be named after the query, like history_20150101.json or conditions.json."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, location, query, etag=None, modified=None):
+        path = os.path.join(self.path, query + '.json')
+        file_modified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+        if modified == file_modified:
+            return None
+        with open(path, 'r') as fh:
+            return fh.read(), None, file_modified
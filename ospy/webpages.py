@@ -197,10 +197,9 @@ class action_page(ProtectedPage):
 
             else:  # If status is off
                 stations.deactivate(sid)
-                active = log.active_runs()
+                active = log.active_runs(sid)
                 for interval in active:
-                    if interval['station'] == sid:
-                        log.finish_run(interval)
+                    log.finish_run(interval)
 
         self._redirect_back()
 
@@ -259,59 +258,60 @@ class program_page(ProtectedPage):
 
         qdict['schedule_type'] = int(qdict['schedule_type'])
 
-        program.name = qdict['name']
-        program.stations = json.loads(qdict['stations'])
-        program.enabled = True if qdict.get('enabled', 'off') == 'on' else False
-
-        if qdict['schedule_type'] == ProgramType.WEEKLY_WEATHER:
-            program.cut_off = 0
-            program.fixed = True
-        else:
-            program.cut_off = int(qdict['cut_off'])
-            program.fixed = True if qdict.get('fixed', 'off') == 'on' else False
-
-        simple = [int(qdict['simple_hour']) * 60 + int(qdict['simple_minute']),
-                  int(qdict['simple_duration']),
-                  int(qdict['simple_pause']),
-                  int(qdict['simple_rcount']) if qdict.get('simple_repeat', 'off') == 'on' else 0]
-
-        repeat_start_date = datetime.datetime.combine(datetime.date.today(), datetime.time.min) + \
-                            datetime.timedelta(days=int(qdict['interval_delay']))
-
-        if qdict['schedule_type'] == ProgramType.DAYS_SIMPLE:
-            program.set_days_simple(*(simple + [
-                                    json.loads(qdict['days'])]))
-
-        elif qdict['schedule_type'] == ProgramType.DAYS_ADVANCED:
-            program.set_days_advanced(json.loads(qdict['advanced_schedule_data']),
-                                      json.loads(qdict['days']))
-
-        elif qdict['schedule_type'] == ProgramType.REPEAT_SIMPLE:
-            program.set_repeat_simple(*(simple + [
-                                      int(qdict['interval']),
-                                      repeat_start_date]))
-
-        elif qdict['schedule_type'] == ProgramType.REPEAT_ADVANCED:
-            program.set_repeat_advanced(json.loads(qdict['advanced_schedule_data']),
-                                        int(qdict['interval']),
-                                        repeat_start_date)
-
-        elif qdict['schedule_type'] == ProgramType.WEEKLY_ADVANCED:
-            program.set_weekly_advanced(json.loads(qdict['weekly_schedule_data']))
-
-        elif qdict['schedule_type'] == ProgramType.WEEKLY_WEATHER:
-            program.set_weekly_weather(int(qdict['weather_irrigation_min']),
-                                       int(qdict['weather_irrigation_max']),
-                                       int(qdict['weather_run_max']),
-                                       int(qdict['weather_pause_ratio'])/100.0,
-                                       json.loads(qdict['weather_pems_data']),
-                                       )
-
-        elif qdict['schedule_type'] == ProgramType.CUSTOM:
-            program.modulo = int(qdict['interval'])*1440
-            program.manual = False
-            program.start = repeat_start_date
-            program.schedule = json.loads(qdict['custom_schedule_data'])
+        with options.batch(program):
+            program.name = qdict['name']
+            program.stations = json.loads(qdict['stations'])
+            program.enabled = True if qdict.get('enabled', 'off') == 'on' else False
+
+            if qdict['schedule_type'] == ProgramType.WEEKLY_WEATHER:
+                program.cut_off = 0
+                program.fixed = True
+            else:
+                program.cut_off = int(qdict['cut_off'])
+                program.fixed = True if qdict.get('fixed', 'off') == 'on' else False
+
+            simple = [int(qdict['simple_hour']) * 60 + int(qdict['simple_minute']),
+                      int(qdict['simple_duration']),
+                      int(qdict['simple_pause']),
+                      int(qdict['simple_rcount']) if qdict.get('simple_repeat', 'off') == 'on' else 0]
+
+            repeat_start_date = datetime.datetime.combine(datetime.date.today(), datetime.time.min) + \
+                                datetime.timedelta(days=int(qdict['interval_delay']))
+
+            if qdict['schedule_type'] == ProgramType.DAYS_SIMPLE:
+                program.set_days_simple(*(simple + [
+                                        json.loads(qdict['days'])]))
+
+            elif qdict['schedule_type'] == ProgramType.DAYS_ADVANCED:
+                program.set_days_advanced(json.loads(qdict['advanced_schedule_data']),
+                                          json.loads(qdict['days']))
+
+            elif qdict['schedule_type'] == ProgramType.REPEAT_SIMPLE:
+                program.set_repeat_simple(*(simple + [
+                                          int(qdict['interval']),
+                                          repeat_start_date]))
+
+            elif qdict['schedule_type'] == ProgramType.REPEAT_ADVANCED:
+                program.set_repeat_advanced(json.loads(qdict['advanced_schedule_data']),
+                                            int(qdict['interval']),
+                                            repeat_start_date)
+
+            elif qdict['schedule_type'] == ProgramType.WEEKLY_ADVANCED:
+                program.set_weekly_advanced(json.loads(qdict['weekly_schedule_data']))
+
+            elif qdict['schedule_type'] == ProgramType.WEEKLY_WEATHER:
+                program.set_weekly_weather(int(qdict['weather_irrigation_min']),
+                                           int(qdict['weather_irrigation_max']),
+                                           int(qdict['weather_run_max']),
+                                           int(qdict['weather_pause_ratio'])/100.0,
+                                           json.loads(qdict['weather_pems_data']),
+                                           )
+
+            elif qdict['schedule_type'] == ProgramType.CUSTOM:
+                program.modulo = int(qdict['interval'])*1440
+                program.manual = False
+                program.start = repeat_start_date
+                program.schedule = json.loads(qdict['custom_schedule_data'])
 
         if program.index < 0:
             programs.add_program(program)
@@ -487,14 +487,15 @@ class stations_page(ProtectedPage):
         qdict = web.input()
 
         for s in xrange(0, stations.count()):
-            stations[s].name = qdict["%d_name" % s]
-            stations[s].usage = float(qdict.get("%d_usage" % s, 1.0))
-            stations[s].precipitation = float(qdict.get("%d_precipitation" % s, 10.0))
-            stations[s].capacity = float(qdict.get("%d_capacity" % s, 10.0))
-            stations[s].enabled = True if qdict.get("%d_enabled" % s, 'off') == 'on' else False
-            stations[s].ignore_rain = True if qdict.get("%d_ignore_rain" % s, 'off') == 'on' else False
-            if stations.master is not None or options.master_relay:
-                stations[s].activate_master = True if qdict.get("%d_activate_master" % s, 'off') == 'on' else False
+            with options.batch(stations[s]):
+                stations[s].name = qdict["%d_name" % s]
+                stations[s].usage = float(qdict.get("%d_usage" % s, 1.0))
+                stations[s].precipitation = float(qdict.get("%d_precipitation" % s, 10.0))
+                stations[s].capacity = float(qdict.get("%d_capacity" % s, 10.0))
+                stations[s].enabled = True if qdict.get("%d_enabled" % s, 'off') == 'on' else False
+                stations[s].ignore_rain = True if qdict.get("%d_ignore_rain" % s, 'off') == 'on' else False
+                if stations.master is not None or options.master_relay:
+                    stations[s].activate_master = True if qdict.get("%d_activate_master" % s, 'off') == 'on' else False
 
         raise web.seeother('/')
 
@@ -535,9 +536,9 @@ class api_status_json(ProtectedPage):
                         status['programName'] = 'Manual Mode'
                     else:
                         if station.active:
-                            active = log.active_runs()
+                            active = log.active_runs(station.index)
                             for interval in active:
-                                if not interval['blocked'] and interval['station'] == station.index:
+                                if not interval['blocked']:
                                     status['programName'] = interval['program_name']
 
                                     status['reason'] = 'program'
@@ -461,6 +461,7 @@ def start_enabled_plugins():
             except Exception:
                 logging.error('Failed to load the {} plug-in:'.format(plugin_n) + '\n' + traceback.format_exc())
                 options.enabled_plugins.remove(module)
+                options.enabled_plugins = options.enabled_plugins  # Explicit write to save to file
 
     for module, plugin in __running.copy().iteritems():
         if module not in options.enabled_plugins:
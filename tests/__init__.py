@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# The ospy modules keep their data in ./ospy/data, so the tests run in a temporary folder.
+# Run the tests from the root folder using: python -m unittest discover tests
+# Every test module imports this package first: with the command above, the modules are loaded from the
+# tests folder itself and this package would otherwise not be imported at all.
+
+# System imports
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path = [ROOT] + [p for p in sys.path if p and os.path.abspath(p) != ROOT]
+__path__[:] = [os.path.abspath(p) for p in __path__]
+
+_work_dir = tempfile.mkdtemp(prefix='ospy_tests_')
+os.makedirs(os.path.join(_work_dir, 'ospy', 'data'))
+os.chdir(_work_dir)
+atexit.register(shutil.rmtree, _work_dir, True)
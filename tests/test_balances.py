@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy import balances as balances_module
+from ospy import stations as stations_module
+from ospy.options import options
+
+
+class _BalanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.balance_file = balances_module.BALANCE_FILE
+        balances_module.BALANCE_FILE = os.path.join(self.folder, 'balances.pkl')
+        self.day = datetime.date(2015, 6, 1)
+
+    def tearDown(self):
+        balances_module.BALANCE_FILE = self.balance_file
+        shutil.rmtree(self.folder)
+
+    def _day(self, days):
+        return self.day + datetime.timedelta(days=days)
+
+
+class TestStationBalance(_BalanceTestCase):
+    def test_update(self):
+        balance = balances_module._StationBalance()
+        self.assertNotIn(self.day, balance)
+        self.assertRaises(KeyError, lambda: balance[self.day])
+
+        balance.update(self._day(2), eto=4.0, rain=0.0, intervals=[], total=1.0, valid=True)
+        balance.update(self._day(0), eto=3.0, rain=2.0, intervals=[{'irrigation': 5.0}], total=0.0, valid=False)
+        balance.update(self._day(2), total=2.0)
+        self.assertTrue(balance.changed)
+
+        self.assertEqual(balance.keys(), [self._day(0), self._day(2)])
+        self.assertNotIn(self._day(1), balance)
+        self.assertEqual(balance[self._day(0)], {'eto': 3.0, 'rain': 2.0, 'intervals': ({'irrigation': 5.0},),
+                                                 'total': 0.0, 'valid': False})
+        self.assertEqual(balance[self._day(2)]['total'], 2.0)
+
+        balance.changed = False
+        balance.update(self._day(2), total=2.0)
+        self.assertFalse(balance.changed)
+
+    def test_read_only(self):
+        balance = balances_module._StationBalance()
+        balance.update(self.day, eto=4.0, rain=0.0, intervals=[], total=0.0, valid=True)
+
+        values = balance[self.day]
+        self.assertRaises(TypeError, values.__setitem__, 'rain', 1.0)
+        self.assertRaises(TypeError, values.update, rain=1.0)
+        self.assertRaises(AttributeError, lambda: values['intervals'].append({'irrigation': 5.0}))
+        self.assertEqual(balance[self.day]['rain'], 0.0)
+        self.assertEqual(balance[self.day]['intervals'], ())
+
+    def test_prune(self):
+        balance = balances_module._StationBalance()
+        for days in range(5):
+            balance.update(self._day(days), eto=float(days), rain=0.0, intervals=[], total=0.0, valid=True)
+
+        balance.changed = False
+        balance.prune(self._day(-1))
+        balance.prune(self._day(0))
+        self.assertFalse(balance.changed)
+
+        balance.prune(self._day(3))
+        self.assertTrue(balance.changed)
+        self.assertEqual(balance.keys(), [self._day(3), self._day(4)])
+        self.assertEqual(balance[self._day(3)]['eto'], 3.0)
+        self.assertEqual(len(balance), 2)
+
+
+class TestBalances(_BalanceTestCase):
+    def test_save(self):
+        stored = balances_module._Balances()
+        self.assertFalse(stored.available(1))
+        stored.get(1).update(self.day, eto=4.0, rain=1.0, intervals=[{'irrigation': 5.0}], total=-3.0, valid=True)
+        stored.get(1).update(self._day(1), eto=4.0, rain=0.0, intervals=[], total=-7.0, valid=False)
+        stored.get(1).prune(self._day(1))
+        stored.get(2)
+        stored.save()
+
+        loaded = balances_module._Balances()
+        self.assertTrue(loaded.available(1))
+        self.assertFalse(loaded.available(2))
+        self.assertEqual(list(loaded.get(1).iteritems()), list(stored.get(1).iteritems()))
+        self.assertFalse(loaded.get(1).changed)
+
+        # Nothing is written if nothing has changed:
+        os.remove(balances_module.BALANCE_FILE)
+        loaded.save()
+        self.assertFalse(os.path.isfile(balances_module.BALANCE_FILE))
+
+        # An interrupted save is resumed:
+        loaded.get(1).update(self._day(1), total=-6.0)
+        loaded.save()
+        os.rename(balances_module.BALANCE_FILE, balances_module.BALANCE_FILE + '.tmp')
+        self.assertEqual(balances_module._Balances().get(1)[self._day(1)]['total'], -6.0)
+
+
+class TestMigration(_BalanceTestCase):
+    INDEX = 40
+
+    def setUp(self):
+        super(TestMigration, self).setUp()
+        self.balances = stations_module.balances
+        stations_module.balances = balances_module._Balances()
+        self.key = options.cls_name(stations_module._Station, self.INDEX)
+
+    def tearDown(self):
+        options.erase(stations_module._Station, self.INDEX)
+        stations_module.balances = self.balances
+        super(TestMigration, self).tearDown()
+
+    def test_balance_option(self):
+        options[self.key] = {
+            'name': 'Old station',
+            'balance': {self.day: {'eto': 4.0, 'rain': 1.0, 'intervals': [], 'total': -3.0, 'valid': True}},
+            'last_balance_date': self._day(1),
+            'last_balance': 2.0
+        }
+        station = stations_module._Station(None, self.INDEX)
+
+        self.assertEqual(station.name, 'Old station')
+        self.assertEqual(options[self.key], {'name': 'Old station'})
+        balance = stations_module.balances.get(self.INDEX)
+        self.assertEqual(balance.keys(), [self.day, self._day(1)])
+        self.assertEqual(balance[self.day]['total'], -3.0)
+        self.assertEqual(balance[self._day(1)], {'eto': 0.0, 'rain': 0.0, 'intervals': (), 'total': 2.0, 'valid': True})
+        self.assertEqual(list(balances_module._Balances().get(self.INDEX).iteritems()), list(balance.iteritems()))
+
+        # Balances that are already migrated are kept:
+        options[self.key] = {'name': 'Old station', 'last_balance_date': self.day, 'last_balance': 0.0}
+        stations_module._Station(None, self.INDEX)
+        self.assertEqual(stations_module.balances.get(self.INDEX)[self.day]['total'], -3.0)
+        self.assertEqual(options[self.key], {'name': 'Old station'})
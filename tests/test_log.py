@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import datetime
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy.log import _RunJournal
+from ospy.log import log
+
+
+def _run(uid, start):
+    return {
+        'start': start,
+        'data': {'uid': uid, 'start': start, 'end': start + datetime.timedelta(minutes=10), 'active': True}
+    }
+
+
+class TestRunJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'runs.journal')
+        self.start = datetime.datetime(2015, 6, 1, 8, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _fill(self, journal):
+        journal.append(('add', _run('a', self.start)))
+        journal.append(('add', _run('b', self.start)))
+        journal.append(('finish', 'a', self.start, self.start + datetime.timedelta(minutes=5)))
+        journal.append(('delete', 'b', self.start))
+
+    def test_replay(self):
+        self._fill(_RunJournal(self.filename))
+
+        journal = _RunJournal(self.filename)
+        runs, damaged = journal.load()
+        self.assertFalse(damaged)
+        self.assertEqual(journal.records, 4)
+        self.assertEqual([run['data']['uid'] for run in runs], ['a'])
+        self.assertEqual(runs[0]['data']['end'], self.start + datetime.timedelta(minutes=5))
+        self.assertFalse(runs[0]['data']['active'])
+
+    def test_missing(self):
+        self.assertEqual(_RunJournal(self.filename).load(), (None, False))
+
+    def test_partial_record(self):
+        self._fill(_RunJournal(self.filename))
+        record = pickle.dumps(('finish', 'c', self.start, self.start), pickle.HIGHEST_PROTOCOL)
+        for length in [1, len(record) // 2, len(record) - 1]:
+            shutil.copy(self.filename, self.filename + '.copy')
+            with open(self.filename + '.copy', 'ab') as fh:
+                fh.write(record[:length])
+
+            journal = _RunJournal(self.filename + '.copy')
+            runs, damaged = journal.load()
+            self.assertTrue(damaged, length)
+            self.assertEqual([run['data']['uid'] for run in runs], ['a'])
+
+            # After compaction, appended records should be replayed again:
+            journal.compact(runs)
+            journal.append(('add', _run('d', self.start)))
+            runs, damaged = _RunJournal(self.filename + '.copy').load()
+            self.assertFalse(damaged)
+            self.assertEqual([run['data']['uid'] for run in runs], ['a', 'd'])
+
+
+class TestRunIndex(unittest.TestCase):
+    def setUp(self):
+        self.runs = log._log['Run']
+        self.rnd = random.Random(5)
+
+    def tearDown(self):
+        log._log['Run'] = self.runs
+        log._index_runs()
+
+    @staticmethod
+    def _interval(uid, station, start, end, active):
+        return {'uid': uid, 'station': station, 'start': start, 'end': end, 'active': active, 'blocked': False,
+                'manual': False, 'program': 0, 'program_name': 'Test', 'usage': 1.0}
+
+    def _fill(self, now):
+        runs = []
+        for index in range(self.rnd.randint(0, 40)):
+            start = now - datetime.timedelta(minutes=self.rnd.randint(0, 3 * 1440))
+            active = self.rnd.random() < 0.2
+            if active:  # Active runs have their planned end
+                end = now + datetime.timedelta(minutes=self.rnd.randint(1, 2 * 1440))
+            else:
+                end = start + datetime.timedelta(minutes=self.rnd.randint(0, 600))
+            runs.append({'time': start, 'data': self._interval(str(index), self.rnd.randint(0, 3), start, end, active)})
+        runs.sort(key=lambda run: run['data']['start'])
+        log._log['Run'] = runs
+        log._index_runs()
+        return [run['data'] for run in runs]
+
+    def test_runs_between(self):
+        now = datetime.datetime(2015, 6, 4, 12, 0)
+        for _ in range(200):
+            runs = self._fill(now)
+            start_time = now - datetime.timedelta(minutes=self.rnd.randint(0, 4 * 1440))
+            end_time = start_time + datetime.timedelta(minutes=self.rnd.randint(0, 2 * 1440))
+            station = self.rnd.choice([None, 0, 1, 2, 3])
+            expected = [run for run in runs if run['end'] >= start_time and run['start'] <= end_time and
+                        (station is None or run['station'] == station)]
+            self.assertEqual(sorted(log.runs_between(start_time, end_time, station)),
+                             sorted(expected))
+
+    def test_active_runs(self):
+        now = datetime.datetime(2015, 6, 4, 12, 0)
+        for _ in range(50):
+            runs = self._fill(now)
+            self.assertEqual(log.active_runs(), [run for run in runs if run['active']])
+            self.assertEqual(log.finished_runs(), [run for run in runs if not run['active']])
+            for station in range(5):
+                self.assertEqual(log.active_runs(station),
+                                 [run for run in runs if run['active'] and run['station'] == station])
+
+        # The listings are copies:
+        log.active_runs()[0]['end'] = now
+        self.assertNotEqual(log.active_runs()[0]['end'], now)
+
+    def test_start_finish(self):
+        log._log['Run'] = []
+        log._index_runs()
+        now = datetime.datetime.now()
+        for station in [0, 1, 1]:
+            log.start_run(self._interval('run-%d' % len(log.active_runs()), station, now,
+                                         now + datetime.timedelta(minutes=10), False))
+        self.assertEqual([run['uid'] for run in log.active_runs(1)], ['run-1', 'run-2'])
+
+        log.finish_run('run-1')
+        self.assertEqual([run['uid'] for run in log.active_runs(1)], ['run-2'])
+        self.assertEqual([run['uid'] for run in log.finished_runs()], ['run-1'])
+        self.assertEqual([run['uid'] for run in log.runs_between(now, datetime.datetime.now(), 1)], ['run-1', 'run-2'])
+
+        log.finish_run(None)
+        self.assertEqual(log.active_runs(), [])
+        self.assertEqual(len(log.runs_between(now - datetime.timedelta(minutes=1), datetime.datetime.now())), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy import options as options_module
+
+
+class TestOptionsJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.files = options_module.OPTIONS_FILE, options_module.JOURNAL_FILE
+        options_module.OPTIONS_FILE = os.path.join(self.folder, 'options.db')
+        options_module.JOURNAL_FILE = options_module.OPTIONS_FILE + '.journal'
+
+    def tearDown(self):
+        options_module.OPTIONS_FILE, options_module.JOURNAL_FILE = self.files
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _load():
+        result = options_module._Options()
+        if result._write_timer is not None:
+            result._write_timer.cancel()  # Writes are done explicitly in the tests
+        return result
+
+    @staticmethod
+    def _write_journal(checkpoint, commits, partial=''):
+        with open(options_module.JOURNAL_FILE, 'wb') as fh:
+            pickle.dump(checkpoint, fh, pickle.HIGHEST_PROTOCOL)
+            for commit in commits:
+                pickle.dump(commit, fh, pickle.HIGHEST_PROTOCOL)
+            fh.write(partial)
+
+    def test_replay(self):
+        self._write_journal(0, [({'name': 'First', 'run_entries': 5}, []), ({'name': 'Second'}, ['run_entries'])])
+        opts = self._load()
+        self.assertEqual(opts.name, 'Second')
+        self.assertNotIn('run_entries', opts)
+        self.assertTrue(opts._journal_valid)
+
+    def test_other_checkpoint(self):
+        self._write_journal(3, [({'name': 'Ignored'}, [])])
+        opts = self._load()
+        self.assertNotEqual(opts.name, 'Ignored')
+        self.assertFalse(opts._journal_valid)  # A checkpoint is needed before appending
+
+    def test_partial_commit(self):
+        commit = pickle.dumps(({'name': 'Lost'}, []), pickle.HIGHEST_PROTOCOL)
+        for length in [1, len(commit) // 2, len(commit) - 1]:
+            self._write_journal(0, [({'name': 'Kept'}, [])])
+            valid_size = os.path.getsize(options_module.JOURNAL_FILE)
+            self._write_journal(0, [({'name': 'Kept'}, [])], commit[:length])
+
+            opts = self._load()
+            self.assertEqual(opts.name, 'Kept')
+            self.assertTrue(opts._journal_valid)
+            self.assertEqual(os.path.getsize(options_module.JOURNAL_FILE), valid_size, length)
+
+            # New commits should be found after a restart:
+            opts.location = 'Somewhere'
+            opts._write_timer.cancel()
+            opts._write()
+            self.assertEqual(self._load().location, 'Somewhere')
+
+    def test_mutable_values(self):
+        self._write_journal(0, [({'enabled_plugins': [], 'plugin_test': {'values': [1]}}, [])])
+        opts = self._load()
+
+        # Values changed in place are saved by setting them again:
+        opts.enabled_plugins.append('test')
+        opts.enabled_plugins = opts.enabled_plugins
+        opts.plugin_test['values'].append(2)
+        opts.plugin_test = opts.plugin_test
+        opts._write_timer.cancel()
+        opts._write()
+
+        with open(options_module.JOURNAL_FILE, 'rb') as fh:
+            for _ in range(2):
+                pickle.load(fh)
+            updates, deletes = pickle.load(fh)
+        self.assertEqual(updates['enabled_plugins'], ['test'])
+        self.assertEqual(updates['plugin_test'], {'values': [1, 2]})
+
+        loaded = self._load()
+        self.assertIn('test', loaded.enabled_plugins)
+        self.assertEqual(loaded.plugin_test, {'values': [1, 2]})
+
+
+class _Saved(object):
+    """Object with slow attributes, to give other threads a chance to run while saving."""
+
+    def __init__(self):
+        self._first = 0
+        self._second = 0
+
+    @property
+    def first(self):
+        time.sleep(0.0001)
+        return self._first
+
+    @first.setter
+    def first(self, value):
+        self._first = value
+
+    @property
+    def second(self):
+        time.sleep(0.0001)
+        return self._second
+
+    @second.setter
+    def second(self, value):
+        self._second = value
+
+
+class TestOptionsSave(unittest.TestCase):
+    def setUp(self):
+        self.obj = _Saved()
+        self.opts = options_module._Options()
+        self.opts._write = lambda: None  # Nothing needs to be written to disk
+        self.opts.save(self.obj)
+
+    def test_attributes(self):
+        self.obj.first = 1
+        self.opts.save(self.obj, attributes=['first'])
+        self.assertEqual(self.opts[self.opts.cls_name(self.obj)], {'first': 1, 'second': 0})
+
+    def test_concurrent_attributes(self):
+        def change(attr):
+            for value in range(1, 101):
+                setattr(self.obj, attr, value)
+                self.opts.save(self.obj, attributes=[attr])
+
+        threads = [threading.Thread(target=change, args=(attr,)) for attr in ['first', 'second']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.opts[self.opts.cls_name(self.obj)], {'first': 100, 'second': 100})
+
+    def test_batch(self):
+        with self.opts.batch(self.obj):
+            self.obj.first = 2
+            self.opts.save(self.obj, attributes=['first'])
+            self.obj.second = 3
+            self.opts.save(self.obj, attributes=['second'])
+            self.assertEqual(self.opts[self.opts.cls_name(self.obj)], {'first': 0, 'second': 0})
+        self.assertEqual(self.opts[self.opts.cls_name(self.obj)], {'first': 2, 'second': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
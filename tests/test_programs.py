@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+import datetime
+import random
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy import scheduler
+from ospy.options import options
+from ospy.programs import programs, _IntervalSet
+from ospy.stations import stations
+
+
+def _old_update_schedule(schedule, modulo, start_minute, end_minute):
+    """The schedule update as it was done by the set_* functions before the interval set."""
+    start_minute %= modulo
+    end_minute %= modulo
+
+    if end_minute < start_minute:
+        end_minute += modulo
+
+    if end_minute > modulo:
+        new_entries = [
+            [0, end_minute % modulo],
+            [start_minute, modulo]
+        ]
+    else:
+        new_entries = [[start_minute, end_minute]]
+
+    new_schedule = schedule[:]
+
+    while new_entries:
+        entry = new_entries.pop(0)
+        for existing in new_schedule:
+            if existing[0] <= entry[0] < existing[1]:
+                entry[0] = existing[1]
+            if existing[0] < entry[1] <= existing[1]:
+                entry[1] = existing[0]
+            if entry[0] < existing[0] <= existing[1] < entry[1]:
+                new_entries.append([existing[1], entry[1]])
+                entry[1] = existing[0]
+
+            if entry[1] - entry[0] <= 0:
+                break
+
+        if entry[1] - entry[0] > 0:
+            new_schedule.append(entry)
+            new_schedule.sort(key=lambda ent: ent[0])
+
+    return new_schedule
+
+
+def _old_future_runs(now, last_date):
+    """The future runs as calculate_balances predicted them before, using a prediction for each day."""
+    result = {}
+    calc_day = now.date()
+    while calc_day <= last_date:
+        if calc_day == now.date():
+            date_time_start = now
+        else:
+            date_time_start = datetime.datetime.combine(calc_day, datetime.time.min)
+        date_time_end = datetime.datetime.combine(calc_day, datetime.time.max)
+        for run in scheduler.predicted_schedule(date_time_start, date_time_end):
+            if not run['blocked']:
+                result.setdefault((run['station'], calc_day), []).append(run)
+        calc_day += datetime.timedelta(days=1)
+    return result
+
+
+def _old_is_active(program, date_time, station):
+    """The linear lookup of _Program.is_active before the schedule bounds."""
+    schedule = program._station_schedule.get(station, [])
+    time_delta = date_time - program.start
+    minute_delta = time_delta.days*24*60 + int(time_delta.seconds/60)
+    if program.manual and minute_delta >= program.modulo:
+        return False
+
+    current_minute = minute_delta % program.modulo
+    for entry in schedule:
+        if entry[0] <= current_minute < entry[1] or entry[0] <= current_minute+program.modulo < entry[1]:
+            return True
+        elif entry[0] > current_minute:
+            break
+    return False
+
+
+def _old_active_intervals(program, date_time_start, date_time_end, station):
+    """The linear lookup of _Program.active_intervals before the schedule bounds."""
+    schedule = program._station_schedule.get(station, [])
+    result = []
+    if program.manual:
+        current_date_time = program.start
+    else:
+        start_delta = date_time_start - program.start
+        start_minutes = (start_delta.days*24*60 + int(start_delta.seconds/60)) % program.modulo
+        current_date_time = date_time_start - datetime.timedelta(minutes=start_minutes,
+                                                                 seconds=date_time_start.second,
+                                                                 microseconds=date_time_start.microsecond)
+
+    while current_date_time < date_time_end:
+        for entry in schedule:
+            start = current_date_time + datetime.timedelta(minutes=entry[0])
+            end = current_date_time + datetime.timedelta(minutes=entry[1])
+            if end <= date_time_start:
+                continue
+            if start >= date_time_end:
+                break
+            result.append({'start': start, 'end': end})
+
+        if program.manual:
+            break
+        current_date_time += datetime.timedelta(minutes=program.modulo)
+    return result
+
+
+class TestIntervalSet(unittest.TestCase):
+    def test_random_intervals(self):
+        rnd = random.Random(1)
+        for _ in range(2000):
+            modulo = rnd.choice([60, 1440, 7*1440, 21*1440])
+            fractional = rnd.random() < 0.3
+            old_schedule = []
+            interval_set = _IntervalSet(modulo)
+            for _ in range(rnd.randint(1, 12)):
+                if fractional:
+                    start = rnd.uniform(-2 * modulo, 3 * modulo)
+                else:
+                    start = rnd.randint(-2 * modulo, 3 * modulo)
+                end = start + rnd.choice([0, 1, rnd.randint(0, modulo), rnd.randint(0, 3 * modulo)])
+
+                old_schedule = _old_update_schedule(old_schedule, modulo, start, end)
+                interval_set.add(start, end)
+                self.assertEqual(old_schedule, interval_set.intervals)
+
+    def test_existing_intervals(self):
+        rnd = random.Random(2)
+        for _ in range(500):
+            modulo = rnd.choice([1440, 7*1440])
+            existing = []
+            for _ in range(rnd.randint(0, 6)):
+                start = rnd.randint(0, modulo)
+                existing = _old_update_schedule(existing, modulo, start, start + rnd.randint(0, modulo // 3))
+
+            old_schedule = existing
+            interval_set = _IntervalSet(modulo, existing)
+            for _ in range(rnd.randint(1, 6)):
+                start = rnd.randint(-modulo, 2 * modulo)
+                end = start + rnd.randint(0, modulo)
+                old_schedule = _old_update_schedule(old_schedule, modulo, start, end)
+                interval_set.add(start, end)
+            self.assertEqual(old_schedule, interval_set.intervals)
+
+
+class TestScheduleBuilders(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(3)
+        self.program = programs.create_program()
+
+    def _random_intervals(self, modulo):
+        result = []
+        for _ in range(self.rnd.randint(1, 8)):
+            start = self.rnd.randint(0, modulo - 1)  # Intervals can cross the end of the period
+            result.append([start, start + self.rnd.randint(1, 300)])
+        return result
+
+    def test_days_simple(self):
+        for _ in range(100):
+            start, duration, pause = self.rnd.randint(0, 1439), self.rnd.randint(1, 120), self.rnd.randint(0, 120)
+            repeat = self.rnd.randint(0, 10)
+            days = self.rnd.sample(range(7), self.rnd.randint(1, 7))
+
+            expected = []
+            for day in days:
+                day_start_min = start + 1440 * day
+                for i in range(repeat+1):
+                    expected = _old_update_schedule(expected, 7*1440, day_start_min, day_start_min + duration)
+                    day_start_min += pause + duration
+
+            self.program.set_days_simple(start, duration, pause, repeat, days)
+            self.assertEqual(expected, self.program.schedule)
+
+    def test_days_advanced(self):
+        for _ in range(100):
+            schedule = self._random_intervals(1440)
+            days = self.rnd.sample(range(7), self.rnd.randint(1, 7))
+
+            expected = []
+            for day in days:
+                for interval in schedule:
+                    expected = _old_update_schedule(expected, 7*1440, interval[0] + 1440 * day,
+                                                    interval[1] + 1440 * day)
+
+            self.program.set_days_advanced(schedule, days)
+            self.assertEqual(expected, self.program.schedule)
+
+    def test_repeat_simple(self):
+        for _ in range(100):
+            start, duration, pause = self.rnd.randint(0, 1439), self.rnd.randint(1, 120), self.rnd.randint(0, 120)
+            repeat, repeat_days = self.rnd.randint(0, 20), self.rnd.randint(1, 3)
+
+            expected = []
+            day_start_min = start
+            for i in range(repeat+1):
+                expected = _old_update_schedule(expected, repeat_days*1440, day_start_min, day_start_min + duration)
+                day_start_min += pause + duration
+
+            self.program.set_repeat_simple(start, duration, pause, repeat, repeat_days, datetime.date.today())
+            self.assertEqual(expected, self.program.schedule)
+
+    def test_repeat_advanced(self):
+        for _ in range(100):
+            repeat_days = self.rnd.randint(1, 3)
+            schedule = self._random_intervals(repeat_days*1440)
+
+            expected = []
+            for interval in schedule:
+                expected = _old_update_schedule(expected, repeat_days*1440, interval[0], interval[1])
+
+            self.program.set_repeat_advanced(schedule, repeat_days, datetime.date.today())
+            self.assertEqual(expected, self.program.schedule)
+
+    def test_weekly_advanced(self):
+        for _ in range(100):
+            schedule = self._random_intervals(7*1440)
+
+            expected = []
+            for interval in schedule:
+                expected = _old_update_schedule(expected, 7*1440, interval[0], interval[1])
+
+            self.program.set_weekly_advanced(schedule)
+            self.assertEqual(expected, self.program.schedule)
+
+    def test_weekly_weather(self):
+        for _ in range(20):
+            pems = [[self.rnd.randint(0, 7*1440 - 1), self.rnd.randint(1, 3)] for _ in range(self.rnd.randint(1, 30))]
+
+            expected = []
+            for pem, prio in pems:
+                expected = _old_update_schedule(expected, 21*1440, pem, pem + 1)
+                expected = _old_update_schedule(expected, 21*1440, 7*1440 + pem, 7*1440 + pem + 1)
+                expected = _old_update_schedule(expected, 21*1440, 14*1440 + pem, 14*1440 + pem + 1)
+
+            self.program.set_weekly_weather(5, 25, 20, 10, pems)
+            self.assertEqual(expected, self.program.schedule)
+
+
+class TestFutureRuns(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(4)
+        self.max_usage = options.max_usage
+        options.max_usage = 0  # The predictions per day are only the same if the runs are not shifted
+        self.programs = []
+
+    def tearDown(self):
+        options.max_usage = self.max_usage
+        for program in reversed(self.programs):
+            programs.remove_program(program.index)
+
+    @staticmethod
+    def _runs(future_runs):
+        return {key: sorted((run['uid'], run['start'], run['end']) for run in runs)
+                for key, runs in future_runs.iteritems()}
+
+    def test_random_programs(self):
+        for _ in range(30):
+            for program in reversed(self.programs):
+                programs.remove_program(program.index)
+            self.programs = []
+
+            # Each station is used by one program, so the runs of a station do not overlap:
+            available = range(stations.count())
+            self.rnd.shuffle(available)
+            for _ in range(self.rnd.randint(1, 3)):
+                program = programs.create_program()
+                program.stations = [available.pop() for _ in range(self.rnd.randint(1, 2))]
+                schedule = []
+                for _ in range(self.rnd.randint(1, 4)):
+                    start = self.rnd.randint(0, 1439)  # Runs can cross midnight
+                    schedule.append([start, start + self.rnd.randint(1, 300)])
+                program.set_days_advanced(schedule, self.rnd.sample(range(7), self.rnd.randint(1, 7)))
+                programs.add_program(program)
+                self.programs.append(program)
+
+            now = datetime.datetime.now() + datetime.timedelta(seconds=self.rnd.randint(0, 7 * 24 * 3600),
+                                                               microseconds=self.rnd.randint(0, 999999))
+            last_date = now.date() + datetime.timedelta(days=self.rnd.randint(0, 9))
+            self.assertEqual(self._runs(programs._future_runs(now, last_date)),
+                             self._runs(_old_future_runs(now, last_date)))
+
+
+class TestScheduleLookups(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(6)
+        self.program = programs.create_program()
+        self.program.stations = [0, 1, 2]
+
+    def _random_schedule(self):
+        """Sets a random schedule, short cycle-and-soak intervals as well as long ones crossing the period."""
+        repeat_days = self.rnd.randint(1, 3)
+        schedule = []
+        for _ in range(self.rnd.randint(0, 40)):
+            start = self.rnd.randint(0, repeat_days * 1440 - 1)
+            schedule.append([start, start + self.rnd.choice([1, 2, 5, self.rnd.randint(1, 1440)])])
+        if self.rnd.random() < 0.5:
+            self.program.set_repeat_advanced(schedule, repeat_days, datetime.date.today())
+        else:
+            self.program.set_days_advanced([interval for interval in schedule if interval[0] < 1440],
+                                           self.rnd.sample(range(7), self.rnd.randint(1, 7)))
+        if self.program.schedule and self.rnd.random() < 0.2:
+            self.program.start_now()  # Uses the (unsorted) typed schedule once
+
+    def _check(self):
+        now = datetime.datetime.now()
+        for _ in range(20):
+            date_time_start = now + datetime.timedelta(seconds=self.rnd.randint(-3 * 86400, 10 * 86400))
+            date_time_end = date_time_start + datetime.timedelta(seconds=self.rnd.choice([
+                0, 59, 60, self.rnd.randint(0, 3600), self.rnd.randint(0, 5 * 86400)]))
+            station = self.rnd.choice([0, 1, 2, 3])
+            self.assertEqual(self.program.is_active(date_time_start, station),
+                             _old_is_active(self.program, date_time_start, station))
+            self.assertEqual(self.program.active_intervals(date_time_start, date_time_end, station),
+                             _old_active_intervals(self.program, date_time_start, date_time_end, station))
+
+    def test_random_schedules(self):
+        for _ in range(100):
+            self._random_schedule()
+            self._check()
+
+    def test_bounds(self):
+        for _ in range(20):
+            self._random_schedule()
+            self._check()
+
+            # The stations share their schedule, so the bounds are only kept once:
+            self.assertLessEqual(len(self.program._schedule_bounds), 1)
+            if self.program._schedule_bounds:
+                schedule, bounds = self.program._schedule_bounds.values()[0]
+                self.assertIs(schedule, self.program._station_schedule[0])
+                if bounds is not None:
+                    self.assertEqual(bounds, ([entry[0] for entry in schedule], [entry[1] for entry in schedule]))
+
+        # The bounds are dropped when the station schedules are rebuilt:
+        self.program.stations = [0]
+        self.assertEqual(self.program._schedule_bounds, {})
+        self._check()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+from threading import Event
+import datetime
+import os
+import random
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy import scheduler
+from ospy.log import log
+from ospy.options import level_adjustments
+from ospy.options import options
+from ospy.options import rain_blocks
+from ospy.options import schedule_changes
+from ospy.programs import programs
+from ospy.stations import stations
+
+
+def _old_skip_logged(all_intervals, skip_intervals):
+    """The skipping of logged intervals as it was done by predicted_schedule before the uid index."""
+    all_intervals = list(all_intervals)
+    for to_skip in skip_intervals:
+        index = 0
+        while index < len(all_intervals):
+            interval = all_intervals[index]
+
+            if interval['original_start'] < to_skip['original_start'] and (not to_skip['blocked'] or interval['blocked']):
+                del all_intervals[index]
+            elif interval['uid'] == to_skip['uid']:
+                del all_intervals[index]
+                break
+            else:
+                index += 1
+    return all_intervals
+
+
+def _old_running_since(usage, index):
+    """The running since moment as predicted_schedule determined it before the markers, by walking the keys."""
+    running_since = None
+    not_running_since = None
+    temp_usage = 0
+    for temp_index in range(0, index):
+        key = usage.keys[temp_index]
+        if temp_usage < 0.01 and usage.changes[temp_index] > 0 and not_running_since is not None and \
+                key - not_running_since > datetime.timedelta(seconds=3):
+            running_since = key
+        temp_usage += usage.changes[temp_index]
+        if temp_usage < 0.01 and usage.changes[temp_index] < 0:
+            not_running_since = key
+    return running_since
+
+
+class TestRunningSince(unittest.TestCase):
+    BASE = datetime.datetime(2015, 6, 1)
+
+    def test_random_timelines(self):
+        rnd = random.Random(4)
+        for _ in range(300):
+            usage = scheduler._UsageTimeline()
+            for _ in range(rnd.randint(1, 30)):
+                # Intervals that touch or follow each other within a few seconds are continued runs:
+                start = self.BASE + datetime.timedelta(seconds=rnd.choice([rnd.randint(0, 7200),
+                                                                           rnd.randint(0, 120) * 60 + rnd.randint(0, 5)]))
+                usage.add(start, start + datetime.timedelta(seconds=rnd.randint(1, 1800)), rnd.choice([0.5, 1.0, 2.0]))
+
+                # Query some keys in between, the markers before a new interval should be kept valid:
+                for _ in range(rnd.randint(0, 3)):
+                    index = rnd.randint(0, len(usage.keys))
+                    self.assertEqual(usage.running_since(index), _old_running_since(usage, index))
+
+            for index in range(len(usage.keys) + 1):
+                self.assertEqual(usage.running_since(index), _old_running_since(usage, index))
+
+    def test_pause(self):
+        usage = scheduler._UsageTimeline()
+        usage.add(self.BASE, self.BASE + datetime.timedelta(minutes=10), 1.0)
+        usage.add(self.BASE + datetime.timedelta(minutes=10, seconds=2), self.BASE + datetime.timedelta(minutes=20), 1.0)
+        usage.add(self.BASE + datetime.timedelta(minutes=30), self.BASE + datetime.timedelta(minutes=40), 1.0)
+        self.assertEqual(usage.running_since(1), None)  # The first run has nothing before it
+        self.assertEqual(usage.running_since(4), None)  # A pause of two seconds continues the run
+        self.assertEqual(usage.running_since(5), self.BASE + datetime.timedelta(minutes=30))
+
+        # A new interval before the markers makes them invalid:
+        usage.add(self.BASE + datetime.timedelta(minutes=25), self.BASE + datetime.timedelta(minutes=30), 1.0)
+        self.assertEqual(usage.running_since(usage.index_before(self.BASE + datetime.timedelta(minutes=35)) + 1),
+                         self.BASE + datetime.timedelta(minutes=25))
+
+
+class TestSkipLogged(unittest.TestCase):
+    BASE = datetime.datetime(2015, 6, 1)
+
+    def _case(self, rnd):
+        uids = ['uid-%d' % index for index in range(rnd.randint(1, 40))]
+        intervals = []
+        for index in range(rnd.randint(0, 60)):
+            intervals.append({
+                'number': index,
+                'uid': rnd.choice(uids),
+                'original_start': self.BASE + datetime.timedelta(minutes=rnd.randint(0, 120)),
+                'blocked': False,
+            })
+
+        skip_intervals = []
+        for index in range(rnd.randint(0, 30)):
+            skip_intervals.append({
+                'uid': rnd.choice(uids + ['logged-%d' % index]),
+                'original_start': self.BASE + datetime.timedelta(minutes=rnd.randint(0, 120)),
+                'blocked': rnd.choice([False, False, 'rain delay']),
+            })
+        return intervals, skip_intervals
+
+    def _compare(self, intervals, skip_intervals):
+        self.assertEqual(_old_skip_logged(intervals, skip_intervals),
+                         scheduler._skip_logged(intervals, skip_intervals))
+
+    def test_sorted(self):
+        rnd = random.Random(1)
+        for _ in range(500):
+            intervals, skip_intervals = self._case(rnd)
+            intervals.sort(key=lambda interval: interval['original_start'])
+            skip_intervals.sort(key=lambda interval: interval['original_start'])
+            self._compare(intervals, skip_intervals)
+
+    def test_shuffled(self):
+        rnd = random.Random(2)
+        for _ in range(500):
+            intervals, skip_intervals = self._case(rnd)
+            rnd.shuffle(intervals)
+            rnd.shuffle(skip_intervals)
+            self._compare(intervals, skip_intervals)
+
+    def test_skip_all(self):
+        intervals, _ = self._case(random.Random(3))
+        logged = {'uid': 'unknown', 'original_start': self.BASE + datetime.timedelta(days=1), 'blocked': False}
+        self.assertEqual(scheduler._skip_logged(intervals, [logged]), [])
+        logged['blocked'] = 'rain delay'
+        self.assertEqual(scheduler._skip_logged(intervals, [logged]), intervals)
+
+
+class _ScheduleTestCase(unittest.TestCase):
+    def setUp(self):
+        if os.path.isfile(scheduler.SNAPSHOT_FILE):
+            os.remove(scheduler.SNAPSHOT_FILE)
+        self.program = programs.create_program()
+        self.program.stations = [0, 1]
+        self.program.set_days_simple(6 * 60, 30, 0, 0, range(7))
+        programs.add_program(self.program)
+
+        self.scheduler = scheduler._Scheduler()
+        self.saved = []
+        save_snapshot = self.scheduler._save_snapshot
+        self.scheduler._save_snapshot = lambda: (self.saved.append(True), save_snapshot())
+        self.now = datetime.datetime.now()
+        self.runs = list(log._log['Run'])
+
+    def tearDown(self):
+        if self.scheduler._recalculation is not None:
+            self.scheduler._recalculation.join()
+        programs.remove_program(self.program.index)
+        log._log['Run'] = self.runs
+        log._index_runs()
+
+    def _schedule(self, current_time):
+        """Returns the schedule once the recalculation (if any) has finished."""
+        schedule = self.scheduler._current_schedule(current_time)
+        if self.scheduler._recalculation is not None:
+            self.scheduler._recalculation.join()
+        return schedule, self.scheduler._current_schedule(current_time)
+
+    def _next_run(self):
+        """Schedules the program an hour from now, returns its (calculated) run of station 0."""
+        start = self.now + datetime.timedelta(hours=1)
+        self.program.set_days_simple(start.hour * 60 + start.minute, 30, 0, 0, range(7))
+        _, schedule = self._schedule(self.now)
+        return [entry for entry in schedule if entry['station'] == 0 and entry['start'] > self.now][0]
+
+
+class TestSnapshot(_ScheduleTestCase):
+    def test_background_recalculation(self):
+        pending, schedule = self._schedule(self.now)
+        self.assertIsNone(pending)
+        self.assertEqual(sorted(set(entry['station'] for entry in schedule)), [0, 1])
+
+        # An old schedule is still used while it is recalculated, a changed one is not:
+        old, new = self._schedule(self.now + datetime.timedelta(hours=2))
+        self.assertIs(old, schedule)
+        self.assertIsNot(new, schedule)
+        self.program.stations = [0]
+        pending, schedule = self._schedule(self.now + datetime.timedelta(hours=2))
+        self.assertIsNone(pending)
+        self.assertEqual(sorted(set(entry['station'] for entry in schedule)), [0])
+
+    def test_save_on_change(self):
+        self._schedule(self.now)
+        self.assertEqual(len(self.saved), 1)
+        self._schedule(self.now + datetime.timedelta(hours=2))
+        self.assertEqual(len(self.saved), 1)
+
+        level_adjustments['test'] = 0.5
+        try:
+            self._schedule(self.now + datetime.timedelta(hours=2))
+        finally:
+            del level_adjustments['test']
+        self.assertEqual(len(self.saved), 2)
+
+        # The saved schedule is renewed before it gets too old to resume:
+        self._schedule(self.now + scheduler._Scheduler.SNAPSHOT_AGE)
+        self.assertEqual(len(self.saved), 3)
+
+    def test_resume(self):
+        _, schedule = self._schedule(self.now)
+
+        resumed = scheduler._Scheduler()
+        self.assertTrue(resumed._load_snapshot(self.now + datetime.timedelta(hours=2)))
+        self.assertEqual(resumed._current_schedule(self.now + datetime.timedelta(hours=2)), schedule)
+        resumed._recalculation.join()
+        self.assertFalse(scheduler._Scheduler()._load_snapshot(self.now + scheduler._Scheduler.SNAPSHOT_AGE))
+
+        later = self.now + datetime.timedelta(hours=2)
+        rain_blocks['test'] = self.now + datetime.timedelta(days=1)
+        try:
+            self.assertFalse(scheduler._Scheduler()._load_snapshot(later))
+        finally:
+            del rain_blocks['test']
+        self.assertTrue(scheduler._Scheduler()._load_snapshot(later))
+        self.program.stations = [1]
+        self.assertFalse(scheduler._Scheduler()._load_snapshot(later))
+
+    def _restart_during_run(self):
+        """Saves the schedule an hour before a run, returns the run of station 0 and its restart time."""
+        entry = self._next_run()
+        return entry, entry['start'] + datetime.timedelta(minutes=1)
+
+    def _resume(self, current_time):
+        resumed = scheduler._Scheduler()
+        self.assertTrue(resumed._load_snapshot(current_time))
+        schedule = resumed._current_schedule(current_time)
+        resumed._recalculation.join()
+        return schedule
+
+    def test_resume_active_run(self):
+        entry, restart_time = self._restart_during_run()
+        log.start_run(entry)
+        schedule = self._resume(restart_time)
+        self.assertNotIn(entry['uid'], [interval['uid'] for interval in schedule])
+        self.assertIn(1, [interval['station'] for interval in schedule if interval['start'] > restart_time])
+        self.assertEqual(len(log.active_runs(0)), 1)
+
+    def test_resume_stopped_run(self):
+        entry, restart_time = self._restart_during_run()
+        log.start_run(entry)
+        log.finish_run(entry)
+        schedule = self._resume(restart_time)
+        self.assertEqual([interval for interval in schedule
+                          if interval['station'] == 0 and interval['start'] <= restart_time < interval['end']], [])
+
+
+class TestMasterTimeline(_ScheduleTestCase):
+    def setUp(self):
+        super(TestMasterTimeline, self).setUp()
+        self.delays = options.master_on_delay, options.master_off_delay
+        options.master_on_delay, options.master_off_delay = -60, 30  # The master opens before the station
+        stations.get(0).activate_master = True
+
+    def tearDown(self):
+        stations.get(0).activate_master = False
+        options.master_on_delay, options.master_off_delay = self.delays
+        super(TestMasterTimeline, self).tearDown()
+
+    def _master_on(self, current_time, moment):
+        starts, ends = self.scheduler._master_timeline(current_time)
+        return any(start <= moment < end for start, end in zip(starts, ends))
+
+    def test_cached(self):
+        entry = self._next_run()
+        before = entry['start'] - datetime.timedelta(minutes=5)
+        self.assertFalse(self._master_on(before, entry['start'] - datetime.timedelta(seconds=61)))
+        self.assertTrue(self._master_on(before, entry['start'] - datetime.timedelta(seconds=59)))
+        self.assertTrue(self._master_on(before, entry['end'] + datetime.timedelta(seconds=29)))
+        self.assertFalse(self._master_on(before, entry['end'] + datetime.timedelta(seconds=31)))
+
+        # The timeline is kept until the schedule changes:
+        timeline = self.scheduler._master_timeline(before)
+        self.assertIs(self.scheduler._master_timeline(before)[0], timeline[0])
+        stations.get(1).activate_master = True
+        try:
+            self.assertIsNot(self.scheduler._master_timeline(before)[0], timeline[0])
+        finally:
+            stations.get(1).activate_master = False
+
+    def test_start_during_recalculation(self):
+        entry = self._next_run()
+        before = entry['start'] - datetime.timedelta(minutes=5)
+        self.assertTrue(self._master_on(before, entry['start'] - datetime.timedelta(seconds=59)))
+
+        calculating = Event()
+        predicted_schedule = scheduler.predicted_schedule
+        scheduler.predicted_schedule = lambda start, end: calculating.wait() or predicted_schedule(start, end)
+        try:
+            # Until the changed schedule is ready, only the logged runs are known:
+            schedule_changes.notify()
+            self.assertFalse(self._master_on(before, entry['start'] - datetime.timedelta(seconds=59)))
+            self.assertTrue(self.scheduler._recalculating())
+
+            # A run that is started in the meantime opens the master as well:
+            log.start_run(entry)
+            now = datetime.datetime.now()
+            self.assertTrue(self._master_on(now, now))
+            self.assertTrue(self._master_on(now, now - datetime.timedelta(seconds=59)))
+            self.assertFalse(self._master_on(now, entry['end'] + datetime.timedelta(seconds=31)))
+        finally:
+            calculating.set()
+            scheduler.predicted_schedule = predicted_schedule
+        self.scheduler._recalculation.join()
+
+        # The run changed the schedule again, the new one skips it and the master closes after it:
+        now = datetime.datetime.now()
+        self.assertIsNone(self.scheduler._current_schedule(now))
+        _, schedule = self._schedule(now)
+        self.assertNotIn(entry['uid'], [interval['uid'] for interval in schedule])
+        self.assertTrue(self._master_on(now, entry['end'] + datetime.timedelta(seconds=29)))
+        self.assertFalse(self._master_on(now, entry['end'] + datetime.timedelta(seconds=31)))
+
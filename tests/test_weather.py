@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+from threading import Lock, Thread
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import calendar
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# Local imports
+import tests  # Runs in a temporary folder, also if the tests folder is the top level
+from ospy import weather as weather_module
+from ospy import weather_providers
+from ospy.observations import observations
+from ospy.options import options
+from ospy.weather import weather, _ParsedDocuments, _TokenBucket, _WeatherResults
+from ospy.weather_providers import FixtureProvider
+
+_locations = itertools.count()
+
+
+def _write_fixtures(path):
+    """Writes the wunderground documents the weather calculations need, for today and 21 days of history."""
+    def write(query, data):
+        with open(os.path.join(path, query + '.json'), 'w') as fh:
+            json.dump(data, fh)
+
+    today = datetime.date.today()
+    for days in range(22):
+        day = today - datetime.timedelta(days=days)
+        history = []
+        for hour in range(24):
+            moment = datetime.datetime(day.year, day.month, day.day, hour, 30)
+            history.append({
+                'utcdate': {'year': str(moment.year), 'mon': '%02d' % moment.month,
+                            'mday': '%02d' % moment.day, 'hour': '%02d' % hour, 'min': '30'},
+                'conds': 'Partly Cloudy' if hour % 3 else 'Clear',
+                'tempm': str(10 + hour % 12), 'wspdm': '12.0', 'hum': '60'})
+        write('history_' + day.strftime('%Y%m%d'), {'response': {}, 'history': {
+            'observations': history,
+            'dailysummary': [{'meanwindspdm': '12', 'meanpressurem': '1015', 'meantempm': '15', 'mintempm': '8',
+                              'maxtempm': '22', 'maxhumidity': '90', 'minhumidity': '40', 'humidity': '65',
+                              'precipm': '%.1f' % (days % 4)}]}})
+
+    hourly = []
+    start = calendar.timegm(today.timetuple())
+    for hour in range(240):
+        hourly.append({'FCTTIME': {'epoch': str(start + hour * 3600)}, 'condition': 'Mostly Sunny',
+                       'wspd': {'metric': '10'}, 'temp': {'metric': str(12 + hour % 10)}, 'humidity': '55'})
+    write('hourly10day', {'response': {}, 'hourly_forecast': hourly})
+    write('hourly', {'response': {}, 'hourly_forecast': hourly[:36]})
+
+    forecast = []
+    for days in range(10):
+        day = today + datetime.timedelta(days=days)
+        forecast.append({'date': {'year': day.year, 'month': day.month, 'day': day.day, 'hour': 12, 'min': 0},
+                         'qpf_allday': {'mm': days % 3}, 'high': {'celsius': '21'}, 'low': {'celsius': '9'},
+                         'avewind': {'kph': 11}, 'avehumidity': 60})
+    write('forecast10day', {'response': {}, 'forecast': {'simpleforecast': {'forecastday': forecast}}})
+
+    write('conditions', {'response': {}, 'current_observation': {
+        'temperature_string': '18 C', 'temp_c': 18, 'temp_f': 64.4, 'precip_today_metric': '0.5', 'wind_kph': 9,
+        'relative_humidity': '62%', 'pressure_mb': '1013', 'pressure_trend': '-'}})
+    write('geolookup', {'response': {}, 'location': {'lat': '52.0', 'lon': '5.0'}})
+
+
+class _RecordingProvider(FixtureProvider):
+    """Serves the fixtures like the wunderground API (rate limited) and records all requests."""
+
+    RATE_LIMITED = True
+
+    def __init__(self, path):
+        super(_RecordingProvider, self).__init__(path)
+        self.requests = []
+        self._lock = Lock()
+
+    def fetch(self, location, query, etag=None, modified=None):
+        result = super(_RecordingProvider, self).fetch(location, query, etag, modified)
+        with self._lock:
+            self.requests.append((time.time(), query, result is not None))
+        return result
+
+
+class _WeatherTestCase(unittest.TestCase):
+    """Points the weather thread at the fixtures, using a new location for every test."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Wait for the first (empty) cycle of the weather thread, it sleeps for an hour afterwards:
+        timeout = time.time() + 10
+        while weather._sleep_time <= 0 and time.time() < timeout:
+            time.sleep(0.01)
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='ospy_weather_')
+        _write_fixtures(self.path)
+        self.provider = _RecordingProvider(self.path)
+
+        self.original = weather._provider, weather._lid, weather._location, weather._request_tokens
+        location = next(_locations)
+        weather._provider = self.provider
+        weather._lid = 'pws:TEST%d' % location
+        weather._location = 'Test %d' % location
+        weather._request_tokens = _TokenBucket(5, 50.0)
+
+    def tearDown(self):
+        weather._provider, weather._lid, weather._location, weather._request_tokens = self.original
+        shutil.rmtree(self.path, True)
+
+    def queries(self):
+        return [query for _, query, _ in self.provider.requests]
+
+
+def _assert_rate(test, times, capacity, rate):
+    """Asserts that no period had more calls than the bucket allows."""
+    times = sorted(times)
+    for first in range(len(times)):
+        for last in range(first + capacity, len(times)):
+            test.assertGreaterEqual(times[last] - times[first], (last - first + 1 - capacity) / rate - 0.005)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = _TokenBucket(3, 20.0)
+        start = time.time()
+        times = []
+        for _ in range(9):
+            bucket.take()
+            times.append(time.time())
+
+        self.assertLess(times[2] - start, 0.05)
+        self.assertGreaterEqual(times[-1] - start, 6 / 20.0 - 0.005)
+        _assert_rate(self, times, 3, 20.0)
+
+    def test_threads(self):
+        bucket = _TokenBucket(2, 40.0)
+        times = []
+
+        def take():
+            for _ in range(5):
+                bucket.take()
+                times.append(time.time())
+
+        threads = [Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(times), 20)
+        _assert_rate(self, times, 2, 40.0)
+
+
+class TestWeatherResults(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.result_file = weather_module.WEATHER_RESULT_FILE
+        weather_module.WEATHER_RESULT_FILE = os.path.join(self.folder, 'weather_results.pkl')
+        self.today = datetime.date.today()
+
+    def tearDown(self):
+        weather_module.WEATHER_RESULT_FILE = self.result_file
+        shutil.rmtree(self.folder)
+
+    @staticmethod
+    def _saved(results):
+        """Saves the results now instead of after the delay."""
+        if results._save_timer is not None:
+            results._save_timer.cancel()
+            results._save_timer = None
+        results._save()
+
+    def test_round_trip(self):
+        results = _WeatherResults()
+        old = self.today - datetime.timedelta(days=_WeatherResults.MAX_AGE + 1)
+        results[('pws:TEST', 10, 'eto', self.today)] = 4.5
+        results[('pws:TEST', 10, 'rain', self.today)] = 1.0
+        results[('pws:TEST', 10, 'eto', old)] = 3.0
+        self.assertIn(('pws:TEST', 10, 'eto', old), results)
+        self._saved(results)
+
+        # Old values are dropped when saving:
+        loaded = _WeatherResults()
+        self.assertEqual(loaded._results, {('pws:TEST', 10, 'eto', self.today): 4.5,
+                                           ('pws:TEST', 10, 'rain', self.today): 1.0})
+        self.assertNotIn(('pws:TEST', 10, 'eto', old), loaded)
+
+        # Setting the same value again does not need a save:
+        loaded[('pws:TEST', 10, 'eto', self.today)] = 4.5
+        self.assertIsNone(loaded._save_timer)
+        loaded[('pws:TEST', 10, 'eto', self.today)] = 5.0
+        self.assertIsNotNone(loaded._save_timer)
+        self._saved(loaded)
+
+        # An interrupted save is resumed:
+        os.rename(weather_module.WEATHER_RESULT_FILE, weather_module.WEATHER_RESULT_FILE + '.tmp')
+        self.assertEqual(_WeatherResults()[('pws:TEST', 10, 'eto', self.today)], 5.0)
+
+    def test_migration(self):
+        options.weather_cache = {'location': 'pws:TEST', 'elevation': 10,
+                                 'eto': {self.today: 4.5}, 'rain': {self.today: 1.0}}
+        results = _WeatherResults()
+        self.assertEqual(options.weather_cache, {})
+        self.assertEqual(results._results, {('pws:TEST', 10, 'eto', self.today): 4.5,
+                                            ('pws:TEST', 10, 'rain', self.today): 1.0})
+        self.assertEqual(_WeatherResults()._results, results._results)
+
+
+class TestParsedDocuments(unittest.TestCase):
+    def setUp(self):
+        self.memory = options.weather_memory
+        options.weather_memory = 1  # kB
+        self.documents = _ParsedDocuments()
+        self.reads = []
+
+    def tearDown(self):
+        options.weather_memory = self.memory
+
+    def _load(self, key, fetched, size=300):
+        def read():
+            self.reads.append(key)
+            return json.dumps({'key': key, 'padding': 'x' * size})
+        return self.documents.load(key, fetched, read)
+
+    def test_hits(self):
+        self.assertEqual(self._load('conditions', 1)['key'], 'conditions')
+        self.assertEqual(self._load('conditions', 1)['key'], 'conditions')
+        self.assertEqual(self.reads, ['conditions'])
+
+        # A document that has been fetched again is read again:
+        self._load('conditions', 2)
+        self.assertEqual(self.reads, ['conditions', 'conditions'])
+        info = self.documents.info()
+        self.assertEqual((info['hits'], info['misses'], info['documents']), (1, 2, 1))
+        self.assertEqual(info['size'], len(json.dumps({'key': 'conditions', 'padding': 'x' * 300})))
+
+    def test_memory(self):
+        for key in ['first', 'second', 'third']:
+            self._load(key, 1)
+        self._load('first', 1)  # Recently used
+        self._load('fourth', 1)
+        self.assertEqual(list(self.documents._documents), ['third', 'first', 'fourth'])
+        self.assertLessEqual(self.documents.info()['size'], 1024)
+
+        # A document larger than the memory is kept until the next one is loaded:
+        self._load('large', 1, 2000)
+        self.assertEqual(list(self.documents._documents), ['large'])
+        self._load('large', 1)
+        self.assertEqual(self.reads.count('large'), 1)
+        self._load('fifth', 1)
+        self.assertEqual(list(self.documents._documents), ['fifth'])
+
+
+class TestPrefetch(_WeatherTestCase):
+    def _history(self, days):
+        return ['history_' + (datetime.date.today() - datetime.timedelta(days=day)).strftime('%Y%m%d')
+                for day in days]
+
+    def _expected(self):
+        """Returns the documents a prefetch should request (the history of today is used after noon)."""
+        first_day = 0 if datetime.datetime.now().hour >= 12 else 1
+        return ['conditions', 'hourly10day', 'forecast10day'] + self._history(range(first_day, 21))
+
+    def test_requests(self):
+        weather._prefetch()
+        expected = self._expected()
+        self.assertEqual(sorted(self.queries()), sorted(expected))
+
+        # Everything is stored now, so neither a second prefetch nor the balance calculations need a request:
+        weather._prefetch()
+        today = datetime.date.today()
+        for days in range(-20, 8):
+            weather.get_eto(today + datetime.timedelta(days=days))
+            weather.get_rain(today + datetime.timedelta(days=days))
+        self.assertEqual(sorted(self.queries()), sorted(expected))
+
+    def test_order(self):
+        requests = [query for _, query, _ in sorted(weather._prefetch_requests())]
+        self.assertEqual(sorted(requests[:3]), sorted(self._expected()[:3]))
+        self.assertEqual(requests[3:], self._expected()[3:])
+
+    def test_results(self):
+        # History days with a calculated ETo and rain value are not requested again:
+        today = datetime.date.today()
+        for days in range(1, 11):
+            for metric in ['eto', 'rain']:
+                weather._results[(weather._location, options.elevation, metric,
+                                  today - datetime.timedelta(days=days))] = 1.0
+
+        weather._prefetch()
+        expected = [query for query in self._expected() if query not in self._history(range(1, 11))]
+        self.assertEqual(sorted(self.queries()), sorted(expected))
+
+    def test_failures(self):
+        # A failed download does not stop the others, it is requested again in the next cycle:
+        missing = self._history([2])[0]
+        os.remove(os.path.join(self.path, missing + '.json'))
+        weather._prefetch()
+        self.assertEqual(sorted(self.queries()), sorted(query for query in self._expected() if query != missing))
+        self.assertEqual([query for _, query, _ in weather._prefetch_requests()], [missing])
+
+    def test_rate_limit(self):
+        weather._request_tokens = _TokenBucket(3, 30.0)
+        start = time.time()
+        weather._prefetch()
+
+        times = [request_time for request_time, _, _ in self.provider.requests]
+        self.assertGreaterEqual(len(times), 21)
+        self.assertGreaterEqual(max(times) - start, (len(times) - 3) / 30.0 - 0.005)
+        _assert_rate(self, times, 3, 30.0)
+
+
+class TestWeather(_WeatherTestCase):
+    def test_values(self):
+        conditions = weather.get_wunderground_conditions(force=False)
+        self.assertEqual((conditions['temp_c'], conditions['rain_mm'], conditions['humidity']), (18, 0.5, 62))
+        self.assertAlmostEqual(conditions['wind_ms'], 9 / 3.6)
+
+        forecast = weather.get_wunderground_forecast(3)
+        self.assertEqual(sorted(forecast), [0, 1, 2, 3])
+        self.assertEqual([forecast[index]['rain_mm'] for index in range(4)], [0, 1, 2, 0])
+
+        history = weather.get_wunderground_history(3)
+        self.assertEqual(sorted(history), [-3, -2, -1])
+        self.assertEqual([history[index]['rain_mm'] for index in [-1, -2, -3]], [1, 2, 3])
+
+        today = datetime.date.today()
+        for days in range(1, 8):
+            self.assertEqual(weather.get_rain(today - datetime.timedelta(days=days)), days % 4)
+            self.assertEqual(weather.get_rain(today + datetime.timedelta(days=days)), days % 3)
+            eto = weather.get_eto(today - datetime.timedelta(days=days))
+            self.assertTrue(0 < eto < 10 and eto != 2.0, eto)  # 2.0 is used if there are no daily values
+
+    def test_revalidation(self):
+        name = 'conditions_' + datetime.date.today().strftime('%Y%m%d')
+        weather._get_wunderground_data('conditions', name)
+        fetched = observations.info(weather._lid, name)[0]
+
+        # The fixture did not change, so the stored document is kept and marked as fetched:
+        weather._download(weather._lid, 'conditions', name)
+        self.assertEqual(self.provider.requests[-1][1:], ('conditions', False))
+        self.assertGreaterEqual(observations.info(weather._lid, name)[0], fetched)
+        self.assertEqual(weather.get_wunderground_conditions(force=False)['temp_c'], 18)
+
+        path = os.path.join(self.path, 'conditions.json')
+        with open(path, 'r') as fh:
+            data = json.load(fh)
+        data['current_observation']['temp_c'] = 25
+        with open(path, 'w') as fh:
+            json.dump(data, fh)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+        weather._download(weather._lid, 'conditions', name)
+        self.assertEqual(self.provider.requests[-1][1:], ('conditions', True))
+        self.assertEqual(weather.get_wunderground_conditions(force=False)['temp_c'], 25)
+
+    def test_documents(self):
+        # The parsed documents are kept in memory until the stored document is fetched again:
+        for _ in range(5):
+            weather.get_wunderground_forecast(3)
+        info = weather.document_cache_info()
+        weather._download(weather._lid, 'forecast10day', 'forecast10day_' + datetime.date.today().strftime('%Y%m%d'))
+        weather.get_wunderground_forecast(3)
+        self.assertEqual(weather.document_cache_info()['hits'], info['hits'])
+        self.assertEqual(weather.document_cache_info()['misses'], info['misses'] + 1)
+        self.assertEqual([request[1:] for request in self.provider.requests],
+                         [('forecast10day', True), ('forecast10day', False)])
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the fixtures like the wunderground API: /api/<key>/<query>/q/<location>.json (with ETag and gzip)."""
+
+    protocol_version = 'HTTP/1.1'
+    path_prefix = None
+    requests = []
+
+    def do_GET(self):
+        query = self.path.split('/')[3]
+        with open(os.path.join(self.path_prefix, query + '.json'), 'rb') as fh:
+            body = fh.read()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.requests.append((self.client_address, query, self.headers.get('Accept-Encoding')))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            body = ''
+        else:
+            self.send_response(200)
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+                fh.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestWundergroundProvider(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='ospy_weather_')
+        _write_fixtures(self.path)
+        _StandInHandler.path_prefix = self.path
+        _StandInHandler.requests = []
+
+        self.server = _StandInServer(('127.0.0.1', 0), _StandInHandler)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.original = weather_providers.WUNDERGROUND_URL
+        weather_providers.WUNDERGROUND_URL = 'http://127.0.0.1:%d/api/' % self.server.server_address[1]
+
+    def tearDown(self):
+        weather_providers.WUNDERGROUND_URL = self.original
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path, True)
+
+    def test_fetch(self):
+        provider = weather_providers.WundergroundProvider()
+        with open(os.path.join(self.path, 'conditions.json'), 'rb') as fh:
+            expected = fh.read()
+
+        body, etag, _ = provider.fetch('pws:TEST', 'conditions')
+        self.assertEqual(body, expected)
+        self.assertIsNone(provider.fetch('pws:TEST', 'conditions', etag))
+        self.assertEqual(provider.fetch('pws:TEST', 'forecast10day')[0][:20], '{"response": {}, "fo')
+
+        # All requests used the same (keep-alive) connection and asked for compression:
+        self.assertEqual(len(_StandInHandler.requests), 3)
+        self.assertEqual(len(set(address for address, _, _ in _StandInHandler.requests)), 1)
+        self.assertEqual(set(encoding for _, _, encoding in _StandInHandler.requests), {'gzip'})
+
+    def test_prefetch(self):
+        provider = weather_providers.WundergroundProvider()
+        provider.available = lambda: True  # The stand-in needs no key
+        original = weather._provider, weather._lid, weather._location, weather._request_tokens
+        location = next(_locations)
+        weather._provider, weather._lid, weather._location = provider, 'pws:TEST%d' % location, 'Test %d' % location
+        weather._request_tokens = _TokenBucket(50, 500.0)
+        try:
+            weather._prefetch()
+            self.assertEqual(len(_StandInHandler.requests), len(set(query for _, query, _ in _StandInHandler.requests)))
+            self.assertGreaterEqual(len(_StandInHandler.requests), 23)
+            self.assertLessEqual(len(set(address for address, _, _ in _StandInHandler.requests)), weather.PREFETCH_WORKERS)
+        finally:
+            weather._provider, weather._lid, weather._location, weather._request_tokens = original
+
+
+if __name__ == '__main__':
+    unittest.main()